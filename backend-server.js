@@ -6,7 +6,7 @@ const path = require('path');
 
 const app = express();
 app.use(cors());
-app.use(express.json());
+app.use(express.json({ limit: '10mb' })); // gzip (Content-Encoding) se descomprime automáticamente
 
 // SQL Server configuration
 const config = {
@@ -306,6 +306,40 @@ app.get('/api/health', (req, res) => {
   });
 });
 
+// Sync data endpoint (sql_sync_robust.py): JSON o NDJSON por trozos, ambos admiten gzip
+app.post('/api/sync-data', express.text({ type: 'application/x-ndjson', limit: '10mb' }), (req, res) => {
+  try {
+    let appointments = [];
+    let tombstones = [];
+    if (typeof req.body === 'string') {
+      // Una línea por registro: {"type": "appointment" | "tombstone", "data": {...}}
+      req.body.split('\n').filter(line => line.trim()).forEach(line => {
+        const item = JSON.parse(line);
+        (item.type === 'tombstone' ? tombstones : appointments).push(item.data);
+      });
+    } else {
+      appointments = req.body.appointments || [];
+      tombstones = req.body.tombstones || [];
+    }
+
+    const { newAppointments, updatedAppointments } = processAppointmentChanges(appointments);
+    tombstones.forEach(tombstone => lastSyncData.delete(tombstone.Registro));
+
+    const chunk = req.get('X-Sync-Chunk');
+    logMessage(`Datos sincronizados${chunk ? ` (trozo ${chunk})` : ''}: ${appointments.length} citas, ${tombstones.length} bajas`);
+    res.json({
+      success: true,
+      received: appointments.length,
+      tombstones: tombstones.length,
+      new_appointments: newAppointments.length,
+      updated_appointments: updatedAppointments.length
+    });
+  } catch (error) {
+    logMessage(`Error procesando datos sincronizados: ${error.message}`);
+    res.status(400).json({ success: false, error: error.message });
+  }
+});
+
 // Sync status endpoint
 app.get('/api/sync-status', (req, res) => {
   const newCount = Array.from(lastSyncData.values()).filter(apt => apt.FechaAlta === apt.CitMod).length;
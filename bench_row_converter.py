@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark de la conversión de filas: bucle celda a celda (hasattr /
+isinstance, como hacían los scripts) frente a RowConverter (gesden_rows.py).
+
+Usa filas sintéticas con las columnas de AppointmentQuery; no necesita SQL
+Server.
+
+Uso:
+  python bench_row_converter.py [--sizes 1000,100000,1000000] [--repeat 3]
+"""
+
+import argparse
+import datetime
+import time
+from typing import Any, Callable, Dict, List
+
+from gesden_query import APPOINTMENT_COLUMNS
+from gesden_rows import RowConverter
+
+COLUMNS = APPOINTMENT_COLUMNS + ['Duracion']
+TYPES = [int, datetime.datetime, datetime.datetime, str, str, str, str,
+         str, str, str, str, str, str, int]
+
+
+def make_rows(n: int) -> List[tuple]:
+    base = datetime.datetime(2025, 1, 1, 8, 0)
+    rows = []
+    for i in range(n):
+        stamp = base + datetime.timedelta(minutes=i)
+        rows.append((
+            i, stamp, stamp, f'{i % 5000:06d}', 'Garcia Lopez', 'Ana', None if i % 7 else '600000000',
+            '2025-01-01', '09:30', 'Planificada', 'Revision', 'Dra. Irene Garcia',
+            None if i % 3 else 'Notas', 30,
+        ))
+    return rows
+
+
+def legacy_dicts(columns: List[str], rows: List[tuple]) -> List[Dict[str, Any]]:
+    """Bucle de sql_sync_robust.rows_to_dicts anterior."""
+    data = []
+    for row in rows:
+        row_dict = {}
+        for i, column in enumerate(columns):
+            value = row[i]
+            if hasattr(value, 'strftime'):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            elif value is None:
+                value = ''
+            row_dict[column] = value
+        data.append(row_dict)
+    return data
+
+
+def legacy_text(rows: List[tuple]) -> List[List[str]]:
+    """normalize_value anterior del export CSV."""
+    def normalize_value(v):
+        if isinstance(v, (bytes, bytearray)):
+            return v.decode('utf-8', errors='ignore')
+        if isinstance(v, datetime.datetime):
+            return v.strftime('%Y-%m-%d %H:%M:%S')
+        if v is None:
+            return ''
+        return str(v)
+    return [[normalize_value(v) for v in r] for r in rows]
+
+
+def best_of(fn: Callable[[], Any], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Microbenchmark de conversión de filas')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='Número de filas, separados por comas')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeticiones (se toma la mejor)')
+    args = parser.parse_args()
+
+    description = list(zip(COLUMNS, TYPES))
+    to_json = RowConverter(description)
+    to_text = RowConverter(description, as_text=True)
+    assert legacy_dicts(COLUMNS, make_rows(50)) == to_json.to_dicts(make_rows(50))
+    assert [tuple(r) for r in legacy_text(make_rows(50))] == to_text.to_tuples(make_rows(50))
+
+    print(f"{'filas':>9}  {'caso':<6} {'celda a celda':>14} {'RowConverter':>13} {'mejora':>7}")
+    for n in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        rows = make_rows(n)
+        cases = [
+            ('dict', lambda: legacy_dicts(COLUMNS, rows), lambda: to_json.to_dicts(rows)),
+            ('texto', lambda: legacy_text(rows), lambda: to_text.to_tuples(rows)),
+        ]
+        for name, old, new in cases:
+            t_old = best_of(old, args.repeat)
+            t_new = best_of(new, args.repeat)
+            print(f"{n:>9}  {name:<6} {t_old:>13.3f}s {t_new:>12.3f}s {t_old / t_new:>6.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
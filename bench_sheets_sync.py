@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la sincronización con Google Sheets (sync_worksheet de
+gesden_sheets) contra el Sheets simulado de gesden_sheets_fake.py.
+
+Para cada tamaño de hoja y porcentaje de cambio se siembra la hoja con una
+primera sincronización y se mide la segunda:
+  • peticiones de lectura / escritura y respuestas 429,
+  • KB enviados y recibidos,
+  • tiempo de API simulado (latencia + esperas por cuota, reloj virtual),
+  • tiempo de CPU local del propio script.
+
+El cambio (churn) reparte los registros afectados entre modificados y
+desplazamiento de la ventana (salen los más antiguos y entran nuevos), como
+cuando se mueve el TOP 250 tras una mañana con muchas citas.
+
+--legacy mide además el algoritmo anterior (get_all_values dos veces,
+append_row y delete_rows fila a fila) como referencia.
+
+Uso:
+  python bench_sheets_sync.py [--sizes 100,1000,10000,50000] [--churn 0,10,50,100]
+                              [--legacy] [--output bench_sheets.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import gesden_sheets
+import gesden_to_sheets
+from gesden_sheets import QuotaClient, QuotaWorksheet
+from gesden_sheets_fake import FakeBackend, FakeSpreadsheet
+
+STATES = ['Planificada', 'Confirmada', 'Anulada', 'Finalizada']
+TREATMENTS = ['Revision', 'Higiene', 'Ortodoncia', 'Implante', 'Endodoncia']
+DENTISTS = ['Dr. Mario Rubio', 'Dra. Irene Garcia', 'Dra. Virginia Tresgallo']
+
+
+def make_record(n: int) -> Dict[str, str]:
+    stamp = f"2025-01-{1 + n % 28:02d} {8 + n % 10:02d}:{n % 60:02d}:00"
+    return {
+        'Registro': str(n), 'CitMod': stamp, 'FechaAlta': stamp, 'NumPac': f"{n % 5000:06d}",
+        'Apellidos': 'Garcia Lopez', 'Nombre': 'Ana', 'TelMovil': '600000000',
+        'Fecha': f"2025-02-{1 + n % 28:02d}", 'Hora': f"{9 + n % 9:02d}:30",
+        'EstadoCita': STATES[n % len(STATES)], 'Tratamiento': TREATMENTS[n % len(TREATMENTS)],
+        'Odontologo': DENTISTS[n % len(DENTISTS)], 'Notas': '', 'Duracion': '30',
+    }
+
+
+def churned(records: List[Dict[str, str]], churn: float, rng: random.Random) -> List[Dict[str, str]]:
+    """Mitad de los afectados se modifica; la otra mitad sale de la ventana y entra la misma cantidad nueva."""
+    affected = round(len(records) * churn)
+    modified = affected // 2
+    shifted = affected - modified
+    top = max(int(r['Registro']) for r in records) + 1 if records else 0
+    kept = records[:len(records) - shifted]
+    result = [make_record(top + i) for i in range(shifted)] + [dict(r) for r in kept]
+    for r in rng.sample(result[shifted:], min(modified, len(kept))):
+        r['Notas'] = f"cambio {rng.random():.6f}"
+        r['CitMod'] = '2025-03-01 10:00:00'
+    return result
+
+
+def legacy_upsert(ws: Any, records: List[Dict[str, str]], client: QuotaClient) -> None:
+    """Algoritmo anterior de upsert_and_prune: get_all_values dos veces (índice antes y después
+    de escribir), updates A:P en lote, append_row y delete_rows fila a fila. Las llamadas
+    pasan por `client` para que cuenten las mismas cuotas que sync_worksheet."""
+    def build_index() -> Dict[str, int]:
+        values = client.call('read', ws.get_all_values)
+        return {row[0].strip(): i for i, row in enumerate(values, start=1) if i > 1 and row and row[0].strip()}
+
+    index = build_index()
+    current = set()
+    updates = []
+    appends = []
+    for d in records:
+        registro = d['Registro']
+        current.add(registro)
+        row = gesden_to_sheets.row_from_record(d)
+        if registro in index:
+            updates.append({'range': f"A{index[registro]}:P{index[registro]}", 'values': [row]})
+        else:
+            appends.append(row)
+    if updates:
+        client.call('write', ws.batch_update, updates)
+    for row in appends:
+        client.call('write', ws.append_row, row, value_input_option='RAW')
+    after = build_index()
+    for row_num in sorted((after[r] for r in set(after) - current), reverse=True):
+        client.call('write', ws.delete_rows, row_num)
+
+
+def run_case(size: int, churn: float, strategy: str, args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(size * 1000 + int(churn * 100))
+    backend = FakeBackend(args.reads_per_minute, args.writes_per_minute, args.latency_ms, args.latency_per_kb_ms)
+    fake_ws = FakeSpreadsheet(backend).add_worksheet(gesden_to_sheets.TARGET_WORKSHEET, rows=1000, cols=20)
+    fake_ws.update('A1:P1', [gesden_to_sheets.HEADERS])
+    client = QuotaClient(args.reads_per_minute, args.writes_per_minute, deadline=float('inf'),
+                         clock=backend.now, sleep=backend.sleep)
+    ws = QuotaWorksheet(fake_ws, client)
+
+    sync: Callable[[List[Dict[str, str]]], None]
+    if strategy == 'legacy':
+        sync = lambda records: legacy_upsert(fake_ws, records, client)  # noqa: E731
+    else:
+        sync = lambda records: gesden_to_sheets.upsert_and_prune(ws, records)  # noqa: E731
+
+    records = [make_record(n) for n in range(size, 0, -1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        gesden_sheets.SHEETS_MIRROR_FILE = os.path.join(tmp, 'sheets_mirror.json')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output if not args.verbose else None):
+            sync(records)  # Siembra: no se mide
+            new_records = churned(records, churn, rng)
+            backend.reset_stats()
+            clock = backend.now()
+            started = time.perf_counter()
+            sync(new_records)
+            cpu = time.perf_counter() - started
+    keys = [r[0] for r in fake_ws.values[1:] if r and r[0]]
+    if sorted(keys) != sorted(r['Registro'] for r in new_records):
+        raise AssertionError(f"Hoja incorrecta tras sincronizar ({strategy}, {size} filas, churn {churn:.0%})")
+    return {
+        'strategy': strategy, 'rows': size, 'churn': churn,
+        'reads': backend.stats['read'], 'writes': backend.stats['write'], 'throttled': backend.stats['throttled'],
+        'kb_out': round(backend.stats['bytes_out'] / 1024, 1), 'kb_in': round(backend.stats['bytes_in'] / 1024, 1),
+        'api_seconds': round(backend.now() - clock, 2), 'cpu_seconds': round(cpu, 3),
+        'calls': dict(backend.calls),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark de la sincronización con Google Sheets (simulado)')
+    parser.add_argument('--sizes', default='100,1000,10000,50000', help='Filas en la hoja, separadas por comas')
+    parser.add_argument('--churn', default='0,10,50,100', help='Porcentaje de filas que cambian, separados por comas')
+    parser.add_argument('--legacy', action='store_true', help='Medir también el algoritmo anterior')
+    parser.add_argument('--reads-per-minute', type=int, default=gesden_sheets.SHEETS_READS_PER_MINUTE)
+    parser.add_argument('--writes-per-minute', type=int, default=gesden_sheets.SHEETS_WRITES_PER_MINUTE)
+    parser.add_argument('--latency-ms', type=float, default=150.0, help='Latencia simulada por petición')
+    parser.add_argument('--latency-per-kb-ms', type=float, default=0.5, help='Latencia simulada por KB')
+    parser.add_argument('--output', help='Guardar resultados en JSON (línea base para comparar)')
+    parser.add_argument('--verbose', action='store_true', help='Mostrar el log de cada sincronización')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    churns = [float(c) / 100 for c in args.churn.split(',') if c.strip()]
+    strategies = ['current'] + (['legacy'] if args.legacy else [])
+
+    results = []
+    print(f"{'algoritmo':<9} {'filas':>7} {'churn':>6} {'lect':>5} {'escr':>6} {'429':>4} "
+          f"{'KB env':>9} {'KB rec':>9} {'API s':>9} {'CPU s':>7}")
+    for size in sizes:
+        for churn in churns:
+            for strategy in strategies:
+                r = run_case(size, churn, strategy, args)
+                results.append(r)
+                print(f"{strategy:<9} {size:>7} {churn:>6.0%} {r['reads']:>5} {r['writes']:>6} {r['throttled']:>4} "
+                      f"{r['kb_out']:>9.1f} {r['kb_in']:>9.1f} {r['api_seconds']:>9.2f} {r['cpu_seconds']:>7.3f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
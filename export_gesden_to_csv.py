@@ -2,9 +2,21 @@
 # -*- coding: utf-8 -*-
 """
 Exporta citas de Gesden (SQL Server) a un archivo CSV local.
-Permite filtrar por rango de fechas (columna Fecha ya transformada a YYYY-MM-DD).
+Permite filtrar por rango de fechas (YYYY-MM-DD); el filtro se aplica sobre el
+número de día de la columna Fecha (ver gesden_query.py) para poder usar índices.
+Las filas se leen en lotes (fetchmany) y se escriben según llegan, por lo que
+la memoria no crece con el tamaño de la tabla.
+Con --workers N el rango (de Fecha o de IdCita, según --shard-by) se divide en
+N tramos que se exportan en paralelo, cada uno con su propia conexión, a
+ficheros parciales que después se fusionan en orden CitMod DESC, IdCita DESC
+(CitMod a segundos, tal como se escribe).
+Con --format parquet|arrow se escriben ficheros columnares tipados y
+comprimidos (zstd), un row group por lote; requieren `pip install pyarrow`.
+--format csv.gz escribe el mismo CSV comprimido con gzip.
 Uso:
-  python export_gesden_to_csv.py --out citas.csv [--from 2025-01-01] [--to 2025-12-31]
+  python export_gesden_to_csv.py --out citas.csv [--from 2025-01-01] [--to 2025-12-31] [--batch-size 5000]
+  python export_gesden_to_csv.py --out historico.csv --workers 4 [--shard-by fecha|idcita]
+  python export_gesden_to_csv.py --out citas.parquet --format parquet [--from ...] [--to ...]
 Config mediante variables de entorno:
   DB_SERVER, DB_DATABASE, DB_DRIVER
 """
@@ -12,126 +24,346 @@ Config mediante variables de entorno:
 import argparse
 import csv
 import datetime
+import gzip
+import heapq
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
 import pyodbc
 
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery, date_range_filter, parse_date, split_range
+from gesden_rows import RowConverter, build_converter
+
 DB_SERVER = os.getenv('DB_SERVER', 'GABINETE2\\INFOMED')
 DB_DATABASE = os.getenv('DB_DATABASE', 'GELITE')
 DB_DRIVER = os.getenv('DB_DRIVER', 'ODBC Driver 17 for SQL Server')
+DEFAULT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '5000'))
+
+# Columna de dbo.DCitas usada para repartir el trabajo con --workers
+SHARD_COLUMNS = {'fecha': 'Fecha', 'idcita': 'IdCita'}
+# Orden total y determinista para poder fusionar los ficheros parciales. Debe
+# coincidir con la clave de merge_parts: CitMod se escribe truncado a segundos
+# ('YYYY-MM-DD HH:MM:SS', estilo 120), así que se ordena por ese mismo texto y
+# no por HorSitCita con milisegundos, que puede discrepar de IdCita en un segundo
+SHARD_ORDER = 'CONVERT(char(19), HorSitCita, 120) DESC, IdCita DESC'
+
+FORMATS = ('csv', 'csv.gz', 'parquet', 'arrow')
+# Tipos de las columnas en los formatos columnares (el resto son texto)
+ARROW_COLUMN_TYPES = {
+    'Registro': 'int64',
+    'CitMod': 'timestamp',
+    'FechaAlta': 'timestamp',
+    'Fecha': 'date',
+    'Hora': 'time',
+    'EstadoCita': 'category',
+    'Tratamiento': 'category',
+    'Odontologo': 'category',
+    'Duracion': 'int32',
+}
 
 
 def log(msg: str) -> None:
     print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
 
+# Conversión a texto de un valor suelto, sin tipo conocido. Para filas del
+# cursor es preferible RowConverter, que decide la conversión por columna.
+normalize_value = build_converter(None, as_text=True)
+
+
 def normalize_row(row: dict) -> dict:
-    out = {}
-    for k, v in row.items():
-        if isinstance(v, (bytes, bytearray)):
-            out[k] = v.decode('utf-8', errors='ignore')
-        elif isinstance(v, datetime.datetime):
-            out[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-        elif v is None:
-            out[k] = ''
+    return {k: normalize_value(v) for k, v in row.items()}
+
+
+def iter_batches(cur: pyodbc.Cursor, batch_size: int) -> Iterator[list]:
+    """Devuelve las filas del cursor en lotes de `batch_size` sin materializar el resultado."""
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def build_query(cursor: pyodbc.Cursor, date_from: str | datetime.date | None,
+                date_to: str | datetime.date | None, shard: str = '',
+                shard_params: Optional[list] = None, order_by: str = 'HorSitCita DESC') -> AppointmentQuery:
+    date_filter, params = date_range_filter(date_from, date_to)
+    where = ' AND '.join(p for p in (date_filter, shard) if p)
+    return AppointmentQuery(get_catalog(cursor), where=where, params=params + (shard_params or []),
+                            order_by=order_by, include_duration=True)
+
+
+def connect() -> pyodbc.Connection:
+    return pyodbc.connect(
+        f"DRIVER={{{DB_DRIVER}}};" +
+        f"SERVER={DB_SERVER};" +
+        f"DATABASE={DB_DATABASE};" +
+        "Trusted_Connection=yes;"
+    )
+
+
+class CsvOutput:
+    """CSV (opcionalmente gzip) con todos los valores como texto."""
+
+    def __init__(self, path: str, columns: List[str], compress: bool = False,
+                 description: Optional[List[Tuple[str, Any]]] = None):
+        self.converter = RowConverter(description or [(c, None) for c in columns], as_text=True)
+        if compress:
+            self.file = gzip.open(path, 'wt', newline='', encoding='utf-8')
         else:
-            out[k] = str(v)
-    return out
-
-
-def build_query(date_from: str | None, date_to: str | None) -> tuple[str, list]:
-    base = """
-    SELECT
-      IdCita AS Registro,
-      HorSitCita AS CitMod,
-      FecAlta AS FechaAlta,
-      NUMPAC AS NumPac,
-      CASE WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1))) ELSE NULL END AS Apellidos,
-      CASE WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto)))) ELSE Texto END AS Nombre,
-      Movil AS TelMovil,
-      CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-      CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-      CASE
-        WHEN IdSitC = 0 THEN 'Planificada'
-        WHEN IdSitC = 1 THEN 'Anulada'
-        WHEN IdSitC = 5 THEN 'Finalizada'
-        WHEN IdSitC = 7 THEN 'Confirmada'
-        WHEN IdSitC = 8 THEN 'Cancelada'
-        ELSE 'Desconocido'
-      END AS EstadoCita,
-      CASE
-        WHEN IdIcono = 1 THEN 'Revision'
-        WHEN IdIcono = 2 THEN 'Urgencia'
-        WHEN IdIcono = 9 THEN 'Periodoncia'
-        WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-        WHEN IdIcono = 11 THEN 'Ortodoncia'
-        WHEN IdIcono = 13 THEN 'Primera'
-        WHEN IdIcono = 14 THEN 'Higiene dental'
-        ELSE 'Otros'
-      END AS Tratamiento,
-      CASE
-        WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-        WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-        WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-        WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-        WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-        ELSE 'Odontologo'
-      END AS Odontologo,
-      CONVERT(NVARCHAR(MAX), NOTAS) AS Notas,
-      CAST(CAST(Duracion AS DECIMAL(10, 2)) / 60 AS INT) AS Duracion
-    FROM dbo.DCitas
-    """.strip()
-
-    params: list = []
-    filters: list[str] = []
-
-    if date_from:
-        filters.append("CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) >= ?")
-        params.append(date_from)
-    if date_to:
-        filters.append("CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) <= ?")
-        params.append(date_to)
-
-    if filters:
-        base += "\nWHERE " + " AND ".join(filters)
-
-    base += "\nORDER BY HorSitCita DESC"
-    return base, params
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows: List[tuple]) -> None:
+        self.writer.writerows(self.converter.to_tuples(rows))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def _to_int(v: Any) -> Optional[int]:
+    return None if v is None or v == '' else int(v)
+
+
+def _to_text(v: Any) -> Optional[str]:
+    if v is None:
+        return None
+    if isinstance(v, (bytes, bytearray)):
+        return v.decode('utf-8', errors='ignore')
+    return str(v)
+
+
+class ArrowOutput:
+    """Parquet o Arrow IPC tipado; cada lote leído se escribe como un row group/record batch."""
+
+    def __init__(self, path: str, columns: List[str], fmt: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError(f"--format {fmt} requiere pyarrow (pip install pyarrow)") from e
+        self.pa = pa
+        self.columns = columns
+        types = {
+            'int64': pa.int64(),
+            'int32': pa.int32(),
+            'timestamp': pa.timestamp('ms'),
+            'date': pa.date32(),
+            'time': pa.time32('s'),
+            # Arrow IPC (fichero) no admite diccionarios distintos entre lotes
+            'category': pa.dictionary(pa.int32(), pa.string()) if fmt == 'parquet' else pa.string(),
+        }
+        self.schema = pa.schema([(c, types.get(ARROW_COLUMN_TYPES.get(c, ''), pa.string())) for c in columns])
+        self._dates: Dict[Any, Any] = {None: None, '': None}
+        self._times: Dict[Any, Any] = {None: None, '': None}
+        converters: Dict[str, Callable[[Any], Any]] = {
+            'int64': _to_int,
+            'int32': _to_int,
+            'timestamp': lambda v: v or None,
+            'date': self._to_date,
+            'time': self._to_time,
+        }
+        self.converters = [converters.get(ARROW_COLUMN_TYPES.get(c, ''), _to_text) for c in columns]
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+    def _to_date(self, v: Any) -> Optional[datetime.date]:
+        if v not in self._dates:
+            self._dates[v] = v if isinstance(v, datetime.date) else datetime.date.fromisoformat(v)
+        return self._dates[v]
+
+    def _to_time(self, v: Any) -> Optional[datetime.time]:
+        if v not in self._times:
+            self._times[v] = v if isinstance(v, datetime.time) else datetime.time.fromisoformat(v)
+        return self._times[v]
+
+    def write(self, rows: List[tuple]) -> None:
+        if not rows:
+            return
+        pa = self.pa
+        arrays = []
+        for field, convert, values in zip(self.schema, self.converters, zip(*rows)):
+            converted = [convert(v) for v in values]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(converted, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(converted, field.type))
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if hasattr(self.writer, 'write_batch'):
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def open_output(path: str, columns: List[str], fmt: str = 'csv',
+                description: Optional[List[Tuple[str, Any]]] = None):
+    if fmt in ('parquet', 'arrow'):
+        return ArrowOutput(path, columns, fmt)
+    return CsvOutput(path, columns, compress=fmt == 'csv.gz', description=description)
+
+
+def write_export(cur: pyodbc.Cursor, query: AppointmentQuery, path: str, batch_size: int,
+                 fmt: str = 'csv') -> int:
+    """Ejecuta la consulta y escribe el resultado en `path` por lotes. Devuelve las filas escritas."""
+    cols = query.execute(cur)
+    total = 0
+    output = open_output(path, cols, fmt, query.description(cur))
+    try:
+        for batch in iter_batches(cur, batch_size):
+            output.write(query.convert(batch))
+            total += len(batch)
+    finally:
+        output.close()
+    return total
+
+
+def shard_bounds(cur: pyodbc.Cursor, column: str, date_from, date_to) -> Optional[Tuple[int, int]]:
+    """MIN/MAX de la columna de reparto dentro del filtro de fechas."""
+    date_filter, params = date_range_filter(date_from, date_to)
+    sql = f"SELECT MIN({column}), MAX({column}) FROM dbo.DCitas"
+    if date_filter:
+        sql += f" WHERE {date_filter}"
+    cur.execute(sql, params)
+    lo, hi = cur.fetchone()
+    if lo is None or hi is None:
+        return None
+    return int(lo), int(hi)
+
+
+def export_shard(index: int, shard: str, shard_params: list, args: argparse.Namespace) -> Tuple[str, int]:
+    """Exporta un tramo con su propia conexión a un fichero parcial."""
+    path = f"{args.out}.part{index:03d}"
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        query = build_query(cur, args.date_from, args.date_to, shard, shard_params, order_by=SHARD_ORDER)
+        total = write_export(cur, query, path, args.batch_size)
+        cur.close()
+    finally:
+        conn.close()
+    log(f"Tramo {index} ({shard} {shard_params}): {total} filas")
+    return path, total
+
+
+def merge_parts(parts: List[str], out: str, fmt: str = 'csv') -> int:
+    """Fusiona los ficheros parciales (ya ordenados por SHARD_ORDER) con la misma clave: CitMod, Registro."""
+    files = [open(p, 'r', newline='', encoding='utf-8') for p in parts]
+    try:
+        readers = [csv.reader(f) for f in files]
+        header = [next(r, None) for r in readers][0]
+        cit_mod = header.index('CitMod')
+        registro = header.index('Registro')
+
+        def key(row: List[str]) -> Tuple[str, int]:
+            return row[cit_mod], int(row[registro] or 0)
+
+        total = 0
+        opener = gzip.open if fmt == 'csv.gz' else open
+        with opener(out, 'wt', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for row in heapq.merge(*readers, key=key, reverse=True):
+                writer.writerow(row)
+                total += 1
+        return total
+    finally:
+        for f in files:
+            f.close()
+        for p in parts:
+            os.remove(p)
+
+
+def export_parallel(args: argparse.Namespace) -> int:
+    column = SHARD_COLUMNS[args.shard_by]
+    conn = connect()
+    try:
+        bounds = shard_bounds(conn.cursor(), column, args.date_from, args.date_to)
+    finally:
+        conn.close()
+
+    shards: List[Tuple[str, list]] = []
+    if bounds:
+        for lo, hi in split_range(bounds[0], bounds[1], args.workers):
+            shards.append((f"{column} >= ? AND {column} <= ?", [lo, hi]))
+    if column == 'Fecha' and not (args.date_from or args.date_to):
+        # Sin filtro de fechas la exportación incluye también las citas sin Fecha
+        shards.append(("Fecha IS NULL", []))
+    log(f"Exportando {len(shards)} tramos por {column} con {args.workers} workers...")
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(export_shard, i, sql, params, args) for i, (sql, params) in enumerate(shards)]
+            results = [f.result() for f in futures]
+    except Exception:
+        for i in range(len(shards)):
+            if os.path.exists(f"{args.out}.part{i:03d}"):
+                os.remove(f"{args.out}.part{i:03d}")
+        raise
+
+    parts = [path for path, _ in results]
+    if not parts:
+        # Sin filas: cabecera vacía con el mismo formato
+        conn = connect()
+        try:
+            cur = conn.cursor()
+            return write_export(cur, build_query(cur, args.date_from, args.date_to, '1 = 0'), args.out,
+                                args.batch_size, args.format)
+        finally:
+            conn.close()
+    log(f"Fusionando {len(parts)} ficheros parciales en {args.out}...")
+    return merge_parts(parts, args.out, args.format)
 
 
 def main() -> int:
-    parser = argparse.ArgumentParser(description='Exporta citas de Gesden a CSV')
-    parser.add_argument('--out', required=True, help='Ruta de salida del CSV')
-    parser.add_argument('--from', dest='date_from', required=False, help='Fecha desde (YYYY-MM-DD)')
-    parser.add_argument('--to', dest='date_to', required=False, help='Fecha hasta (YYYY-MM-DD)')
+    parser = argparse.ArgumentParser(description='Exporta citas de Gesden a CSV, Parquet o Arrow')
+    parser.add_argument('--out', required=True, help='Ruta del fichero de salida')
+    parser.add_argument('--from', dest='date_from', type=parse_date, required=False, help='Fecha desde (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='date_to', type=parse_date, required=False, help='Fecha hasta (YYYY-MM-DD)')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'Filas por lote de lectura/escritura (por defecto {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Tramos exportados en paralelo, cada uno con su conexión (por defecto 1)')
+    parser.add_argument('--shard-by', dest='shard_by', choices=sorted(SHARD_COLUMNS), default='fecha',
+                        help='Columna para repartir los tramos con --workers (por defecto fecha)')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='Formato de salida (por defecto csv)')
     args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error('--batch-size debe ser mayor que 0')
+    if args.workers <= 0:
+        parser.error('--workers debe ser mayor que 0')
+    if args.workers > 1 and args.format not in ('csv', 'csv.gz'):
+        parser.error('--workers solo admite --format csv o csv.gz')
+
+    if args.workers > 1:
+        try:
+            total = export_parallel(args)
+            log(f"✅ Exportación completada. Filas: {total}")
+            return 0
+        except Exception as e:
+            log(f"❌ Error: {e}")
+            return 1
 
     conn = None
     cur = None
     try:
         log(f"Conectando a SQL Server: {DB_SERVER}/{DB_DATABASE}")
-        conn = pyodbc.connect(
-            f"DRIVER={{{{}}}}".format(DB_DRIVER) + ";" +
-            f"SERVER={DB_SERVER};" +
-            f"DATABASE={DB_DATABASE};" +
-            "Trusted_Connection=yes;"
-        )
+        conn = connect()
         cur = conn.cursor()
-        query, params = build_query(args.date_from, args.date_to)
-        log("Ejecutando consulta...")
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        cols = [c[0] for c in cur.description]
-        log(f"Filas: {len(rows)}. Escribiendo {args.out} ...")
-
-        with open(args.out, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(cols)
-            for r in rows:
-                normalized = normalize_row(dict(zip(cols, r)))
-                writer.writerow([normalized.get(c, '') for c in cols])
+        query = build_query(cur, args.date_from, args.date_to)
+        log(f"Ejecutando consulta y escribiendo {args.out} en lotes de {args.batch_size} filas...")
+        total = write_export(cur, query, args.out, args.batch_size, args.format)
 
-        log("✅ Exportación completada")
+        log(f"✅ Exportación completada. Filas: {total}")
         return 0
     except Exception as e:
         log(f"❌ Error: {e}")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cliente del backend (backend-server.js) para enviar las citas sincronizadas.
+
+Antes cada envío hacía un GET a /api/health y luego un requests.post sin
+reutilizar conexión, con toda la lista de citas en un JSON sin comprimir.
+BackendClient:
+  • mantiene una requests.Session (keep-alive): una sola conexión TCP para
+    todas las peticiones del proceso (y del demonio de sync_engine),
+  • comprime el cuerpo con gzip (Content-Encoding: gzip; express.json y
+    express.text lo descomprimen sin configuración adicional),
+  • con más de BACKEND_CHUNK_RECORDS citas envía NDJSON por trozos
+    (X-Sync-Batch / X-Sync-Chunk: i/n), sin construir un único JSON enorme,
+  • omite /api/health si el último envío correcto fue hace menos de
+    BACKEND_HEALTH_TTL segundos (se recuerda entre ejecuciones en
+    BACKEND_STATE_FILE); si el envío falla se vuelve a comprobar la próxima vez.
+
+>>> list(ndjson_lines([{'Registro': 1}], [{'Registro': 2, 'reason': 'deleted'}]))
+[b'{"type":"appointment","data":{"Registro":1}}\\n', b'{"type":"tombstone","data":{"Registro":2,"reason":"deleted"}}\\n']
+>>> len(list(chunked(range(5), 2)))
+3
+"""
+
+import datetime
+import gzip
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import requests
+
+from gesden_record import json_default
+from gesden_snapshot import write_json_atomic
+
+BACKEND_TIMEOUT = int(os.getenv('BACKEND_TIMEOUT', '30'))
+# Segundos durante los que un envío correcto hace innecesario /api/health
+BACKEND_HEALTH_TTL = int(os.getenv('BACKEND_HEALTH_TTL', '600'))
+# A partir de cuántas citas se envía NDJSON por trozos (y tamaño de cada trozo)
+BACKEND_CHUNK_RECORDS = int(os.getenv('BACKEND_CHUNK_RECORDS', '1000'))
+# Cuerpos más pequeños no compensan la compresión
+BACKEND_GZIP_MIN_BYTES = int(os.getenv('BACKEND_GZIP_MIN_BYTES', '1024'))
+BACKEND_STATE_FILE = os.getenv('BACKEND_STATE_FILE', 'backend_client_state.json')
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def log(msg: str, level: str = 'info') -> None:
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+def _dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=json_default).encode('utf-8')
+
+
+def ndjson_lines(appointments: Iterable[Any], tombstones: Iterable[Dict[str, Any]] = ()) -> Iterator[bytes]:
+    """Una línea JSON por cita y por baja."""
+    for appointment in appointments:
+        yield _dumps({'type': 'appointment', 'data': appointment}) + b'\n'
+    for tombstone in tombstones:
+        yield _dumps({'type': 'tombstone', 'data': tombstone}) + b'\n'
+
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk: List[Any] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BackendClient:
+    """Conexión persistente con el backend; ver la descripción del módulo."""
+
+    def __init__(self, base_url: str, timeout: int = BACKEND_TIMEOUT, health_ttl: int = BACKEND_HEALTH_TTL,
+                 chunk_records: int = BACKEND_CHUNK_RECORDS, state_file: Optional[str] = BACKEND_STATE_FILE,
+                 log: Callable[..., None] = log, session: Optional[requests.Session] = None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.health_ttl = health_ttl
+        self.chunk_records = max(1, chunk_records)
+        self.state_file = state_file
+        self.log = log
+        self.session = session or requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+        self.last_success = self._load_last_success()
+
+    # --- Estado entre ejecuciones ---
+
+    def _load_last_success(self) -> Optional[float]:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return float(json.load(f)['last_success'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _record(self, success: bool) -> None:
+        self.last_success = time.time() if success else None
+        if self.state_file:
+            try:
+                write_json_atomic(self.state_file, {'last_success': self.last_success, 'base_url': self.base_url})
+            except OSError:
+                pass
+
+    # --- Peticiones ---
+
+    def health(self) -> bool:
+        """GET /api/health."""
+        try:
+            response = self.session.get(f"{self.base_url}/api/health", timeout=10)
+            if response.status_code == 200:
+                data = response.json()
+                self.log(f"✅ Backend API disponible - Estado: {data.get('status', 'Unknown')}")
+                return True
+            self.log(f"⚠️ Backend API respondió con código: {response.status_code}", 'warning')
+            return False
+        except requests.exceptions.RequestException as e:
+            self.log(f"❌ Backend API no disponible: {e}", 'warning')
+            return False
+
+    def recently_ok(self) -> bool:
+        return self.last_success is not None and time.time() - self.last_success < self.health_ttl
+
+    def post(self, path: str, body: bytes, content_type: str = 'application/json',
+             headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        """POST con el cuerpo ya serializado; se comprime con gzip si merece la pena."""
+        headers = dict(headers or {}, **{'Content-Type': content_type})
+        if len(body) >= BACKEND_GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        return self.session.post(f"{self.base_url}{path}", data=body, headers=headers, timeout=self.timeout)
+
+    def push_appointments(self, appointments: Sequence[Any],
+                          tombstones: Optional[Sequence[Dict[str, Any]]] = None) -> bool:
+        """Envía la instantánea de citas (y las bajas) a /api/sync-data. Devuelve True si el backend la aceptó."""
+        if not self.recently_ok() and not self.health():
+            self._record(False)
+            return False
+        try:
+            if len(appointments) + len(tombstones or ()) <= self.chunk_records:
+                payload: Dict[str, Any] = {'appointments': appointments}
+                if tombstones is not None:
+                    payload['tombstones'] = tombstones
+                ok = self._check(self.post('/api/sync-data', _dumps(payload)))
+            else:
+                ok = self._push_ndjson(appointments, tombstones or ())
+        except requests.exceptions.RequestException as e:
+            self.log(f"⚠️ Error enviando datos al backend: {e}", 'warning')
+            ok = False
+        self._record(ok)
+        return ok
+
+    def _push_ndjson(self, appointments: Sequence[Any], tombstones: Sequence[Dict[str, Any]]) -> bool:
+        total = -(-(len(appointments) + len(tombstones)) // self.chunk_records)
+        batch = uuid.uuid4().hex
+        for i, lines in enumerate(chunked(ndjson_lines(appointments, tombstones), self.chunk_records), start=1):
+            response = self.post('/api/sync-data', b''.join(lines), NDJSON_CONTENT_TYPE,
+                                 {'X-Sync-Batch': batch, 'X-Sync-Chunk': f"{i}/{total}"})
+            if not self._check(response, f" (trozo {i}/{total})"):
+                return False
+        self.log(f"📦 {len(appointments)} citas enviadas en {total} trozos NDJSON")
+        return True
+
+    def _check(self, response: requests.Response, what: str = '') -> bool:
+        if response.status_code == 200:
+            return True
+        self.log(f"⚠️ Backend respondió con código: {response.status_code}{what}", 'warning')
+        return False
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Catálogos de Gesden (estados de cita, tratamientos/iconos y odontólogos).
+
+Sustituye a las escaleras CASE repetidas en cada script: los identificadores
+se leen en crudo desde dbo.DCitas y se traducen en Python con estas tablas.
+
+Origen de los catálogos (variable GESDEN_CATALOG_SOURCE):
+  • 'file' (por defecto): tablas integradas + correcciones de gesden_catalog.json
+  • 'db': se leen de las tablas de catálogo de Gesden (CATALOG_QUERIES) y se
+    guardan en gesden_catalog.json; si falla se usa el fichero.
+
+Para dar de alta un odontólogo basta con añadirlo a gesden_catalog.json:
+  {"Odontologo": {"15": "Dra. Nueva Doctora"}}
+"""
+
+import datetime
+import json
+import os
+import sys
+from typing import Any, Dict, Optional
+
+CATALOG_FILE = os.getenv('GESDEN_CATALOG_FILE', 'gesden_catalog.json')
+CATALOG_SOURCE = os.getenv('GESDEN_CATALOG_SOURCE', 'file')
+
+# Tablas integradas (equivalentes a las escaleras CASE históricas)
+DEFAULT_CATALOG: Dict[str, Dict[int, str]] = {
+    'EstadoCita': {
+        0: 'Planificada',
+        1: 'Anulada',
+        5: 'Finalizada',
+        7: 'Confirmada',
+        8: 'Cancelada',
+    },
+    'Tratamiento': {
+        1: 'Revision',
+        2: 'Urgencia',
+        9: 'Periodoncia',
+        10: 'Cirugia Implantes',
+        11: 'Ortodoncia',
+        13: 'Primera',
+        14: 'Higiene dental',
+    },
+    'Odontologo': {
+        3: 'Dr. Mario Rubio',
+        4: 'Dra. Irene Garcia',
+        8: 'Dra. Virginia Tresgallo',
+        10: 'Dra. Miriam Carrasco',
+        12: 'Dr. Juan Antonio Manzanedo',
+    },
+}
+
+# Valor cuando el identificador no está en el catálogo (rama ELSE del CASE)
+FALLBACKS: Dict[str, str] = {
+    'EstadoCita': 'Desconocido',
+    'Tratamiento': 'Otros',
+    'Odontologo': 'Odontologo',
+}
+
+# Columna de dbo.DCitas de la que sale cada catálogo
+SOURCE_COLUMNS: Dict[str, str] = {
+    'EstadoCita': 'IdSitC',
+    'Tratamiento': 'IdIcono',
+    'Odontologo': 'IdUsu',
+}
+
+# Consultas a las tablas de catálogo de Gesden (id, descripción).
+# Ajustar con variables de entorno si la instalación usa otros nombres.
+CATALOG_QUERIES: Dict[str, str] = {
+    'EstadoCita': os.getenv('GESDEN_SQL_ESTADOS', 'SELECT IdSitC, Descripcion FROM dbo.TSitCita'),
+    'Tratamiento': os.getenv('GESDEN_SQL_TRATAMIENTOS', 'SELECT IdIcono, Descripcion FROM dbo.TIconos'),
+    'Odontologo': os.getenv('GESDEN_SQL_ODONTOLOGOS', 'SELECT IdUsu, Nombre FROM dbo.TUsuAgd'),
+}
+
+
+def log(msg: str) -> None:
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+class Catalog:
+    """Tablas de traducción id -> texto con cadenas internadas."""
+
+    def __init__(self, tables: Dict[str, Dict[int, str]]):
+        self.tables: Dict[str, Dict[int, str]] = {
+            name: {int(k): sys.intern(str(v)) for k, v in table.items()}
+            for name, table in tables.items()
+        }
+        self.fallbacks: Dict[str, str] = {k: sys.intern(v) for k, v in FALLBACKS.items()}
+
+    def lookup(self, name: str, key: Any) -> str:
+        return self.tables.get(name, {}).get(key, self.fallbacks[name])
+
+    def to_json(self) -> Dict[str, Dict[str, str]]:
+        return {name: {str(k): v for k, v in table.items()} for name, table in self.tables.items()}
+
+
+def _merge(base: Dict[str, Dict[int, str]], extra: Dict[str, Dict[Any, str]]) -> Dict[str, Dict[int, str]]:
+    merged = {name: dict(table) for name, table in base.items()}
+    for name, table in (extra or {}).items():
+        if name not in merged:
+            continue
+        for k, v in table.items():
+            merged[name][int(k)] = str(v).strip()
+    return merged
+
+
+def load_catalog_file(path: str = CATALOG_FILE) -> Dict[str, Dict[int, str]]:
+    tables = DEFAULT_CATALOG
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                tables = _merge(DEFAULT_CATALOG, json.load(f))
+        except Exception as e:
+            log(f"⚠️ Error leyendo catálogo {path}: {e}. Usando catálogo integrado")
+    return tables
+
+
+def load_catalog_db(cursor: Any) -> Dict[str, Dict[int, str]]:
+    extra: Dict[str, Dict[int, str]] = {}
+    for name, query in CATALOG_QUERIES.items():
+        cursor.execute(query)
+        extra[name] = {int(k): v for k, v in cursor.fetchall() if k is not None and v}
+        log(f"Catálogo {name}: {len(extra[name])} entradas desde Gesden")
+    return _merge(DEFAULT_CATALOG, extra)
+
+
+_catalog: Optional[Catalog] = None
+
+
+def get_catalog(cursor: Any = None, refresh: bool = False, path: str = CATALOG_FILE) -> Catalog:
+    """Devuelve el catálogo, cargándolo solo la primera vez.
+
+    Con GESDEN_CATALOG_SOURCE=db (o refresh=True) y un cursor disponible se
+    leen las tablas de Gesden y se actualiza la caché en disco.
+    """
+    global _catalog
+    if _catalog is not None and not refresh:
+        return _catalog
+
+    if cursor is not None and (refresh or CATALOG_SOURCE == 'db'):
+        try:
+            _catalog = Catalog(load_catalog_db(cursor))
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(_catalog.to_json(), f, ensure_ascii=False, indent=2)
+            log(f"Catálogo guardado en {path}")
+            return _catalog
+        except Exception as e:
+            log(f"⚠️ No se pudo leer el catálogo de Gesden: {e}. Usando {path}")
+    _catalog = Catalog(load_catalog_file(path))
+    return _catalog
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Captura de cambios (CDC) sobre dbo.DCitas.
+
+En lugar de deducir los cambios comparando la ventana completa con el JSON
+anterior, se pregunta a la base de datos qué claves (IdCita) se insertaron,
+modificaron o borraron desde la última versión procesada, y solo se leen esas
+filas. El coste de cada ciclo crece con el número de cambios, no con la ventana.
+
+Fuentes disponibles (SYNC_CHANGE_SOURCE en sql_sync_robust.py):
+  • 'ct'         → Change Tracking de SQL Server. Requiere (una vez, como admin):
+                     ALTER DATABASE GELITE SET CHANGE_TRACKING = ON
+                       (CHANGE_RETENTION = 2 DAYS, AUTO_CLEANUP = ON);
+                     ALTER TABLE dbo.DCitas ENABLE CHANGE_TRACKING;
+  • 'rowversion' → columna rowversion en DCitas (CDC_ROWVERSION_COLUMN). No
+                   detecta borrados; estos se recogen en la lectura completa
+                   periódica.
+  • SqliteChangeSource → sustituto local con tabla de cambios alimentada por
+                   triggers, para pruebas sin SQL Server. cleanup() imita la
+                   retención de Change Tracking.
+
+Ejemplo con el sustituto SQLite:
+
+>>> import sqlite3
+>>> conn = sqlite3.connect(':memory:')
+>>> _ = conn.execute('CREATE TABLE DCitas (IdCita INTEGER PRIMARY KEY, Texto TEXT)')
+>>> source = SqliteChangeSource()
+>>> source.install(conn)
+>>> v0 = source.current_version(conn.cursor())
+>>> _ = conn.execute("INSERT INTO DCitas VALUES (1, 'Lopez, Ana'), (2, 'Ruiz, Eva')")
+>>> _ = conn.execute("UPDATE DCitas SET Texto = 'Ruiz, Eva M.' WHERE IdCita = 2")
+>>> _ = conn.execute('DELETE FROM DCitas WHERE IdCita = 1')
+>>> changes = source.changes_since(conn.cursor(), v0)
+>>> changes.upserted, changes.deleted, changes.version
+([2], [1], 4)
+"""
+
+import abc
+import datetime
+import json
+import os
+from typing import Any, List, Optional, Tuple
+
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery
+
+CDC_STATE_FILE = os.getenv('CDC_STATE_FILE', 'cdc_state.json')
+CDC_ROWVERSION_COLUMN = os.getenv('CDC_ROWVERSION_COLUMN', 'RowVer')
+# Límite de parámetros por sentencia en SQL Server: 2100
+FETCH_CHUNK = 1000
+
+
+def log(msg: str) -> None:
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+class VersionTooOld(Exception):
+    """La versión guardada ya no es válida (limpieza de Change Tracking): hace falta lectura completa."""
+
+
+class ChangeSet:
+    """Claves cambiadas desde una versión, con la operación neta de cada una."""
+
+    __slots__ = ('upserted', 'deleted', 'version')
+
+    def __init__(self, upserted: List[Any], deleted: List[Any], version: int):
+        self.upserted = upserted
+        self.deleted = deleted
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.upserted) + len(self.deleted)
+
+
+def _net_changes(changes: List[Tuple[Any, str]]) -> Tuple[List[Any], List[Any]]:
+    """Reduce una secuencia (clave, op) a la última operación de cada clave."""
+    last = {}
+    for key, op in changes:
+        last[key] = op
+    upserted = [k for k, op in last.items() if op != 'D']
+    deleted = [k for k, op in last.items() if op == 'D']
+    return upserted, deleted
+
+
+class ChangeSource(abc.ABC):
+    """Origen de cambios. Las versiones son enteros crecientes."""
+
+    name = 'base'
+
+    @abc.abstractmethod
+    def current_version(self, cursor: Any) -> int:
+        ...
+
+    @abc.abstractmethod
+    def changes_since(self, cursor: Any, version: int) -> ChangeSet:
+        """Claves cambiadas después de `version`; VersionTooOld si ya no hay historial."""
+
+    def fetch(self, cursor: Any, keys: List[Any]) -> Tuple[List[Tuple[str, Any]], List[tuple]]:
+        """Lee solo las filas indicadas, con las mismas columnas que la consulta normal (Duracion incluida).
+
+        Devuelve la descripción (columna, tipo) de AppointmentQuery.description() y las filas.
+        """
+        description: List[Tuple[str, Any]] = []
+        rows: List[tuple] = []
+        for i in range(0, len(keys), FETCH_CHUNK):
+            chunk = keys[i:i + FETCH_CHUNK]
+            query = AppointmentQuery(
+                get_catalog(cursor),
+                where=f"IdCita IN ({', '.join('?' * len(chunk))})",
+                params=chunk,
+                include_duration=True,
+            )
+            query.execute(cursor)
+            description = query.description(cursor)
+            rows.extend(query.fetchall(cursor))
+        return description, rows
+
+
+class ChangeTrackingSource(ChangeSource):
+    """SQL Server Change Tracking (CHANGETABLE)."""
+
+    name = 'ct'
+
+    def current_version(self, cursor: Any) -> int:
+        cursor.execute('SELECT CHANGE_TRACKING_CURRENT_VERSION()')
+        return int(cursor.fetchone()[0] or 0)
+
+    def changes_since(self, cursor: Any, version: int) -> ChangeSet:
+        cursor.execute("SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('dbo.DCitas'))")
+        min_valid = cursor.fetchone()[0]
+        if min_valid is None:
+            raise VersionTooOld('Change Tracking no está habilitado en dbo.DCitas')
+        if version < int(min_valid):
+            raise VersionTooOld(f'versión {version} anterior a la mínima válida {min_valid}')
+        current = self.current_version(cursor)
+        cursor.execute(
+            'SELECT CT.IdCita, CT.SYS_CHANGE_OPERATION '
+            'FROM CHANGETABLE(CHANGES dbo.DCitas, ?) AS CT '
+            'WHERE CT.SYS_CHANGE_VERSION <= ?',
+            [version, current],
+        )
+        upserted, deleted = _net_changes([(k, op) for k, op in cursor.fetchall()])
+        return ChangeSet(upserted, deleted, current)
+
+
+class RowVersionSource(ChangeSource):
+    """Columna rowversion en dbo.DCitas (sin detección de borrados)."""
+
+    name = 'rowversion'
+
+    def __init__(self, column: str = CDC_ROWVERSION_COLUMN):
+        self.column = column
+
+    def current_version(self, cursor: Any) -> int:
+        # Todo lo anterior a MIN_ACTIVE_ROWVERSION está confirmado
+        cursor.execute('SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT) - 1')
+        return int(cursor.fetchone()[0])
+
+    def changes_since(self, cursor: Any, version: int) -> ChangeSet:
+        current = self.current_version(cursor)
+        cursor.execute(
+            f'SELECT IdCita FROM dbo.DCitas '
+            f'WHERE {self.column} > CAST(CAST(? AS BIGINT) AS BINARY(8)) '
+            f'AND {self.column} <= CAST(CAST(? AS BIGINT) AS BINARY(8))',
+            [version, current],
+        )
+        return ChangeSet([r[0] for r in cursor.fetchall()], [], current)
+
+
+class SqliteChangeSource(ChangeSource):
+    """Sustituto local: tabla DCitas_changes alimentada por triggers en SQLite."""
+
+    name = 'sqlite'
+
+    RAW_SELECT = (
+        'SELECT IdCita AS Registro, HorSitCita AS CitMod, FecAlta AS FechaAlta, NUMPAC AS NumPac, '
+        'Texto, Movil AS TelMovil, Fecha, Hora, IdSitC, IdIcono, IdUsu, NOTAS AS Notas, Duracion '
+        'FROM DCitas'
+    )
+
+    def install(self, conn: Any) -> None:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS DCitas_changes (
+                version INTEGER PRIMARY KEY AUTOINCREMENT,
+                IdCita INTEGER NOT NULL,
+                op TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS DCitas_changes_min_valid (version INTEGER NOT NULL);
+            CREATE TRIGGER IF NOT EXISTS DCitas_ct_ins AFTER INSERT ON DCitas BEGIN
+                INSERT INTO DCitas_changes (IdCita, op) VALUES (NEW.IdCita, 'I');
+            END;
+            CREATE TRIGGER IF NOT EXISTS DCitas_ct_upd AFTER UPDATE ON DCitas BEGIN
+                INSERT INTO DCitas_changes (IdCita, op)
+                    SELECT OLD.IdCita, 'D' WHERE OLD.IdCita <> NEW.IdCita;
+                INSERT INTO DCitas_changes (IdCita, op) VALUES (NEW.IdCita, 'U');
+            END;
+            CREATE TRIGGER IF NOT EXISTS DCitas_ct_del AFTER DELETE ON DCitas BEGIN
+                INSERT INTO DCitas_changes (IdCita, op) VALUES (OLD.IdCita, 'D');
+            END;
+        ''')
+
+    def current_version(self, cursor: Any) -> int:
+        # sqlite_sequence conserva la última versión aunque cleanup() haya vaciado la tabla
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'DCitas_changes'")
+        return int(cursor.fetchone()[0])
+
+    def min_valid_version(self, cursor: Any) -> int:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM DCitas_changes_min_valid')
+        return int(cursor.fetchone()[0])
+
+    def cleanup(self, conn: Any, version: int) -> None:
+        """Descarta los cambios hasta `version` incluida (como AUTO_CLEANUP de Change Tracking)."""
+        with conn:
+            conn.execute('DELETE FROM DCitas_changes WHERE version <= ?', [version])
+            conn.execute('DELETE FROM DCitas_changes_min_valid')
+            conn.execute('INSERT INTO DCitas_changes_min_valid (version) VALUES (?)', [version])
+
+    def changes_since(self, cursor: Any, version: int) -> ChangeSet:
+        min_valid = self.min_valid_version(cursor)
+        if version < min_valid:
+            raise VersionTooOld(f'versión {version} anterior a la mínima válida {min_valid}')
+        current = self.current_version(cursor)
+        cursor.execute(
+            'SELECT IdCita, op FROM DCitas_changes WHERE version > ? AND version <= ? ORDER BY version',
+            [version, current],
+        )
+        upserted, deleted = _net_changes(cursor.fetchall())
+        return ChangeSet(upserted, deleted, current)
+
+    def fetch(self, cursor: Any, keys: List[Any]) -> Tuple[List[Tuple[str, Any]], List[tuple]]:
+        query = AppointmentQuery(get_catalog(), include_duration=True, raw=True)
+        # SQLite no declara tipos en cursor.description: columnas sin tipo (conversión genérica)
+        description: List[Tuple[str, Any]] = [(c, None) for c in query.columns]
+        rows: List[tuple] = []
+        for i in range(0, len(keys), FETCH_CHUNK):
+            chunk = keys[i:i + FETCH_CHUNK]
+            cursor.execute(f"{self.RAW_SELECT} WHERE IdCita IN ({', '.join('?' * len(chunk))})", chunk)
+            rows.extend(query.convert(cursor.fetchall()))
+        return description, rows
+
+
+CHANGE_SOURCES = {cls.name: cls for cls in (ChangeTrackingSource, RowVersionSource, SqliteChangeSource)}
+
+
+class CdcPoller:
+    """Guarda la última versión procesada y devuelve solo las filas cambiadas."""
+
+    def __init__(self, source: ChangeSource, state_file: str = CDC_STATE_FILE):
+        self.source = source
+        self.state_file = state_file
+
+    def load_version(self) -> Optional[int]:
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if state.get('source') == self.source.name:
+                    return int(state['version'])
+        except Exception as e:
+            log(f"⚠️ Error cargando estado CDC: {e}")
+        return None
+
+    def save_version(self, version: int) -> None:
+        with open(self.state_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'source': self.source.name,
+                'version': version,
+                'updated_at': datetime.datetime.now().isoformat(),
+            }, f, ensure_ascii=False, indent=2)
+
+    def begin_full_sync(self, conn: Any) -> int:
+        """Versión a guardar tras una lectura completa. Se toma ANTES de leer para no perder cambios."""
+        cursor = conn.cursor()
+        try:
+            return self.source.current_version(cursor)
+        finally:
+            cursor.close()
+
+    def poll(self, conn: Any) -> Optional[Tuple[List[Tuple[str, Any]], List[tuple], List[Any], int]]:
+        """Devuelve (descripción, filas cambiadas, claves borradas, versión) o None si hace falta lectura completa.
+
+        La versión devuelta se debe guardar con save_version() cuando los
+        cambios se hayan aplicado.
+        """
+        version = self.load_version()
+        if version is None:
+            return None
+        cursor = conn.cursor()
+        try:
+            try:
+                changes = self.source.changes_since(cursor, version)
+            except VersionTooOld as e:
+                log(f"⚠️ CDC: {e}. Se requiere lectura completa")
+                return None
+            log(f"CDC ({self.source.name}): {len(changes.upserted)} cambiadas, "
+                f"{len(changes.deleted)} borradas (versión {version} → {changes.version})")
+            description, rows = self.source.fetch(cursor, changes.upserted) if changes.upserted else ([], [])
+            return description, rows, changes.deleted, changes.version
+        finally:
+            cursor.close()
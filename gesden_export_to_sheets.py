@@ -7,6 +7,11 @@ import pyodbc
 import gspread
 from google.oauth2.service_account import Credentials
 
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery
+from gesden_rows import RowConverter
+from gesden_sheets import QuotaWorksheet, quota_worksheet, sync_worksheet
+
 # --- Configuración (por variables de entorno con valores por defecto) ---
 DB_SERVER = os.getenv('DB_SERVER', 'GABINETE2\\INFOMED')
 DB_DATABASE = os.getenv('DB_DATABASE', 'GELITE')
@@ -16,61 +21,15 @@ GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID', '1MBDBHQ08XGuf5LxVHCFhHDagIazFkpB
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE', 'service-account-key.json')
 TARGET_WORKSHEET = os.getenv('TARGET_WORKSHEET', 'Hoja1')
 
-# Columnas esperadas en Google Sheets (A:O)
+# Columnas esperadas en Google Sheets (A:P)
 HEADERS = [
     'Registro', 'CitMod', 'FechaAlta', 'NumPac', 'Apellidos', 'Nombre', 'TelMovil',
     'Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas', 'Duracion',
-    'InsertedAt'
+    'InsertedAt', 'UpdatedAt'
 ]
 
-QUERY = """
-    SELECT TOP 250
-        IdCita AS Registro,
-        HorSitCita AS CitMod,
-        FecAlta AS FechaAlta,
-        NUMPAC AS NumPac,
-        CASE
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1)))
-            ELSE NULL
-        END AS Apellidos,
-        CASE
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto))))
-            ELSE Texto
-        END AS Nombre,
-        Movil AS TelMovil,
-        CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-        CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-        CASE
-            WHEN IdSitC = 0 THEN 'Planificada'
-            WHEN IdSitC = 1 THEN 'Anulada'
-            WHEN IdSitC = 5 THEN 'Finalizada'
-            WHEN IdSitC = 7 THEN 'Confirmada'
-            WHEN IdSitC = 8 THEN 'Cancelada'
-            ELSE 'Desconocido'
-        END AS EstadoCita,
-        CASE
-            WHEN IdIcono = 1 THEN 'Revision'
-            WHEN IdIcono = 2 THEN 'Urgencia'
-            WHEN IdIcono = 9 THEN 'Periodoncia'
-            WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-            WHEN IdIcono = 11 THEN 'Ortodoncia'
-            WHEN IdIcono = 13 THEN 'Primera'
-            WHEN IdIcono = 14 THEN 'Higiene dental'
-            ELSE 'Otros'
-        END AS Tratamiento,
-        CASE
-            WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-            WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-            WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-            WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-            WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-            ELSE 'Odontologo'
-        END AS Odontologo,
-        CONVERT(NVARCHAR(MAX), NOTAS) AS Notas,
-        CAST(CAST(Duracion AS DECIMAL(10, 2)) / 60 AS INT) AS Duracion
-    FROM dbo.DCitas
-    ORDER BY HorSitCita DESC;
-"""
+# Últimas citas modificadas que se reflejan en la hoja
+TOP_RECORDS = 250
 
 
 def log(msg: str) -> None:
@@ -90,33 +49,17 @@ def connect_db() -> Tuple[pyodbc.Connection, pyodbc.Cursor]:
 
 def fetch_rows(cursor: pyodbc.Cursor) -> Tuple[List[Dict[str, Any]], List[str]]:
     log("Ejecutando consulta SQL...")
-    cursor.execute(QUERY)
-    rows = cursor.fetchall()
-    columns = [col[0] for col in cursor.description]
+    query = AppointmentQuery(get_catalog(cursor), top=TOP_RECORDS, include_duration=True)
+    columns = query.execute(cursor)
+    rows = query.fetchall(cursor)
     log(f"Consulta ejecutada. Registros: {len(rows)}")
 
-    result: List[Dict[str, Any]] = []
-    for row in rows:
-        data = {k: v for k, v in zip(columns, row)}
-        norm: Dict[str, str] = {}
-        for key, value in data.items():
-            if isinstance(value, (bytes, bytearray)):
-                norm[key] = value.decode('utf-8', errors='ignore')
-            elif isinstance(value, (datetime.date, datetime.datetime)):
-                # Normalizamos a ISO para comparaciones y escritura
-                if isinstance(value, datetime.datetime):
-                    norm[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    norm[key] = value.strftime('%Y-%m-%d')
-            elif value is None:
-                norm[key] = ''
-            else:
-                norm[key] = str(value)
-        result.append(norm)
+    # Normalizamos a texto (fechas ISO) para comparaciones y escritura
+    result = RowConverter(query.description(cursor), as_text=True).to_dicts(rows)
     return result, columns
 
 
-def authorize_sheets() -> gspread.Worksheet:
+def authorize_sheets() -> QuotaWorksheet:
     log("Autenticando con Google Sheets (Service Account)...")
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
@@ -132,10 +75,11 @@ def authorize_sheets() -> gspread.Worksheet:
         log(f"Hoja '{TARGET_WORKSHEET}' no encontrada. Creando...")
         ws = ss.add_worksheet(title=TARGET_WORKSHEET, rows=1000, cols=20)
     # Asegurar cabeceras
-    values = ws.get_all_values()
-    if not values or (values and (len(values[0]) == 0 or values[0][0].strip() != 'Registro')):
+    ws = quota_worksheet(ws)
+    header = ws.row_values(1)
+    if [h.strip() for h in header[:len(HEADERS)]] != HEADERS:
         log("Escribiendo cabeceras en fila 1")
-        ws.update('A1:O1', [HEADERS])
+        ws.update('A1:P1', [HEADERS])
     return ws
 
 
@@ -155,72 +99,13 @@ def row_from_record(d: Dict[str, str]) -> List[str]:
         d.get('Odontologo', ''),
         d.get('Notas', ''),
         d.get('Duracion', ''),
-        datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # InsertedAt
+        '',  # UpdatedAt: solo cuando la cita cambia
     ]
 
 
-def build_index(ws: gspread.Worksheet) -> Dict[str, int]:
-    values = ws.get_all_values()
-    index: Dict[str, int] = {}
-    for i, row in enumerate(values, start=1):
-        if i == 1:
-            continue  # header
-        if not row:
-            continue
-        key = (row[0] if len(row) > 0 else '').strip()
-        if key:
-            index[key] = i
-    return index
-
-
 def upsert_records(ws: gspread.Worksheet, records: List[Dict[str, str]]) -> None:
-    existing_index = build_index(ws)
-    registros_actuales_sql = set()
-
-    updates: List[Tuple[str, List[List[str]]]] = []  # (range, values)
-    appends: List[List[str]] = []
-
-    for d in records:
-        registro = d.get('Registro', '').strip()
-        if not registro:
-            continue
-        registros_actuales_sql.add(registro)
-
-        citmod = d.get('CitMod', '')
-        fecha_alta = d.get('FechaAlta', '')
-        is_new = citmod == fecha_alta
-
-        new_row = row_from_record(d)
-
-        if registro in existing_index:
-            row_number = existing_index[registro]
-            rng = f"A{row_number}:O{row_number}"
-            updates.append((rng, [new_row]))
-            log(f"Programado UPDATE ({'NUEVA' if is_new else 'MOD'}): Registro {registro} -> fila {row_number}")
-        else:
-            appends.append(new_row)
-            log(f"Programado APPEND ({'NUEVA' if is_new else 'MOD'}): Registro {registro}")
-
-    # Ejecutar updates en lotes
-    if updates:
-        log(f"Ejecutando {len(updates)} updates en lotes...")
-        ws.batch_update([{ 'range': r, 'values': v } for r, v in updates])
-
-    # Ejecutar appends
-    for row in appends:
-        ws.append_row(row, value_input_option='RAW')
-    if appends:
-        log(f"Ejecutados {len(appends)} appends")
-
-    # Borrado de citas que ya no aparecen
-    existing_index_after = build_index(ws)
-    registros_sheet = set(existing_index_after.keys())
-    to_delete = sorted([existing_index_after[r] for r in registros_sheet - registros_actuales_sql], reverse=True)
-
-    if to_delete:
-        log(f"Eliminando {len(to_delete)} filas que ya no existen en SQL...")
-        for row_num in to_delete:
-            ws.delete_rows(row_num)
+    sync_worksheet(ws, records, row_from_record)
 
 
 def main() -> int:
@@ -242,7 +127,7 @@ def main() -> int:
         log(f"ERROR BD: {ex}")
         return 1
     except gspread.exceptions.APIError as ex:
-        log(f"ERROR Google Sheets API: {ex}")
+        log(f"ERROR Google Sheets API (tras reintentos): {ex}")
         return 2
     except Exception as ex:
         log(f"ERROR no controlado: {ex}")
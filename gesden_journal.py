@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Diario de cambios de citas (append-only, JSONL por segmentos).
+
+Cada sincronización añade sus eventos (nueva, actualizada, borrada, fuera de
+ventana) con un número de secuencia creciente. Los consumidores (backend,
+Sheets, notificador de WhatsApp...) leen desde su último desplazamiento
+confirmado y procesan solo los cambios, cada uno a su ritmo, sin cargar ni
+comparar la instantánea completa.
+
+Ficheros en JOURNAL_DIR:
+  • journal-<primera secuencia>.jsonl  segmentos; se rota al superar JOURNAL_SEGMENT_BYTES
+  • offsets/<consumidor>.json          última secuencia procesada por cada consumidor
+
+>>> import tempfile
+>>> directory = tempfile.mkdtemp()
+>>> journal = ChangeJournal(directory, segment_bytes=200)
+>>> journal.append([{'type': 'new', 'Registro': n} for n in range(1, 6)])
+5
+>>> len(journal.segments()) > 1
+True
+>>> reader = JournalReader(directory, 'backend')
+>>> [e['seq'] for e in reader.read(limit=2)]
+[1, 2]
+>>> reader.commit(2)
+>>> [e['Registro'] for e in JournalReader(directory, 'backend').read()]
+[3, 4, 5]
+"""
+
+import bisect
+import datetime
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from gesden_record import json_default
+from gesden_snapshot import write_json_atomic
+
+JOURNAL_DIR = os.getenv('SYNC_JOURNAL_DIR', 'sync_journal')
+JOURNAL_SEGMENT_BYTES = int(os.getenv('SYNC_JOURNAL_SEGMENT_BYTES', str(8 * 1024 * 1024)))
+
+EVENT_TYPES = ('new', 'updated', 'deleted', 'out_of_window')
+
+_SEGMENT_RE = re.compile(r'^journal-(\d{20})\.jsonl$')
+
+
+def _segment_name(first_seq: int) -> str:
+    return f"journal-{first_seq:020d}.jsonl"
+
+
+def list_segments(directory: str) -> List[int]:
+    """Primera secuencia de cada segmento, en orden."""
+    if not os.path.isdir(directory):
+        return []
+    firsts = []
+    for name in os.listdir(directory):
+        match = _SEGMENT_RE.match(name)
+        if match:
+            firsts.append(int(match.group(1)))
+    return sorted(firsts)
+
+
+def _last_seq(path: str) -> Optional[int]:
+    """Secuencia de la última línea completa de un segmento (lee solo el final)."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        block = 4096
+        while True:
+            start = max(0, end - block)
+            f.seek(start)
+            tail = f.read(end - start)
+            lines = [line for line in tail.split(b'\n') if line.strip()]
+            # La primera línea del bloque puede estar cortada salvo que empiece el fichero
+            complete = lines if start == 0 else lines[1:]
+            for line in reversed(complete):
+                try:
+                    return int(json.loads(line)['seq'])
+                except (ValueError, KeyError):
+                    continue  # Línea a medio escribir (corte de luz): se ignora
+            if start == 0:
+                return None
+            block *= 2
+
+
+def _repair_tail(path: str) -> None:
+    """Recorta una última línea a medio escribir para que el siguiente append no la corrompa."""
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        pos = size
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b'\n')
+            if newline >= 0:
+                f.truncate(pos - step + newline + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+class ChangeJournal:
+    """Escritor del diario. Un solo proceso escritor a la vez."""
+
+    def __init__(self, directory: str = JOURNAL_DIR, segment_bytes: int = JOURNAL_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.last_seq = 0
+        segments = list_segments(directory)
+        if segments:
+            _repair_tail(os.path.join(directory, _segment_name(segments[-1])))
+        for first in reversed(segments):
+            last = _last_seq(os.path.join(directory, _segment_name(first)))
+            if last is not None:
+                self.last_seq = last
+                break
+
+    def segments(self) -> List[int]:
+        return list_segments(self.directory)
+
+    def _current_segment(self) -> str:
+        segments = self.segments()
+        if segments:
+            path = os.path.join(self.directory, _segment_name(segments[-1]))
+            if os.path.getsize(path) < self.segment_bytes:
+                return path
+        return os.path.join(self.directory, _segment_name(self.last_seq + 1))
+
+    def append(self, events: Iterable[Dict[str, Any]]) -> int:
+        """Añade los eventos con secuencias consecutivas; fsync una vez por lote. Devuelve cuántos."""
+        timestamp = datetime.datetime.now().isoformat()
+        count = 0
+        f = None
+        try:
+            for event in events:
+                if f is None or f.tell() >= self.segment_bytes:
+                    if f is not None:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                    f = open(self._current_segment(), 'ab')
+                self.last_seq += 1
+                line = json.dumps({'seq': self.last_seq, 'ts': timestamp, **event},
+                                  ensure_ascii=False, separators=(',', ':'), default=json_default)
+                f.write(line.encode('utf-8') + b'\n')
+                count += 1
+        finally:
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        return count
+
+    def prune(self) -> int:
+        """Borra los segmentos ya procesados por todos los consumidores. Devuelve cuántos."""
+        offsets = load_offsets(self.directory)
+        if not offsets:
+            return 0
+        low = min(offsets.values())
+        segments = self.segments()
+        removed = 0
+        # Un segmento termina justo antes de que empiece el siguiente; el último nunca se borra
+        for first, next_first in zip(segments, segments[1:]):
+            if next_first - 1 <= low:
+                os.remove(os.path.join(self.directory, _segment_name(first)))
+                removed += 1
+        return removed
+
+
+def _offsets_dir(directory: str) -> str:
+    return os.path.join(directory, 'offsets')
+
+
+def load_offsets(directory: str = JOURNAL_DIR) -> Dict[str, int]:
+    """Desplazamiento confirmado de cada consumidor."""
+    path = _offsets_dir(directory)
+    offsets: Dict[str, int] = {}
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.endswith('.json'):
+                with open(os.path.join(path, name), 'r', encoding='utf-8') as f:
+                    offsets[name[:-5]] = int(json.load(f)['seq'])
+    return offsets
+
+
+class JournalReader:
+    """Lectura del diario para un consumidor, desde su último desplazamiento confirmado."""
+
+    def __init__(self, directory: str = JOURNAL_DIR, consumer: str = 'default'):
+        if not re.match(r'^[\w.-]+$', consumer):
+            raise ValueError(f"Nombre de consumidor no válido: {consumer}")
+        self.directory = directory
+        self.consumer = consumer
+
+    @property
+    def offset_file(self) -> str:
+        return os.path.join(_offsets_dir(self.directory), f"{self.consumer}.json")
+
+    def offset(self) -> int:
+        try:
+            with open(self.offset_file, 'r', encoding='utf-8') as f:
+                return int(json.load(f)['seq'])
+        except FileNotFoundError:
+            return 0
+
+    def commit(self, seq: int) -> None:
+        """Confirma que se han procesado los eventos hasta `seq` (incluido)."""
+        os.makedirs(_offsets_dir(self.directory), exist_ok=True)
+        write_json_atomic(self.offset_file, {
+            'seq': seq,
+            'updated_at': datetime.datetime.now().isoformat(),
+        })
+
+    def read(self, after: Optional[int] = None, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Eventos con secuencia mayor que `after` (por defecto, el desplazamiento confirmado)."""
+        after = self.offset() if after is None else after
+        segments = list_segments(self.directory)
+        if not segments:
+            return
+        if after + 1 < segments[0]:
+            raise LookupError(f"Eventos desde {after + 1} ya eliminados (el diario empieza en {segments[0]}); "
+                              f"hace falta recargar la instantánea completa")
+        start = max(0, bisect.bisect_right(segments, after + 1) - 1)
+        returned = 0
+        for first in segments[start:]:
+            with open(os.path.join(self.directory, _segment_name(first)), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        return  # Última línea aún en escritura
+                    event = json.loads(line)
+                    if event['seq'] <= after:
+                        continue
+                    yield event
+                    returned += 1
+                    if limit is not None and returned >= limit:
+                        return
+
+
+def appointment_events(new: Iterable[Any], updated: Iterable[Any],
+                       tombstones: Iterable[Dict[str, Any]] = ()) -> Iterator[Dict[str, Any]]:
+    """Eventos del diario a partir del resultado de una sincronización."""
+    for appointment in new:
+        yield {'type': 'new', 'Registro': appointment['Registro'], 'data': appointment}
+    for appointment in updated:
+        yield {'type': 'updated', 'Registro': appointment['Registro'], 'data': appointment}
+    for tombstone in tombstones:
+        yield {'type': tombstone['reason'], 'Registro': tombstone['Registro'], 'CitMod': tombstone.get('CitMod', '')}
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Construcción de las consultas sobre dbo.DCitas (Gesden): filtros de fecha y la
+consulta de citas compartida por todos los scripts (AppointmentQuery).
+
+Gesden guarda la fecha de la cita en `Fecha` como número de día
+(DATEADD(DAY, Fecha - 2, '1900-01-01')) y la hora en `Hora` como segundos
+desde medianoche (DATEADD(SECOND, Hora, 0)). Filtrar sobre la columna
+convertida obliga a SQL Server a recorrer toda la tabla, así que aquí se
+convierten los límites a enteros en Python y los predicados se escriben sobre
+las columnas en crudo, de forma que puedan usar un índice sobre Fecha.
+
+Ejemplos (se pueden comprobar con `python -m doctest gesden_query.py -v`):
+
+>>> date_to_fecha('2025-01-01')
+45658
+>>> fecha_to_date(45658).isoformat()
+'2025-01-01'
+>>> sql, params = date_range_filter('2025-01-01', '2025-12-31')
+>>> sql
+'Fecha >= ? AND Fecha <= ?'
+>>> params
+[45658, 46022]
+>>> rolling_window_filter(90, 365, today=datetime.date(2025, 6, 1))
+('Fecha >= ? AND Fecha <= ?', [45719, 46174])
+
+Equivalencia con las expresiones anteriores, evaluadas sobre los números de
+día en torno a los bordes de la ventana. `selects` evalúa el predicado nuevo
+sobre un valor de Fecha:
+
+>>> import operator
+>>> def selects(sql, params, fecha):
+...     ops = {'>=': operator.ge, '<=': operator.le}
+...     return all(ops[p.split()[1]](fecha, v) for p, v in zip(sql.split(' AND '), params))
+
+El export filtraba por texto:
+CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) BETWEEN ? AND ?.
+El filtro nuevo selecciona las mismas filas, también en fin de año y el 29 de febrero:
+
+>>> def old_export(fecha, date_from, date_to):
+...     text = (datetime.date(1900, 1, 1) + datetime.timedelta(days=fecha - 2)).isoformat()
+...     return date_from <= text <= date_to
+>>> for date_from, date_to in [('2025-01-01', '2025-12-31'), ('2024-02-29', '2024-03-01')]:
+...     sql, params = date_range_filter(date_from, date_to)
+...     candidates = range(params[0] - 5, params[1] + 6)
+...     new = [f for f in candidates if selects(sql, params, f)]
+...     assert new == [f for f in candidates if old_export(f, date_from, date_to)], date_from
+
+La ventana móvil comparaba el entero Fecha con GETDATE() ± N:
+Fecha >= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) - N, 0).
+SQL Server convierte el entero a datetime contando días desde 1900-01-01, no
+con el desplazamiento de 2 días de la columna. Por eso la ventana anterior
+quedaba dos días antes de lo que ve el usuario. La nueva está centrada en hoy:
+
+>>> today = datetime.date(2025, 6, 1)
+>>> def old_window(fecha, back, forward):
+...     as_datetime = datetime.date(1900, 1, 1) + datetime.timedelta(days=fecha)
+...     return today - datetime.timedelta(days=back) <= as_datetime <= today + datetime.timedelta(days=forward)
+>>> sql, params = rolling_window_filter(90, 365, today=today)
+>>> candidates = range(params[0] - 5, params[1] + 6)
+>>> new = [f for f in candidates if selects(sql, params, f)]
+>>> old = [f for f in candidates if old_window(f, 90, 365)]
+>>> [f - 2 for f in new] == old
+True
+>>> fecha_to_date(new[0]), fecha_to_date(new[-1])
+(datetime.date(2025, 3, 3), datetime.date(2026, 6, 1))
+>>> fecha_to_date(old[0]), fecha_to_date(old[-1])
+(datetime.date(2025, 3, 1), datetime.date(2026, 5, 30))
+"""
+
+import datetime
+import os
+import sys
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from gesden_catalog import SOURCE_COLUMNS
+
+# Día 0 de la columna Fecha: DATEADD(DAY, 0 - 2, '1900-01-01') = 1899-12-30
+FECHA_EPOCH = datetime.date(1899, 12, 30)
+
+DateLike = Union[str, datetime.date]
+TimeLike = Union[str, datetime.time]
+
+
+def parse_date(value: DateLike) -> datetime.date:
+    """Acepta 'YYYY-MM-DD', date o datetime y devuelve un date."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value.strip())
+
+
+def date_to_fecha(value: DateLike) -> int:
+    """Convierte una fecha al entero que Gesden guarda en DCitas.Fecha.
+
+    >>> date_to_fecha(datetime.date(1900, 1, 1))
+    2
+    """
+    return (parse_date(value) - FECHA_EPOCH).days
+
+
+def fecha_to_date(serial: int) -> datetime.date:
+    """Inversa de date_to_fecha: equivale a DATEADD(DAY, Fecha - 2, '1900-01-01')."""
+    return FECHA_EPOCH + datetime.timedelta(days=int(serial))
+
+
+def time_to_hora(value: TimeLike) -> int:
+    """Convierte 'HH:MM[:SS]' o time a segundos desde medianoche (DCitas.Hora).
+
+    >>> time_to_hora('09:30')
+    34200
+    """
+    if isinstance(value, str):
+        value = datetime.time.fromisoformat(value.strip())
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def hora_to_str(seconds: int) -> str:
+    """Equivale a CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108).
+
+    >>> hora_to_str(34200)
+    '09:30'
+    """
+    seconds = int(seconds) % 86400
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
+
+
+def date_range_filter(
+    date_from: Optional[DateLike] = None,
+    date_to: Optional[DateLike] = None,
+    time_from: Optional[TimeLike] = None,
+    time_to: Optional[TimeLike] = None,
+) -> Tuple[str, List[int]]:
+    """Predicado sargable sobre Fecha (y opcionalmente Hora), límites inclusivos.
+
+    Devuelve ('', []) si no hay ningún límite.
+
+    >>> date_range_filter(date_from='2025-03-01', time_from='08:00')
+    ('Fecha >= ? AND Hora >= ?', [45717, 28800])
+    >>> date_range_filter()
+    ('', [])
+    """
+    filters: List[str] = []
+    params: List[int] = []
+    if date_from:
+        filters.append('Fecha >= ?')
+        params.append(date_to_fecha(date_from))
+    if date_to:
+        filters.append('Fecha <= ?')
+        params.append(date_to_fecha(date_to))
+    if time_from:
+        filters.append('Hora >= ?')
+        params.append(time_to_hora(time_from))
+    if time_to:
+        filters.append('Hora <= ?')
+        params.append(time_to_hora(time_to))
+    return ' AND '.join(filters), params
+
+
+def rolling_window_filter(
+    days_back: Optional[int],
+    days_forward: Optional[int] = None,
+    today: Optional[datetime.date] = None,
+) -> Tuple[str, List[int]]:
+    """Ventana móvil [hoy - days_back, hoy + days_forward] sobre Fecha.
+
+    Sustituye a `Fecha >= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) - N, 0)`,
+    que convierte la columna entera a datetime en cada fila.
+    """
+    today = today or datetime.date.today()
+    date_from = today - datetime.timedelta(days=days_back) if days_back is not None else None
+    date_to = today + datetime.timedelta(days=days_forward) if days_forward is not None else None
+    return date_range_filter(date_from, date_to)
+
+
+def split_range(lo: int, hi: int, parts: int) -> List[Tuple[int, int]]:
+    """Divide [lo, hi] (inclusivo) en como mucho `parts` tramos contiguos.
+
+    >>> split_range(1, 10, 3)
+    [(1, 4), (5, 8), (9, 10)]
+    >>> split_range(5, 5, 4)
+    [(5, 5)]
+    """
+    size = max(1, -(-(hi - lo + 1) // max(1, parts)))
+    return [(start, min(start + size - 1, hi)) for start in range(lo, hi + 1, size)]
+
+
+def where_clause(*predicates: str) -> str:
+    """Une predicados no vacíos en una cláusula WHERE (o '' si no hay ninguno).
+
+    >>> where_clause('Fecha >= ?', '', 'IdUsu = ?')
+    'WHERE Fecha >= ? AND IdUsu = ?'
+    """
+    parts = [p for p in predicates if p]
+    return 'WHERE ' + ' AND '.join(parts) if parts else ''
+
+
+# --- Consulta de citas (dbo.DCitas) ---
+
+# Columnas que devuelven todas las variantes de la consulta, en este orden
+APPOINTMENT_COLUMNS: List[str] = [
+    'Registro', 'CitMod', 'FechaAlta', 'NumPac', 'Apellidos', 'Nombre', 'TelMovil',
+    'Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas',
+]
+
+RAW_FETCH = os.getenv('GESDEN_RAW_FETCH', '1') != '0'
+
+
+def _sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _case_ladder(column: str, table: Dict[int, str], fallback: str, alias: str) -> str:
+    whens = '\n'.join(f"        WHEN {column} = {k} THEN {_sql_literal(v)}" for k, v in sorted(table.items()))
+    return f"CASE\n{whens}\n        ELSE {_sql_literal(fallback)}\n    END AS {alias}"
+
+
+def split_name(texto: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Equivale al CHARINDEX/LEFT/SUBSTRING sobre Texto: 'Apellidos, Nombre'.
+
+    >>> split_name(' Garcia Lopez ,  Ana ')
+    ('Garcia Lopez', 'Ana')
+    >>> split_name('Ana')
+    (None, 'Ana')
+    """
+    if texto is None:
+        return None, None
+    pos = texto.find(',')
+    if pos < 0:
+        return None, texto
+    return texto[:pos].strip(' '), texto[pos + 1:].strip(' ')
+
+
+class AppointmentQuery:
+    """Consulta de citas sobre dbo.DCitas en dos modos.
+
+    • raw=True: solo columnas en crudo (enteros y texto); la traducción de
+      estados/tratamientos/odontólogos, nombre y fecha/hora se hace en Python
+      con el catálogo (gesden_catalog.py).
+    • raw=False: la traducción la hace SQL Server con escaleras CASE generadas
+      desde el mismo catálogo (comportamiento histórico).
+
+    En ambos casos `columns` y las filas de `convert()` son las mismas.
+    """
+
+    def __init__(
+        self,
+        catalog: Any,
+        top: Optional[int] = None,
+        where: str = '',
+        params: Optional[List[Any]] = None,
+        order_by: str = 'HorSitCita DESC',
+        include_duration: bool = False,
+        raw: Optional[bool] = None,
+    ):
+        self.catalog = catalog
+        self.top = top
+        self.where = where
+        self.params = list(params or [])
+        self.order_by = order_by
+        self.include_duration = include_duration
+        self.raw = RAW_FETCH if raw is None else raw
+        self.columns = APPOINTMENT_COLUMNS + (['Duracion'] if include_duration else [])
+        self._fecha_cache: Dict[Any, Optional[str]] = {None: None}
+        self._hora_cache: Dict[Any, Optional[str]] = {None: None}
+
+    @property
+    def sql(self) -> str:
+        select = f"SELECT TOP {int(self.top)}" if self.top else "SELECT"
+        if self.raw:
+            fields = [
+                'IdCita AS Registro', 'HorSitCita AS CitMod', 'FecAlta AS FechaAlta', 'NUMPAC AS NumPac',
+                'Texto', 'Movil AS TelMovil', 'Fecha', 'Hora', 'IdSitC', 'IdIcono', 'IdUsu',
+                'CONVERT(NVARCHAR(MAX), NOTAS) AS Notas',
+            ]
+            if self.include_duration:
+                fields.append('Duracion')
+        else:
+            fields = [
+                'IdCita AS Registro', 'HorSitCita AS CitMod', 'FecAlta AS FechaAlta', 'NUMPAC AS NumPac',
+                "CASE WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1))) ELSE NULL END AS Apellidos",
+                "CASE WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto)))) ELSE Texto END AS Nombre",
+                'Movil AS TelMovil',
+                "CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha",
+                'CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora',
+            ]
+            for name, column in SOURCE_COLUMNS.items():
+                fields.append(_case_ladder(column, self.catalog.tables[name], self.catalog.fallbacks[name], name))
+            fields.append('CONVERT(NVARCHAR(MAX), NOTAS) AS Notas')
+            if self.include_duration:
+                fields.append('CAST(CAST(Duracion AS DECIMAL(10, 2)) / 60 AS INT) AS Duracion')
+        parts = [select, '    ' + ',\n    '.join(fields), 'FROM dbo.DCitas']
+        where = where_clause(self.where)
+        if where:
+            parts.append(where)
+        if self.order_by:
+            parts.append(f"ORDER BY {self.order_by}")
+        return '\n'.join(parts)
+
+    def _fecha(self, serial: Any) -> Optional[str]:
+        cache = self._fecha_cache
+        value = cache.get(serial)
+        if value is None and serial is not None:
+            value = cache[serial] = sys.intern(fecha_to_date(serial).isoformat())
+        return value
+
+    def _hora(self, seconds: Any) -> Optional[str]:
+        cache = self._hora_cache
+        value = cache.get(seconds)
+        if value is None and seconds is not None:
+            value = cache[seconds] = sys.intern(hora_to_str(seconds))
+        return value
+
+    def convert(self, rows: List[Any]) -> List[tuple]:
+        """Devuelve las filas como tuplas en el orden de `columns`."""
+        if not self.raw:
+            return [tuple(r) for r in rows]
+        estados = self.catalog.tables['EstadoCita']
+        tratamientos = self.catalog.tables['Tratamiento']
+        odontologos = self.catalog.tables['Odontologo']
+        fb_estado = self.catalog.fallbacks['EstadoCita']
+        fb_tratamiento = self.catalog.fallbacks['Tratamiento']
+        fb_odontologo = self.catalog.fallbacks['Odontologo']
+        fecha = self._fecha
+        hora = self._hora
+        with_duration = self.include_duration
+        out: List[tuple] = []
+        for r in rows:
+            apellidos, nombre = split_name(r[4])
+            row = (
+                r[0], r[1], r[2], r[3], apellidos, nombre, r[5],
+                fecha(r[6]), hora(r[7]),
+                estados.get(r[8], fb_estado),
+                tratamientos.get(r[9], fb_tratamiento),
+                odontologos.get(r[10], fb_odontologo),
+                r[11],
+            )
+            if with_duration:
+                row += (None if r[12] is None else int(r[12] / 60),)
+            out.append(row)
+        return out
+
+    # Columna cruda de la que sale cada columna de salida en modo raw (None: se calcula en Python)
+    _RAW_SOURCE = (0, 1, 2, 3, None, None, 5, None, None, None, None, None, 11)
+
+    def description(self, cursor: Any) -> List[Tuple[str, Any]]:
+        """(nombre, tipo) de las columnas de salida, a partir de cursor.description tras execute()."""
+        raw_desc = cursor.description or []
+        if not self.raw:
+            return [(name, d[1]) for name, d in zip(self.columns, raw_desc)]
+        types: List[Any] = [raw_desc[i][1] if i is not None and i < len(raw_desc) else str
+                            for i in self._RAW_SOURCE]
+        if self.include_duration:
+            types.append(int)
+        return list(zip(self.columns, types))
+
+    def execute(self, cursor: Any) -> List[str]:
+        """Ejecuta la consulta en el cursor y devuelve los nombres de columna de salida."""
+        cursor.execute(self.sql, self.params)
+        return self.columns
+
+    def fetchall(self, cursor: Any) -> List[tuple]:
+        return self.convert(cursor.fetchall())
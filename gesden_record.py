@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registro compacto de una cita (Appointment).
+
+Las citas viajaban entre módulos como diccionarios con claves en castellano:
+un dict por cita (más su tabla hash) y una cadena nueva por cada estado,
+tratamiento, odontólogo o fecha repetidos. Appointment guarda los mismos
+campos en __slots__ e interna los campos categóricos, de modo que todas las
+citas comparten las mismas cadenas.
+
+El acceso de solo lectura es el de un dict (apt['Fecha'], apt.get('Notas')),
+así que process_appointments, analyze_changes, etc. no cambian. El dict/JSON
+solo se construye al entregar los datos (to_dict, json_default).
+
+>>> a = Appointment(1, '2025-01-02 09:00:00', '2025-01-02 09:00:00', '7', 'Lopez', 'Ana', '',
+...                 '2025-01-10', '10:00', 'Planificada', 'Revision', 'Dr. Mario Rubio', '')
+>>> a['Fecha'], a.get('Duracion', 0), 'Duracion' in a
+('2025-01-10', 0, False)
+>>> b = Appointment.from_dict(a.to_dict())
+>>> b == a, b.EstadoCita is a.EstadoCita
+(True, True)
+>>> import json
+>>> json.loads(json.dumps([a], default=json_default))[0]['Odontologo']
+'Dr. Mario Rubio'
+
+Cada registro lleva un resumen (digest) de sus campos significativos; para
+detectar cambios basta comparar resúmenes:
+
+>>> a.digest() == content_digest(a.to_dict())
+True
+>>> c = Appointment.from_dict(dict(a.to_dict(), Hora='11:00'))
+>>> c.digest() == a.digest(), field_diff(a, c)
+(False, [('Hora', '10:00', '11:00')])
+"""
+
+import hashlib
+import sys
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+from gesden_query import APPOINTMENT_COLUMNS
+
+FIELDS: Tuple[str, ...] = tuple(APPOINTMENT_COLUMNS) + ('Duracion',)
+# Campos con pocos valores distintos: se internan para compartir la cadena
+CATEGORICAL_FIELDS = ('Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo')
+# Campos que cuentan como cambio de una cita (estado de sql_sync_script)
+SIGNIFICANT_FIELDS = (
+    'Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas', 'TelMovil', 'Nombre', 'Apellidos',
+)
+
+_FIELD_SET = frozenset(FIELDS)
+_MISSING = object()
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def _digest(values: Iterator[Any]) -> str:
+    # Igual que la comparación histórica: str() sin espacios, NULL como ''
+    text = '\x1f'.join('' if v is None else str(v).strip() for v in values)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def content_digest(record: Any, fields: Sequence[str] = SIGNIFICANT_FIELDS) -> str:
+    """Resumen estable (entre ejecuciones) de los campos significativos de un registro o dict."""
+    if isinstance(record, Appointment):
+        return record.digest(fields)
+    return _digest(record.get(f) for f in fields)
+
+
+def field_diff(old: Any, new: Any, fields: Sequence[str] = SIGNIFICANT_FIELDS) -> List[Tuple[str, Any, Any]]:
+    """Campos que difieren entre dos versiones; solo para el log, cuando el resumen ya cambió."""
+    diff = []
+    for f in fields:
+        before = '' if old.get(f) is None else str(old.get(f)).strip()
+        after = '' if new.get(f) is None else str(new.get(f)).strip()
+        if before != after:
+            diff.append((f, before, after))
+    return diff
+
+
+class Appointment:
+    """Cita de dbo.DCitas con las columnas de AppointmentQuery.
+
+    Duracion es opcional: si la consulta no la incluye no aparece en to_dict().
+    """
+
+    __slots__ = FIELDS + ('_digest',)
+
+    def __init__(self, Registro: Any, CitMod: Any, FechaAlta: Any, NumPac: Any, Apellidos: Any,
+                 Nombre: Any, TelMovil: Any, Fecha: Any, Hora: Any, EstadoCita: Any,
+                 Tratamiento: Any, Odontologo: Any, Notas: Any, Duracion: Any = _MISSING):
+        self.Registro = Registro
+        self.CitMod = CitMod
+        self.FechaAlta = FechaAlta
+        self.NumPac = NumPac
+        self.Apellidos = Apellidos
+        self.Nombre = Nombre
+        self.TelMovil = TelMovil
+        self.Fecha = _intern(Fecha)
+        self.Hora = _intern(Hora)
+        self.EstadoCita = _intern(EstadoCita)
+        self.Tratamiento = _intern(Tratamiento)
+        self.Odontologo = _intern(Odontologo)
+        self.Notas = Notas
+        if Duracion is not _MISSING:
+            self.Duracion = Duracion
+
+    def digest(self, fields: Sequence[str] = SIGNIFICANT_FIELDS) -> str:
+        """Resumen de `fields`; se calcula una vez por registro y conjunto de campos."""
+        cached = getattr(self, '_digest', None)
+        if cached is not None and cached[0] is fields:
+            return cached[1]
+        value = _digest(getattr(self, f, None) for f in fields)
+        self._digest = (fields, value)
+        return value
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Appointment':
+        """Desde un dict ya serializado (p. ej. appointments_data.json)."""
+        return cls(*[data.get(f) for f in APPOINTMENT_COLUMNS], data.get('Duracion', _MISSING))
+
+    # --- Acceso como dict (solo lectura) ---
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in _FIELD_SET:
+            return default
+        return getattr(self, key, default)
+
+    def __contains__(self, key: object) -> bool:
+        return key in _FIELD_SET and hasattr(self, key)  # type: ignore[arg-type]
+
+    def keys(self) -> List[str]:
+        return [f for f in FIELDS if hasattr(self, f)]
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for f in FIELDS:
+            value = getattr(self, f, _MISSING)
+            if value is not _MISSING:
+                yield f, value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Appointment):
+            return NotImplemented
+        return all(getattr(self, f, _MISSING) == getattr(other, f, _MISSING) for f in FIELDS)
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"Appointment(Registro={self.Registro!r}, Fecha={self.Fecha!r}, Hora={self.Hora!r})"
+
+
+def appointments_from_rows(columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> List[Appointment]:
+    """Crea registros a partir de tuplas en el orden de AppointmentQuery.columns."""
+    if tuple(columns) != FIELDS[:len(columns)]:
+        raise ValueError(f"Columnas inesperadas para Appointment: {list(columns)}")
+    return [Appointment(*row) for row in rows]
+
+
+def to_dicts(records: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Convierte a dicts en la frontera de salida (JSON, backend). Acepta dicts ya convertidos."""
+    return [r.to_dict() if isinstance(r, Appointment) else r for r in records]
+
+
+def json_default(obj: Any) -> Any:
+    """Para json.dump(..., default=json_default)."""
+    if isinstance(obj, Appointment):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Conversión de filas de pyodbc a valores serializables.
+
+Los scripts convertían cada celda preguntando su tipo (hasattr(value,
+'strftime'), cadenas de isinstance...). RowConverter mira cursor.description
+una sola vez, decide la conversión de cada columna y aplica a cada fila esa
+tupla de funciones, sin inspeccionar tipos celda a celda. Las columnas sin tipo
+declarado (p. ej. SQLite) usan la conversión genérica con isinstance.
+
+>>> import datetime
+>>> description = [('Registro', int), ('CitMod', datetime.datetime), ('Notas', str)]
+>>> conv = RowConverter(description)
+>>> conv.to_dict((7, datetime.datetime(2025, 1, 2, 9, 30), None))
+{'Registro': 7, 'CitMod': '2025-01-02 09:30:00', 'Notas': ''}
+>>> RowConverter(description, as_text=True).to_tuple((7, None, 'x'))
+('7', '', 'x')
+>>> RowConverter(description, null=None, datetime_format=None).to_tuple((7, datetime.datetime(2025, 1, 2), None))
+(7, '2025-01-02T00:00:00', None)
+"""
+
+import datetime
+import decimal
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+Converter = Callable[[Any], Any]
+
+
+def _generic(null: Any, as_text: bool, datetime_format: Optional[str]) -> Converter:
+    """Conversor con inspección de tipo, para columnas cuyo tipo no declara el driver."""
+    def convert(v: Any) -> Any:
+        if v is None:
+            return null
+        if isinstance(v, (bytes, bytearray)):
+            return v.decode('utf-8', errors='ignore')
+        if isinstance(v, datetime.datetime):
+            return v.strftime(datetime_format) if datetime_format else v.isoformat()
+        if isinstance(v, datetime.date) and as_text:
+            return v.strftime('%Y-%m-%d')
+        return str(v) if as_text else v
+    return convert
+
+
+def _plan(type_code: Any, null: Any, as_text: bool, datetime_format: Optional[str]) -> Optional[Converter]:
+    """Conversión de una columna según su tipo; None si el valor pasa tal cual (salvo NULL)."""
+    if type_code is datetime.datetime:
+        if datetime_format == DATETIME_FORMAT:
+            # Igual que strftime(DATETIME_FORMAT) y bastante más rápido
+            return lambda v: null if v is None else v.isoformat(' ', 'seconds')
+        if datetime_format:
+            return lambda v: null if v is None else v.strftime(datetime_format)
+        return lambda v: null if v is None else v.isoformat()
+    if type_code is datetime.date:
+        fmt = '%Y-%m-%d' if as_text else datetime_format
+        if fmt:
+            return lambda v: null if v is None else v.strftime(fmt)
+        return lambda v: null if v is None else v.isoformat()
+    if type_code is datetime.time:
+        return lambda v: null if v is None else v.strftime('%H:%M:%S')
+    if type_code in (bytes, bytearray):
+        return lambda v: null if v is None else bytes(v).decode('utf-8', errors='ignore')
+    if type_code is str:
+        return None
+    if type_code in (int, float, bool, decimal.Decimal):
+        if as_text:
+            return lambda v: null if v is None else str(v)
+        return None
+    return _generic(null, as_text, datetime_format)
+
+
+def build_converter(type_code: Any, null: Any = '', as_text: bool = False,
+                    datetime_format: Optional[str] = DATETIME_FORMAT) -> Converter:
+    """Devuelve la función de conversión para un tipo de columna de cursor.description."""
+    convert = _plan(type_code, null, as_text, datetime_format)
+    if convert is None:
+        return lambda v: null if v is None else v
+    return convert
+
+
+class RowConverter:
+    """Plan de conversión por columna calculado una vez a partir de cursor.description.
+
+    • null: valor para NULL ('' por defecto; None para conservarlo)
+    • as_text: todo como str (Sheets, CSV)
+    • datetime_format: formato strftime de fechas-hora, o None para isoformat()
+
+    El plan es una tupla de funciones (self.converters), una por columna, que
+    se aplica a cada fila con zip. Si ninguna columna necesita conversión y
+    NULL se conserva, la fila se copia tal cual.
+    """
+
+    def __init__(self, description: Sequence[Sequence[Any]], null: Any = '', as_text: bool = False,
+                 datetime_format: Optional[str] = DATETIME_FORMAT):
+        self.columns: List[str] = [d[0] for d in description]
+        plan = [_plan(d[1] if len(d) > 1 else None, null, as_text, datetime_format) for d in description]
+        self.converters: Tuple[Converter, ...] = tuple(
+            (lambda v: null if v is None else v) if f is None else f for f in plan
+        )
+        self.identity = null is None and all(f is None for f in plan)
+
+    def to_tuple(self, row: Sequence[Any]) -> tuple:
+        if self.identity:
+            return tuple(row)
+        return tuple([f(v) for f, v in zip(self.converters, row)])
+
+    def to_dict(self, row: Sequence[Any]) -> Dict[str, Any]:
+        return dict(zip(self.columns, self.to_tuple(row)))
+
+    def to_tuples(self, rows: Sequence[Sequence[Any]]) -> List[tuple]:
+        if self.identity:
+            return list(map(tuple, rows))
+        converters = self.converters
+        return [tuple([f(v) for f, v in zip(converters, row)]) for row in rows]
+
+    def to_dicts(self, rows: Sequence[Sequence[Any]]) -> List[Dict[str, Any]]:
+        columns = self.columns
+        return [dict(zip(columns, values)) for values in self.to_tuples(rows)]
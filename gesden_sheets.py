@@ -0,0 +1,761 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Utilidades comunes para escribir citas en Google Sheets
+(gesden_to_sheets.py, gesden_export_to_sheets.py y el sink 'sheets').
+
+Réplica local de la hoja (SheetMirror): para cada Registro guarda la fila en
+la que está y un resumen de su contenido, en SHEETS_MIRROR_FILE. En cada
+ejecución solo se descarga la columna A (claves) para validarla; la hoja
+completa se lee únicamente si la columna A no coincide con la réplica (alguien
+ordenó, insertó o borró filas a mano, o es la primera ejecución).
+
+>>> class FakeWorksheet:
+...     id = 0
+...     def __init__(self, values): self.values = values; self.full_reads = 0
+...     def col_values(self, col): return [r[0] for r in self.values]
+...     def get_all_values(self): self.full_reads += 1; return self.values
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'mirror.json')
+>>> ws = FakeWorksheet([['Registro'], ['10', 'a'], ['11', 'b']])
+>>> mirror = SheetMirror.load(path, 'hoja')
+>>> mirror.refresh(ws), mirror.rows  # doctest: +ELLIPSIS
+[...] Réplica de la hoja desactualizada (0 vs 2 claves): lectura completa
+(False, {'10': 2, '11': 3})
+>>> mirror.save()
+>>> mirror = SheetMirror.load(path, 'hoja')
+>>> mirror.refresh(ws), ws.full_reads
+(True, 1)
+
+Las filas nuevas se añaden en bloque (append_rows) y su posición se toma de
+`updates.updatedRange` de la respuesta:
+
+>>> list(updated_rows({'updates': {'updatedRange': "'Hoja1'!A4:O5"}}))
+[4, 5]
+
+QuotaWorksheet reparte las llamadas según las cuotas por minuto (TokenBucket)
+y reintenta los 429/5xx con espera exponencial con jitter:
+
+>>> class RateLimited(Exception):
+...     code = 429
+>>> attempts = []
+>>> def flaky():
+...     attempts.append(1)
+...     if len(attempts) < 3:
+...         raise RateLimited()
+...     return 'ok'
+>>> client = QuotaClient(sleep=lambda s: None)
+>>> client.call('write', flaky), client.stats['retries']  # doctest: +ELLIPSIS
+[...] ⚠️ Sheets API 429; reintento 1 en ...s
+[...] ⚠️ Sheets API 429; reintento 2 en ...s
+('ok', 2)
+
+values.append y el borrado de filas no son idempotentes: un 5xx no dice si se
+aplicaron, así que solo se reintentan ante 429. El 5xx de un append lo resuelve
+append_rows() releyendo la columna A; el de un borrado aborta la sincronización
+y la siguiente ejecución reconstruye la réplica (SheetMirror.refresh):
+
+>>> class Unavailable(Exception):
+...     code = 503
+>>> def down():
+...     raise Unavailable()
+>>> try:
+...     client.call('write', down, retry_status=NON_IDEMPOTENT_RETRY_STATUS)
+... except Unavailable:
+...     print('sin reintentos:', client.stats['retries'])
+sin reintentos: 2
+"""
+
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from gesden_snapshot import write_json_atomic
+
+SHEETS_MIRROR_FILE = os.getenv('SHEETS_MIRROR_FILE', 'sheets_mirror.json')
+
+# Columnas de datos (A:N); las marcas de tiempo (O: InsertedAt, P: UpdatedAt) no cuentan para el resumen
+DATA_COLUMNS = 14
+SHEET_COLUMNS = 16
+
+# Tamaño máximo aproximado del cuerpo de una petición de escritura (Google recomienda ~2 MB)
+MAX_PAYLOAD_BYTES = int(os.getenv('SHEETS_MAX_PAYLOAD_BYTES', str(2 * 1024 * 1024)))
+
+# Cuotas de la API de Sheets por usuario y minuto (lecturas / escrituras)
+SHEETS_READS_PER_MINUTE = int(os.getenv('SHEETS_READS_PER_MINUTE', '60'))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', '60'))
+# Tiempo máximo reintentando una misma petición (429 / 5xx) antes de darla por fallida
+SHEETS_RETRY_DEADLINE = float(os.getenv('SHEETS_RETRY_DEADLINE', '120'))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 32.0
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+# values.append y deleteDimension: un 429 garantiza que no se aplicó nada; un 5xx no
+NON_IDEMPOTENT_RETRY_STATUS = frozenset({429})
+# Veces que se relee la columna A tras un 5xx en un append antes de dar el error por definitivo
+APPEND_RECONCILE_ATTEMPTS = 3
+
+# Coste estimado (ms) de cada petición y de cada celda escrita o desplazada al borrar filas
+SHEETS_REQUEST_COST_MS = float(os.getenv('SHEETS_REQUEST_COST_MS', '500'))
+SHEETS_CELL_COST_MS = float(os.getenv('SHEETS_CELL_COST_MS', '0.05'))
+SHEETS_SHIFT_COST_MS = float(os.getenv('SHEETS_SHIFT_COST_MS', '0.02'))
+
+# Reparto en pestañas (gesden_to_sheets con SHEETS_SHARD_BY): prefijo del título por criterio
+SHARD_PREFIXES = {'month': 'Citas ', 'dentist': 'Odontólogo '}
+
+_RANGE_RE = re.compile(r"!?[A-Z]+(\d+)(?::[A-Z]+(\d+))?$")
+
+
+# La réplica de todas las pestañas comparte fichero: se guarda de una en una
+_MIRROR_LOCK = threading.Lock()
+
+
+def log(msg: str) -> None:
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+def row_digest(cells: Sequence[Any]) -> str:
+    """Resumen de las columnas de datos de una fila tal como queda en la hoja."""
+    values = [str(c).strip() for c in cells[:DATA_COLUMNS]]
+    values += [''] * (DATA_COLUMNS - len(values))
+    return hashlib.blake2b('\x1f'.join(values).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def sheet_key(ws: Any) -> str:
+    """Identifica la hoja (libro + pestaña) para no mezclar réplicas."""
+    spreadsheet = getattr(ws, 'spreadsheet', None)
+    return f"{getattr(spreadsheet, 'id', '')}/{ws.id}"
+
+
+class SheetMirror:
+    """Registro -> (fila, resumen) de una pestaña, persistido entre ejecuciones."""
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self.rows: Dict[str, int] = {}
+        self.digests: Dict[str, str] = {}
+        self.stamps: Dict[str, List[str]] = {}  # Registro -> [InsertedAt, UpdatedAt]
+
+    @classmethod
+    def load(cls, path: str, key: str) -> 'SheetMirror':
+        mirror = cls(path, key)
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    state = json.load(f).get(key, {})
+                for registro, entry in state.get('rows', {}).items():
+                    mirror.rows[registro] = int(entry[0])
+                    mirror.digests[registro] = entry[1]
+                    if len(entry) >= 4:
+                        mirror.stamps[registro] = [entry[2], entry[3]]
+        except Exception as e:
+            log(f"⚠️ Réplica de la hoja no válida ({e}); se reconstruirá")
+            mirror.rows, mirror.digests, mirror.stamps = {}, {}, {}
+        return mirror
+
+    def save(self) -> None:
+        with _MIRROR_LOCK:
+            state: Dict[str, Any] = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                except Exception:
+                    state = {}
+            state[self.key] = {
+                'rows': {k: [row, self.digests.get(k, '')] + self.stamps.get(k, []) for k, row in self.rows.items()},
+                'updated_at': datetime.datetime.now().isoformat(),
+            }
+            write_json_atomic(self.path, state)
+
+    @property
+    def last_row(self) -> int:
+        """Última fila ocupada según la réplica (1 = solo cabecera)."""
+        return max(self.rows.values(), default=1)
+
+    def refresh(self, ws: Any) -> bool:
+        """Valida la réplica con la columna A. Devuelve True si era válida; si no, la reconstruye."""
+        index = _index_from_keys(ws.col_values(1))
+        if index == self.rows and len(self.digests) == len(self.rows):
+            return True
+        log(f"Réplica de la hoja desactualizada ({len(self.rows)} vs {len(index)} claves): lectura completa")
+        self.rows, self.digests, self.stamps = {}, {}, {}
+        for i, row in enumerate(ws.get_all_values(), start=1):
+            key = (row[0] if row else '').strip()
+            if i == 1 or not key:
+                continue
+            self.rows[key] = i
+            self.digests[key] = row_digest(row)
+            self.stamps[key] = _stamps(row)
+        return False
+
+    def set_row(self, registro: str, row: int, digest: str,
+                inserted_at: Optional[str] = None, updated_at: Optional[str] = None) -> None:
+        self.rows[registro] = row
+        self.digests[registro] = digest
+        if inserted_at is not None or updated_at is not None:
+            stamps = self.stamps.setdefault(registro, ['', ''])
+            if inserted_at is not None:
+                stamps[0] = inserted_at
+            if updated_at is not None:
+                stamps[1] = updated_at
+
+    def missing_stamps(self) -> bool:
+        """Si falta InsertedAt/UpdatedAt de alguna fila (réplicas anteriores a estas columnas)."""
+        return any(k not in self.stamps for k in self.rows)
+
+    def remove_rows(self, row_numbers: Iterable[int]) -> None:
+        """Quita las filas borradas y desplaza hacia arriba las que estaban debajo."""
+        deleted = sorted(set(row_numbers))
+        if not deleted:
+            return
+        gone = set(deleted)
+        rows: Dict[str, int] = {}
+        for registro, row in self.rows.items():
+            if row in gone:
+                self.digests.pop(registro, None)
+                self.stamps.pop(registro, None)
+                continue
+            # Se resta el número de filas borradas por encima de esta
+            rows[registro] = row - _count_below(deleted, row)
+        self.rows = rows
+
+
+def _stamps(cells: Sequence[Any]) -> List[str]:
+    stamps = [str(c) for c in cells[DATA_COLUMNS:SHEET_COLUMNS]]
+    return stamps + [''] * (2 - len(stamps))
+
+
+def _index_from_keys(keys: List[str]) -> Dict[str, int]:
+    index: Dict[str, int] = {}
+    for i, key in enumerate(keys, start=1):
+        key = (key or '').strip()
+        if i == 1 or not key:
+            continue
+        index[key] = i
+    return index
+
+
+def _count_below(sorted_rows: List[int], row: int) -> int:
+    """Cuántas filas de `sorted_rows` son menores que `row`."""
+    return bisect.bisect_left(sorted_rows, row)
+
+
+def chunk_rows(rows: List[List[str]], max_bytes: int = MAX_PAYLOAD_BYTES) -> Iterator[List[List[str]]]:
+    """Agrupa filas en lotes cuyo JSON no supere `max_bytes` (un solo lote casi siempre)."""
+    chunk: List[List[str]] = []
+    size = 0
+    for row in rows:
+        row_size = len(json.dumps(row, ensure_ascii=False).encode('utf-8')) + 1
+        if chunk and size + row_size > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(row)
+        size += row_size
+    if chunk:
+        yield chunk
+
+
+def updated_rows(response: Any) -> Optional[range]:
+    """Filas escritas según `updates.updatedRange` de la respuesta de values.append."""
+    try:
+        updated = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    match = _RANGE_RE.search(updated)
+    if not match:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    return range(first, last + 1)
+
+
+def _reconcile_append(ws: Any, chunk: List[List[str]], mirror: SheetMirror) -> List[List[str]]:
+    """Tras un 5xx en values.append: anota las filas de `chunk` que sí llegaron y devuelve las que faltan.
+
+    Se relee la columna A porque volver a enviar filas ya añadidas las
+    duplicaría, y _index_from_keys solo conserva la última aparición de cada clave.
+    """
+    index = _index_from_keys(ws.col_values(1))
+    missing: List[List[str]] = []
+    for row in chunk:
+        registro = str(row[0]).strip()
+        if registro in index:
+            mirror.set_row(registro, index[registro], row_digest(row), *_stamps(row))
+        else:
+            missing.append(row)
+    log(f"Append reconciliado con la columna A: {len(chunk) - len(missing)} filas ya escritas, "
+        f"{len(missing)} pendientes")
+    return missing
+
+
+def append_rows(ws: Any, rows: List[List[str]], mirror: SheetMirror) -> int:
+    """Añade `rows` con una petición por lote y anota en la réplica la fila de cada una.
+
+    Un 5xx no se reintenta a ciegas: se concilia con la columna A
+    (_reconcile_append) y se vuelven a enviar solo las filas que faltan.
+    Devuelve el número de peticiones realizadas.
+    """
+    calls = 0
+    pending = list(chunk_rows(rows))
+    attempts = 0
+    while pending:
+        chunk = pending.pop(0)
+        try:
+            response = ws.append_rows(chunk, value_input_option='RAW', table_range='A1')
+        except Exception as e:
+            status = _status(e)
+            if status not in RETRYABLE_STATUS or attempts >= APPEND_RECONCILE_ATTEMPTS:
+                raise
+            attempts += 1
+            calls += 2
+            log(f"⚠️ Sheets API {status} en append; comprobando qué filas se escribieron")
+            missing = _reconcile_append(ws, chunk, mirror)
+            if missing:
+                sleep = getattr(getattr(ws, 'client', None), 'sleep', time.sleep)
+                sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts)))
+                pending.insert(0, missing)
+            continue
+        calls += 1
+        landed = updated_rows(response)
+        if landed is None or len(landed) != len(chunk):
+            # Sin rango en la respuesta: se asume que quedan tras la última fila conocida
+            landed = range(mirror.last_row + 1, mirror.last_row + 1 + len(chunk))
+        for row_number, row in zip(landed, chunk):
+            mirror.set_row(str(row[0]).strip(), row_number, row_digest(row), *_stamps(row))
+    return calls
+
+
+def row_runs(row_numbers: Iterable[int]) -> List[Tuple[int, int]]:
+    """Tramos contiguos (primera, última) de filas, de abajo arriba.
+
+    >>> row_runs([2, 3, 4, 9, 7, 8, 12])
+    [(12, 12), (7, 9), (2, 4)]
+    """
+    runs: List[Tuple[int, int]] = []
+    for row in sorted(set(row_numbers)):
+        if runs and row == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs[::-1]
+
+
+def delete_rows(ws: Any, row_numbers: Iterable[int], mirror: SheetMirror) -> int:
+    """Borra las filas en una sola petición batchUpdate (un deleteDimension por tramo).
+
+    Los tramos van de abajo arriba para que los índices de los siguientes no se
+    desplacen. Ante un 5xx no se reintenta (ver QuotaSpreadsheet) y la réplica
+    no se guarda. Devuelve el número de tramos.
+    """
+    runs = row_runs(row_numbers)
+    if not runs:
+        return 0
+    ws.spreadsheet.batch_update({'requests': [
+        {
+            'deleteDimension': {
+                'range': {
+                    'sheetId': ws.id,
+                    'dimension': 'ROWS',
+                    'startIndex': first - 1,  # Índices de la API: base 0, fin exclusivo
+                    'endIndex': last,
+                },
+            },
+        }
+        for first, last in runs
+    ]})
+    mirror.remove_rows(row for first, last in runs for row in range(first, last + 1))
+    return len(runs)
+
+
+class TokenBucket:
+    """Limita a `per_minute` peticiones por minuto, permitiendo ráfagas de hasta `capacity`."""
+
+    def __init__(self, per_minute: int, capacity: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = per_minute / 60.0
+        self.capacity = float(capacity or per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Consume un token, esperando si hace falta. Devuelve los segundos esperados.
+
+        El token se reserva al momento (el saldo puede quedar negativo) y se
+        espera una sola vez lo que falte, así cada hilo espera su turno.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+def _status(exc: Exception) -> Optional[int]:
+    """Código HTTP de un error de la API (gspread.exceptions.APIError u otro con .response)."""
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(exc, 'code', None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaClient:
+    """Ejecuta llamadas a la API respetando las cuotas y reintentando 429/5xx.
+
+    Cada llamada consume un token del cubo de lecturas o de escrituras. Ante
+    un código de `retry_status` (por omisión 429 o 5xx) se reintenta con espera
+    exponencial con jitter (o la indicada en Retry-After) hasta agotar
+    `deadline` segundos; entonces se relanza el error.
+    """
+
+    def __init__(self, reads_per_minute: int = SHEETS_READS_PER_MINUTE,
+                 writes_per_minute: int = SHEETS_WRITES_PER_MINUTE,
+                 deadline: float = SHEETS_RETRY_DEADLINE,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.buckets = {
+            'read': TokenBucket(reads_per_minute, clock=clock, sleep=sleep),
+            'write': TokenBucket(writes_per_minute, clock=clock, sleep=sleep),
+        }
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = {'read': 0, 'write': 0, 'retries': 0, 'waited': 0.0}
+        self.lock = threading.Lock()
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        with self.lock:
+            self.stats[key] += amount
+
+    def call(self, kind: str, fn: Callable[..., Any], *args: Any,
+             retry_status: Iterable[int] = RETRYABLE_STATUS, **kwargs: Any) -> Any:
+        started = self.clock()
+        attempt = 0
+        while True:
+            self._count('waited', self.buckets[kind].acquire())
+            self._count(kind)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                status = _status(e)
+                if status not in retry_status:
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                delay = max(delay, _retry_after(e) or 0.0)
+                if self.clock() - started + delay > self.deadline:
+                    log(f"❌ Sheets API {status}: sin margen para reintentar ({self.deadline:.0f}s)")
+                    raise
+                attempt += 1
+                self._count('retries')
+                log(f"⚠️ Sheets API {status}; reintento {attempt} en {delay:.1f}s")
+                self.sleep(delay)
+                self._count('waited', delay)
+
+
+class QuotaSpreadsheet:
+    """Spreadsheet cuyo batch_update pasa por el QuotaClient de la hoja."""
+
+    def __init__(self, spreadsheet: Any, worksheet: 'QuotaWorksheet'):
+        self._spreadsheet = spreadsheet
+        self._worksheet = worksheet
+
+    def batch_update(self, body: Dict[str, Any]) -> Any:
+        self._worksheet.flush()
+        # deleteDimension por índices: repetirlo tras un 5xx ya aplicado borraría otras filas
+        return self._worksheet.client.call('write', self._spreadsheet.batch_update, body,
+                                           retry_status=NON_IDEMPOTENT_RETRY_STATUS)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._spreadsheet, name)
+
+
+class QuotaWorksheet:
+    """Envoltorio de gspread.Worksheet con cuotas, reintentos y escrituras agrupadas.
+
+    batch_update no se envía en el momento: los rangos se acumulan (el último
+    valor de cada rango gana) y salen en una sola petición antes de la siguiente
+    lectura, append o borrado, o al llamar a flush().
+    """
+
+    READS = ('col_values', 'row_values', 'get_all_values', 'get_values', 'get')
+
+    def __init__(self, ws: Any, client: Optional[QuotaClient] = None):
+        self._ws = ws
+        self.client = client or QuotaClient()
+        self._pending: Dict[str, List[List[Any]]] = {}
+        self._pending_options: Dict[str, Any] = {}
+        self.spreadsheet = QuotaSpreadsheet(ws.spreadsheet, self)
+
+    @property
+    def id(self) -> Any:
+        return self._ws.id
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs: Any) -> None:
+        if self._pending and kwargs != self._pending_options:
+            self.flush()
+        self._pending_options = kwargs
+        for item in data:
+            self._pending.pop(item['range'], None)
+            self._pending[item['range']] = item['values']
+
+    def flush(self) -> None:
+        """Envía las escrituras pendientes en una única petición."""
+        if not self._pending:
+            return
+        data = [{'range': r, 'values': v} for r, v in self._pending.items()]
+        self.client.call('write', self._ws.batch_update, data, **self._pending_options)
+        self._pending = {}
+
+    def append_rows(self, *args: Any, **kwargs: Any) -> Any:
+        self.flush()
+        return self.client.call('write', self._ws.append_rows, *args,
+                                retry_status=NON_IDEMPOTENT_RETRY_STATUS, **kwargs)
+
+    def update(self, *args: Any, **kwargs: Any) -> Any:
+        self.flush()
+        return self.client.call('write', self._ws.update, *args, **kwargs)
+
+    def batch_clear(self, ranges: List[str]) -> Any:
+        self.flush()
+        return self.client.call('write', self._ws.batch_clear, ranges)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._ws, name)
+        if name in self.READS:
+            def read(*args: Any, **kwargs: Any) -> Any:
+                self.flush()
+                return self.client.call('read', attr, *args, **kwargs)
+            return read
+        return attr
+
+
+def quota_worksheet(ws: Any, client: Optional[QuotaClient] = None) -> QuotaWorksheet:
+    """Envuelve `ws` (si no lo estaba ya). Varias pestañas pueden compartir `client` y sus cuotas."""
+    return ws if isinstance(ws, QuotaWorksheet) else QuotaWorksheet(ws, client)
+
+
+def shard_title(record: Dict[str, str], by: str) -> str:
+    """Pestaña de una cita según el criterio de reparto ('month' o 'dentist').
+
+    >>> shard_title({'Fecha': '2025-03-14 00:00:00'}, 'month')
+    'Citas 2025-03'
+    >>> shard_title({'Odontologo': 'Dr. Mario Rubio'}, 'dentist')
+    'Odontólogo Dr. Mario Rubio'
+    """
+    if by not in SHARD_PREFIXES:
+        raise ValueError(f"Reparto desconocido: {by} (disponibles: {', '.join(SHARD_PREFIXES)})")
+    if by == 'month':
+        value = (record.get('Fecha') or '')[:7] or 'sin fecha'
+    else:
+        value = (record.get('Odontologo') or '').strip() or 'sin odontólogo'
+    # Caracteres no admitidos en títulos de pestaña; máximo 100 caracteres
+    value = re.sub(r"[\[\]*?:/\\']", ' ', value)
+    return (SHARD_PREFIXES[by] + value)[:100]
+
+
+class SyncPlan:
+    """Estrategia de escritura con su coste estimado.
+
+    • 'incremental': updates (A:N + P) de las filas cambiadas, append en bloque y
+      borrado por tramos; cada fila borrada desplaza las de debajo.
+    • 'rewrite': se reescribe el bloque completo A2:P en el orden de la consulta
+      y se limpian las filas sobrantes del final.
+    """
+
+    def __init__(self, strategy: str, requests: int, cells: int, shifted: int = 0):
+        self.strategy = strategy
+        self.requests = requests
+        self.cells = cells
+        self.shifted = shifted
+
+    @property
+    def cost(self) -> float:
+        return (self.requests * SHEETS_REQUEST_COST_MS + self.cells * SHEETS_CELL_COST_MS
+                + self.shifted * SHEETS_SHIFT_COST_MS)
+
+    def __repr__(self) -> str:
+        return (f"{self.strategy}: {self.requests} petición(es), {self.cells} celdas"
+                f"{f', {self.shifted} celdas desplazadas' if self.shifted else ''} (~{self.cost:.0f} ms)")
+
+
+def plan_sync(mirror: SheetMirror, total: int, changed: int,
+              appends: List[List[str]], deletes: List[int]) -> Tuple[SyncPlan, SyncPlan]:
+    """Coste de cada estrategia para dejar `total` filas en la hoja. Devuelve (elegida, descartada).
+
+    >>> mirror = SheetMirror('', 'hoja')
+    >>> for n in range(2, 252):
+    ...     mirror.set_row(str(n), n, '', '', '')
+    >>> plan_sync(mirror, 250, changed=3, appends=[], deletes=[])[0].strategy
+    'incremental'
+    >>> plan_sync(mirror, 250, changed=10, appends=[['x'] * 16] * 200, deletes=list(range(2, 202)))[0].strategy
+    'rewrite'
+    """
+    incremental = SyncPlan(
+        'incremental',
+        requests=(1 if changed else 0) + len(list(chunk_rows(appends))) + (1 if deletes else 0),
+        cells=changed * (DATA_COLUMNS + 1) + len(appends) * SHEET_COLUMNS,
+        # Al borrar, se desplazan todas las filas por debajo del primer hueco
+        shifted=(mirror.last_row + len(appends) - min(deletes)) * SHEET_COLUMNS if deletes else 0,
+    )
+    if not (changed or appends or deletes):
+        return incremental, incremental
+    surplus = max(0, mirror.last_row - 1 - total)
+    rewrite = SyncPlan(
+        'rewrite',
+        requests=1 + (1 if surplus else 0) + (1 if mirror.missing_stamps() else 0),
+        cells=(total + surplus) * SHEET_COLUMNS,
+    )
+    return (rewrite, incremental) if rewrite.cost < incremental.cost else (incremental, rewrite)
+
+
+def rewrite_sheet(ws: Any, mirror: SheetMirror, rows: List[List[str]],
+                  changed: Iterable[str], updated_at: str) -> int:
+    """Reescribe A2:P con `rows` (ya en el orden final) y limpia el resto.
+
+    Conserva InsertedAt/UpdatedAt de las filas existentes; UpdatedAt pasa a
+    `updated_at` solo en las de `changed`. Devuelve el número de peticiones.
+    """
+    calls = 0
+    old_last = mirror.last_row
+    if mirror.missing_stamps():
+        # Réplica sin marcas de tiempo: se leen solo las columnas O:P
+        calls += 1
+        by_row = {row: registro for registro, row in mirror.rows.items()}
+        for i, cells in enumerate(ws.get(f"O2:P{old_last}"), start=2):
+            if i in by_row:
+                mirror.stamps[by_row[i]] = _stamps([''] * DATA_COLUMNS + list(cells))
+    changed = set(changed)
+    previous = mirror.stamps
+    values: List[List[str]] = []
+    mirror.rows, mirror.digests, mirror.stamps = {}, {}, {}
+    for i, row in enumerate(rows, start=2):
+        registro = str(row[0]).strip()
+        row = list(row[:DATA_COLUMNS]) + _stamps(row)
+        if registro in previous:
+            row[DATA_COLUMNS] = previous[registro][0]
+            row[DATA_COLUMNS + 1] = updated_at if registro in changed else previous[registro][1]
+        values.append(row)
+        mirror.set_row(registro, i, row_digest(row), *row[DATA_COLUMNS:SHEET_COLUMNS])
+    new_last = len(values) + 1
+    if values:
+        ws.batch_update([{'range': f"A2:P{new_last}", 'values': values}])
+        calls += 1
+    if old_last > new_last:
+        ws.batch_clear([f"A{new_last + 1}:P{old_last}"])
+        calls += 1
+    return calls
+
+
+def open_mirror(ws: Any, path: Optional[str] = None) -> SheetMirror:
+    """Carga la réplica de `ws` y la valida con la columna A."""
+    mirror = SheetMirror.load(path or SHEETS_MIRROR_FILE, sheet_key(ws))
+    mirror.refresh(ws)
+    return mirror
+
+
+def sync_worksheet(ws: Any, records: List[Dict[str, str]],
+                   row_from_record: Callable[[Dict[str, str]], List[str]],
+                   prune: bool = True, remove: Iterable[str] = ()) -> int:
+    """Deja en `ws` exactamente las filas de `records` (una por Registro).
+
+    Las filas sin cambios (mismo resumen en la réplica) no se tocan; las
+    modificadas se actualizan en A:N y P (InsertedAt se conserva), las nuevas
+    se añaden en bloque y las que ya no llegan se borran. Si reescribir la hoja
+    entera sale más barato (plan_sync), se hace eso.
+
+    Con prune=False la hoja acumula historial: solo se borran las filas de
+    `remove` y nunca se reescribe entera. Devuelve las filas de datos de la hoja.
+    """
+    ws = quota_worksheet(ws)
+    mirror = open_mirror(ws)
+    existing_index = dict(mirror.rows)
+    registros_actuales = set()
+
+    updates: List[Tuple[str, List[List[str]]]] = []  # (range, values)
+    appends: List[List[str]] = []
+    changed: Dict[str, str] = {}  # Registro -> resumen nuevo
+    desired: List[List[str]] = []  # Todas las filas en el orden de la consulta
+    unchanged = 0
+    updated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    for d in records:
+        registro = d.get('Registro', '').strip()
+        if not registro:
+            continue
+        registros_actuales.add(registro)
+        is_new = d.get('CitMod', '') == d.get('FechaAlta', '')
+
+        new_row = row_from_record(d)
+        desired.append(new_row)
+
+        if registro in existing_index:
+            row_number = existing_index[registro]
+            digest = row_digest(new_row)
+            if mirror.digests.get(registro) == digest:
+                unchanged += 1
+                continue
+            # Datos (A:N) y UpdatedAt (P); InsertedAt (O) conserva la fecha de alta en la hoja
+            updates.append((f"A{row_number}:N{row_number}", [new_row[:DATA_COLUMNS]]))
+            updates.append((f"P{row_number}", [[updated_at]]))
+            changed[registro] = digest
+            log(f"UPDATE ({'NUEVA' if is_new else 'MOD'}) Registro {registro} -> fila {row_number}")
+        else:
+            appends.append(new_row)
+            log(f"APPEND ({'NUEVA' if is_new else 'MOD'}) Registro {registro}")
+
+    if unchanged:
+        log(f"{unchanged} filas sin cambios (no se reescriben)")
+
+    gone = set(mirror.rows) - registros_actuales
+    if not prune:
+        gone &= {str(r).strip() for r in remove}
+    to_delete = [mirror.rows[r] for r in gone]
+    plan, alternative = plan_sync(mirror, len(desired), len(changed), appends, to_delete)
+    if not prune and plan.strategy == 'rewrite':
+        # La reescritura deja solo `records` y perdería el historial
+        plan, alternative = alternative, plan
+    log(f"Plan elegido → {plan}; descartado → {alternative}")
+
+    if plan.strategy == 'rewrite':
+        requests = rewrite_sheet(ws, mirror, desired, changed, updated_at)
+        log(f"Hoja reescrita: {len(desired)} filas en {requests} petición(es)")
+    else:
+        if updates:
+            log(f"Ejecutando {len(updates) // 2} updates en lote...")
+            ws.batch_update([{'range': r, 'values': v} for r, v in updates])
+            for registro, digest in changed.items():
+                mirror.set_row(registro, mirror.rows[registro], digest, updated_at=updated_at)
+
+        if appends:
+            append_requests = append_rows(ws, appends, mirror)
+            log(f"Ejecutados {len(appends)} appends en {append_requests} petición(es)")
+
+        # Borrado de filas que ya no aparecen
+        if to_delete:
+            log(f"Eliminando {len(to_delete)} filas obsoletas...")
+            runs = delete_rows(ws, to_delete, mirror)
+            log(f"Filas eliminadas en {runs} tramo(s) con una sola petición")
+
+    ws.flush()
+    mirror.save()
+    return len(mirror.rows)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Google Sheets simulado en memoria, para medir la sincronización sin tocar Google.
+
+Implementa las llamadas de gspread que usan gesden_to_sheets.py,
+gesden_export_to_sheets.py y gesden_sheets.py (get_all_values, col_values,
+row_values, get, batch_update, update, append_row(s), delete_rows,
+batch_clear y Spreadsheet.batch_update con deleteDimension). Cada llamada:
+  • cuenta como una petición de lectura o escritura,
+  • suma los bytes (JSON) enviados y recibidos,
+  • avanza un reloj virtual según la latencia simulada,
+  • y si supera la cuota por minuto responde 429 como la API real.
+
+El reloj es virtual: FakeBackend.now / FakeBackend.sleep se pasan a
+QuotaClient, así que las esperas por cuota no consumen tiempo real.
+
+>>> backend = FakeBackend(writes_per_minute=3)
+>>> ws = FakeSpreadsheet(backend).add_worksheet('Hoja1', rows=10, cols=16)
+>>> ws.append_rows([['1', 'a'], ['2', 'b']])['updates']['updatedRange']
+"'Hoja1'!A1:B2"
+>>> ws.batch_update([{'range': 'B2', 'values': [['c']]}])
+>>> ws.col_values(1), ws.get_all_values()[1]
+(['1', '2'], ['2', 'c'])
+>>> ws.delete_rows(1)
+Traceback (most recent call last):
+...
+gesden_sheets_fake.FakeAPIError: 429 RESOURCE_EXHAUSTED (write)
+>>> backend.sleep(60); ws.delete_rows(1); ws.col_values(1)
+['2']
+>>> backend.stats['write'], backend.stats['read'], backend.stats['throttled']
+(4, 3, 1)
+"""
+
+import collections
+import json
+import re
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# Latencia simulada por petición y por KB transferido (milisegundos)
+DEFAULT_LATENCY_MS = 150.0
+DEFAULT_LATENCY_PER_KB_MS = 0.5
+
+_CELL_RE = re.compile(r'^([A-Z]+)?(\d+)?$')
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers: Dict[str, str] = {}
+
+
+class FakeAPIError(Exception):
+    """Como gspread.exceptions.APIError: lleva .response.status_code y .code."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status} {message}")
+        self.code = status
+        self.response = FakeResponse(status)
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for ch in letters:
+        index = index * 26 + (ord(ch) - 64)
+    return index - 1
+
+
+def _column_letters(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def parse_range(a1: str) -> Tuple[int, int, Optional[int], Optional[int]]:
+    """'A2:P10' -> (fila0, col0, fila1, col1), base 0 e inclusivo; None = hasta el final.
+
+    >>> parse_range("'Hoja1'!B2:C"), parse_range('P5'), parse_range('A:A')
+    ((1, 1, None, 2), (4, 15, 4, 15), (0, 0, None, 0))
+    """
+    a1 = a1.split('!')[-1]
+    start, _, end = a1.partition(':')
+    m0 = _CELL_RE.match(start)
+    m1 = _CELL_RE.match(end or start)
+    if not m0 or not m1:
+        raise ValueError(f"Rango no válido: {a1}")
+    row0 = int(m0.group(2)) - 1 if m0.group(2) else 0
+    col0 = _column_index(m0.group(1)) if m0.group(1) else 0
+    row1 = int(m1.group(2)) - 1 if m1.group(2) else None
+    col1 = _column_index(m1.group(1)) if m1.group(1) else None
+    return row0, col0, row1, col1
+
+
+def _size(obj: Any) -> int:
+    return len(json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+class FakeBackend:
+    """Reloj virtual, cuotas por minuto y contadores compartidos por todas las hojas."""
+
+    def __init__(self, reads_per_minute: Optional[int] = 60, writes_per_minute: Optional[int] = 60,
+                 latency_ms: float = DEFAULT_LATENCY_MS, latency_per_kb_ms: float = DEFAULT_LATENCY_PER_KB_MS):
+        self.quotas = {'read': reads_per_minute, 'write': writes_per_minute}
+        self.latency_ms = latency_ms
+        self.latency_per_kb_ms = latency_per_kb_ms
+        self.clock = 0.0
+        self.recent: Dict[str, Deque[float]] = {'read': collections.deque(), 'write': collections.deque()}
+        self.stats: Dict[str, float] = {}
+        self.calls: Dict[str, int] = collections.Counter()
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.stats = {'read': 0, 'write': 0, 'throttled': 0, 'bytes_out': 0, 'bytes_in': 0, 'api_seconds': 0.0}
+        self.calls = collections.Counter()
+
+    def now(self) -> float:
+        return self.clock
+
+    def sleep(self, seconds: float) -> None:
+        self.clock += max(0.0, seconds)
+
+    def request(self, kind: str, method: str, sent: Any = None) -> None:
+        """Antes de ejecutar una llamada: aplica la cuota y cuenta lo enviado."""
+        recent = self.recent[kind]
+        while recent and recent[0] <= self.clock - 60:
+            recent.popleft()
+        quota = self.quotas[kind]
+        if quota is not None and len(recent) >= quota:
+            self.stats['throttled'] += 1
+            self._advance(0)
+            raise FakeAPIError(429, f"RESOURCE_EXHAUSTED ({kind})")
+        recent.append(self.clock)
+        self.stats[kind] += 1
+        self.calls[method] += 1
+        self._advance(self.record_bytes('bytes_out', sent))
+
+    def respond(self, received: Any) -> Any:
+        """Después de ejecutarla: cuenta lo recibido y avanza el reloj por la descarga."""
+        self._advance(self.record_bytes('bytes_in', received), fixed=False)
+        return received
+
+    def record_bytes(self, key: str, payload: Any) -> int:
+        size = _size(payload) if payload is not None else 0
+        self.stats[key] += size
+        return size
+
+    def _advance(self, size: int, fixed: bool = True) -> None:
+        seconds = ((self.latency_ms if fixed else 0) + size / 1024 * self.latency_per_kb_ms) / 1000
+        self.clock += seconds
+        self.stats['api_seconds'] += seconds
+
+
+class FakeWorksheet:
+    """Pestaña en memoria: lista de filas (listas de cadenas), sin huecos a la derecha."""
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet', sheet_id: int, title: str, rows: int, cols: int):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.values: List[List[str]] = []
+
+    @property
+    def backend(self) -> FakeBackend:
+        return self.spreadsheet.backend
+
+    # --- Lecturas ---
+
+    def get_all_values(self) -> List[List[str]]:
+        self.backend.request('read', 'get_all_values')
+        return self.backend.respond([list(r) for r in self.values])
+
+    def col_values(self, col: int) -> List[str]:
+        self.backend.request('read', 'col_values')
+        values = [r[col - 1] if len(r) >= col else '' for r in self.values]
+        while values and not values[-1]:
+            values.pop()
+        return self.backend.respond(values)
+
+    def row_values(self, row: int) -> List[str]:
+        self.backend.request('read', 'row_values')
+        return self.backend.respond(list(self.values[row - 1]) if len(self.values) >= row else [])
+
+    def get(self, a1: str) -> List[List[str]]:
+        self.backend.request('read', 'get')
+        row0, col0, row1, col1 = parse_range(a1)
+        rows = self.values[row0:None if row1 is None else row1 + 1]
+        return self.backend.respond([r[col0:None if col1 is None else col1 + 1] for r in rows])
+
+    # --- Escrituras ---
+
+    def _write(self, a1: str, values: List[List[Any]]) -> None:
+        row0, col0, _, _ = parse_range(a1)
+        for i, cells in enumerate(values):
+            while len(self.values) <= row0 + i:
+                self.values.append([])
+            row = self.values[row0 + i]
+            if len(row) < col0 + len(cells):
+                row.extend([''] * (col0 + len(cells) - len(row)))
+            row[col0:col0 + len(cells)] = ['' if c is None else str(c) for c in cells]
+        self.row_count = max(self.row_count, len(self.values))
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs: Any) -> None:
+        self.backend.request('write', 'batch_update', data)
+        for item in data:
+            self._write(item['range'], item['values'])
+        self.backend.respond({'totalUpdatedRows': sum(len(item['values']) for item in data)})
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        # gspread 5: update(rango, valores); gspread 6: update(valores, rango)
+        a1, values = (args[0], args[1]) if isinstance(args[0], str) else (args[1], args[0])
+        self.backend.request('write', 'update', values)
+        self._write(a1, values)
+        self.backend.respond({'updatedRange': a1})
+
+    def _append(self, rows: List[List[Any]]) -> Dict[str, Any]:
+        while self.values and not any(self.values[-1]):
+            self.values.pop()
+        first = len(self.values) + 1
+        self._write(f"A{first}", rows)
+        width = max((len(r) for r in rows), default=1)
+        updated = f"'{self.title}'!A{first}:{_column_letters(width - 1)}{first + len(rows) - 1}"
+        return {'updates': {'updatedRange': updated, 'updatedRows': len(rows)}}
+
+    def append_row(self, row: List[Any], **kwargs: Any) -> Dict[str, Any]:
+        self.backend.request('write', 'append_row', row)
+        return self.backend.respond(self._append([row]))
+
+    def append_rows(self, rows: List[List[Any]], **kwargs: Any) -> Dict[str, Any]:
+        self.backend.request('write', 'append_rows', rows)
+        return self.backend.respond(self._append(rows))
+
+    def delete_rows(self, start: int, end: Optional[int] = None) -> None:
+        self.backend.request('write', 'delete_rows')
+        del self.values[start - 1:(end or start)]
+        self.backend.respond(None)
+
+    def batch_clear(self, ranges: List[str]) -> None:
+        self.backend.request('write', 'batch_clear', ranges)
+        for a1 in ranges:
+            row0, col0, row1, col1 = parse_range(a1)
+            for row in self.values[row0:None if row1 is None else row1 + 1]:
+                stop = len(row) if col1 is None else min(len(row), col1 + 1)
+                row[col0:stop] = [''] * max(0, stop - col0)
+        while self.values and not any(self.values[-1]):
+            self.values.pop()
+        self.backend.respond(None)
+
+
+class FakeSpreadsheet:
+    """Libro con varias pestañas; batch_update admite peticiones deleteDimension."""
+
+    def __init__(self, backend: Optional[FakeBackend] = None, spreadsheet_id: str = 'fake'):
+        self.backend = backend or FakeBackend()
+        self.id = spreadsheet_id
+        self.tabs: Dict[str, FakeWorksheet] = {}
+
+    def worksheets(self) -> List[FakeWorksheet]:
+        self.backend.request('read', 'worksheets')
+        self.backend.respond([ws.title for ws in self.tabs.values()])
+        return list(self.tabs.values())
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.backend.request('read', 'worksheet')
+        self.backend.respond(None)
+        if title not in self.tabs:
+            raise KeyError(f"Pestaña no encontrada: {title}")
+        return self.tabs[title]
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        self.backend.request('write', 'add_worksheet')
+        self.backend.respond(None)
+        ws = FakeWorksheet(self, len(self.tabs), title, rows, cols)
+        self.tabs[title] = ws
+        return ws
+
+    def batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.backend.request('write', 'spreadsheet.batch_update', body)
+        by_id = {ws.id: ws for ws in self.tabs.values()}
+        for request in body.get('requests', []):
+            if 'deleteDimension' not in request:
+                raise NotImplementedError(f"Petición no simulada: {list(request)}")
+            rng = request['deleteDimension']['range']
+            del by_id[rng['sheetId']].values[rng['startIndex']:rng['endIndex']]
+        return self.backend.respond({'replies': [{} for _ in body.get('requests', [])]})
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Escritura atómica de instantáneas JSON (appointments_data.json, ...).
+
+El JSON se genera en una sola pasada hacia un fichero temporal del mismo
+directorio, calculando el SHA-256 a la vez que se escribe; después fsync y
+os.replace sobre el destino. Quien lea el fichero (backend-server.js, la app)
+ve siempre la versión anterior completa o la nueva completa, nunca un fichero
+ausente o a medio escribir. No hace falta volver a leerlo para verificarlo:
+el resumen queda en <fichero>.sha256 (formato de sha256sum).
+
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'datos.json')
+>>> digest = write_json_atomic(path, {'appointments': [1, 2, 3]})
+>>> open(path).read()
+'{"appointments":[1,2,3]}'
+>>> verify_snapshot(path), read_checksum(path) == digest
+(True, True)
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Callable, Optional
+
+# Tamaño de los bloques que se codifican, resumen y escriben de una vez
+WRITE_CHUNK = 64 * 1024
+
+
+def _fsync_dir(path: str) -> None:
+    """Persiste la entrada de directorio tras os.replace (no aplica en Windows)."""
+    if os.name == 'nt':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace_bytes(path: str, data: bytes) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def checksum_path(path: str) -> str:
+    return f"{path}.sha256"
+
+
+def write_json_atomic(path: str, obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """Escribe `obj` como JSON compacto en `path` de forma atómica. Devuelve el SHA-256."""
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+    digest = hashlib.sha256()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            pending = []
+            size = 0
+            for chunk in encoder.iterencode(obj):
+                pending.append(chunk)
+                size += len(chunk)
+                if size >= WRITE_CHUNK:
+                    data = ''.join(pending).encode('utf-8')
+                    digest.update(data)
+                    f.write(data)
+                    pending = []
+                    size = 0
+            data = ''.join(pending).encode('utf-8')
+            digest.update(data)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    hexdigest = digest.hexdigest()
+    _replace_bytes(checksum_path(path), f"{hexdigest}  {os.path.basename(path)}\n".encode('utf-8'))
+    _fsync_dir(path)
+    return hexdigest
+
+
+def read_checksum(path: str) -> Optional[str]:
+    try:
+        with open(checksum_path(path), 'r', encoding='utf-8') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def verify_snapshot(path: str) -> bool:
+    """Comprueba el fichero contra su .sha256 (para lectores o diagnóstico, no en la escritura)."""
+    expected = read_checksum(path)
+    if expected is None or not os.path.exists(path):
+        return False
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest() == expected
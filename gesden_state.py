@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Almacén del estado de sincronización (citas conocidas por Registro).
+
+Antes el estado se leía y reescribía entero en cada ejecución
+(last_sync_state.json, appointments_data.json con indent=2). Con el almacén
+SQLite solo se escriben las citas que cambian (upsert) y las que desaparecen
+(delete), dentro de una transacción; las lecturas por Registro usan la clave
+primaria y hay índice por CitMod.
+
+Backends (variable SYNC_STATE_BACKEND):
+  • 'sqlite' (por defecto): <nombre>.db en modo WAL
+  • 'json': <nombre>.json, se reescribe entero al confirmar (comportamiento antiguo)
+
+>>> import os, tempfile
+>>> from gesden_record import Appointment, content_digest
+>>> path = os.path.join(tempfile.mkdtemp(), 'estado')
+>>> a = Appointment(1, '2025-01-02 09:00:00', '2025-01-02 09:00:00', '7', 'Lopez', 'Ana', '',
+...                 '2025-01-10', '10:00', 'Planificada', 'Revision', 'Dr. Mario Rubio', '')
+>>> store = open_state_store(path, 'sqlite')
+>>> with store.transaction():
+...     _ = store.upsert([a], content_digest)
+...     store.set_meta('last_sync', '2025-01-02T09:00:00')
+>>> store.get('1') == a, store.get_digest('1') == a.digest(), len(store)
+(True, True, 1)
+>>> with store.transaction():
+...     _ = store.delete(['1'])
+>>> store.get('1'), store.get_meta('last_sync')
+(None, '2025-01-02T09:00:00')
+>>> store.close()
+"""
+
+import abc
+import contextlib
+import json
+import os
+import sqlite3
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, Optional
+
+from gesden_record import Appointment, json_default
+
+STATE_BACKEND = os.getenv('SYNC_STATE_BACKEND', 'sqlite')
+
+
+class StateStore(abc.ABC):
+    """Estado por Registro: resumen (digest), CitMod y opcionalmente la cita completa.
+
+    Las escrituras se hacen dentro de transaction(); al salir sin error se
+    confirman y con error se descartan.
+    """
+
+    def __init__(self, path: str, keep_records: bool = True):
+        self.path = path
+        self.keep_records = keep_records
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    def get(self, registro: str) -> Optional[Appointment]:
+        ...
+
+    @abc.abstractmethod
+    def get_digest(self, registro: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def digests(self) -> Dict[str, str]:
+        ...
+
+    @abc.abstractmethod
+    def load_all(self) -> Dict[str, Appointment]:
+        """Todas las citas guardadas, de CitMod más reciente a más antigua."""
+
+    @abc.abstractmethod
+    def upsert(self, records: Iterable[Any], digest: Callable[[Any], str]) -> int:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, keys: Iterable[str]) -> int:
+        ...
+
+    @abc.abstractmethod
+    def get_meta(self, key: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def set_meta(self, key: str, value: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def transaction(self) -> ContextManager['StateStore']:
+        """Gestor de contexto (las implementaciones usan @contextlib.contextmanager)."""
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteStateStore(StateStore):
+    """SQLite en modo WAL: upserts por lotes, lecturas por clave primaria e índice por CitMod."""
+
+    def __init__(self, path: str, keep_records: bool = True):
+        super().__init__(path, keep_records)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS records (
+                registro TEXT PRIMARY KEY,
+                cit_mod TEXT,
+                digest TEXT NOT NULL,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS records_cit_mod ON records (cit_mod);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self.conn.commit()
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def get(self, registro: str) -> Optional[Appointment]:
+        row = self.conn.execute('SELECT data FROM records WHERE registro = ?', (str(registro),)).fetchone()
+        return Appointment.from_dict(json.loads(row[0])) if row and row[0] else None
+
+    def get_digest(self, registro: str) -> Optional[str]:
+        row = self.conn.execute('SELECT digest FROM records WHERE registro = ?', (str(registro),)).fetchone()
+        return row[0] if row else None
+
+    def digests(self) -> Dict[str, str]:
+        return dict(self.conn.execute('SELECT registro, digest FROM records'))
+
+    def load_all(self) -> Dict[str, Appointment]:
+        rows = self.conn.execute('SELECT registro, data FROM records WHERE data IS NOT NULL ORDER BY cit_mod DESC')
+        return {registro: Appointment.from_dict(json.loads(data)) for registro, data in rows}
+
+    def upsert(self, records: Iterable[Any], digest: Callable[[Any], str]) -> int:
+        params = [
+            (
+                str(r['Registro']),
+                str(r.get('CitMod') or ''),
+                digest(r),
+                json.dumps(r, ensure_ascii=False, separators=(',', ':'), default=json_default)
+                if self.keep_records else None,
+            )
+            for r in records
+        ]
+        self.conn.executemany(
+            'INSERT INTO records (registro, cit_mod, digest, data) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (registro) DO UPDATE SET '
+            'cit_mod = excluded.cit_mod, digest = excluded.digest, data = excluded.data',
+            params,
+        )
+        return len(params)
+
+    def delete(self, keys: Iterable[str]) -> int:
+        params = [(str(k),) for k in keys]
+        self.conn.executemany('DELETE FROM records WHERE registro = ?', params)
+        return len(params)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self.conn.execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+            (key, value),
+        )
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator['StateStore']:
+        with self.conn:
+            yield self
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class JsonStateStore(StateStore):
+    """Fichero JSON compacto en memoria; se reescribe entero al confirmar."""
+
+    def __init__(self, path: str, keep_records: bool = True):
+        super().__init__(path, keep_records)
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.meta: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.records = state.get('records', {})
+            self.meta = state.get('meta', {})
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, registro: str) -> Optional[Appointment]:
+        entry = self.records.get(str(registro))
+        return Appointment.from_dict(entry['data']) if entry and entry.get('data') else None
+
+    def get_digest(self, registro: str) -> Optional[str]:
+        entry = self.records.get(str(registro))
+        return entry['digest'] if entry else None
+
+    def digests(self) -> Dict[str, str]:
+        return {k: v['digest'] for k, v in self.records.items()}
+
+    def load_all(self) -> Dict[str, Appointment]:
+        entries = sorted(self.records.items(), key=lambda kv: kv[1].get('CitMod', ''), reverse=True)
+        return {k: Appointment.from_dict(v['data']) for k, v in entries if v.get('data')}
+
+    def upsert(self, records: Iterable[Any], digest: Callable[[Any], str]) -> int:
+        count = 0
+        for r in records:
+            self.records[str(r['Registro'])] = {
+                'CitMod': str(r.get('CitMod') or ''),
+                'digest': digest(r),
+                'data': (r.to_dict() if isinstance(r, Appointment) else dict(r)) if self.keep_records else None,
+            }
+            count += 1
+        return count
+
+    def delete(self, keys: Iterable[str]) -> int:
+        count = 0
+        for k in keys:
+            count += self.records.pop(str(k), None) is not None
+        return count
+
+    def get_meta(self, key: str) -> Optional[str]:
+        return self.meta.get(key)
+
+    def set_meta(self, key: str, value: str) -> None:
+        self.meta[key] = value
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator['StateStore']:
+        snapshot = (dict(self.records), dict(self.meta))
+        try:
+            yield self
+        except BaseException:
+            self.records, self.meta = snapshot
+            raise
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'meta': self.meta, 'records': self.records}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+
+STATE_BACKENDS = {'sqlite': (SqliteStateStore, '.db'), 'json': (JsonStateStore, '.json')}
+
+
+def open_state_store(name: str, backend: str = STATE_BACKEND, keep_records: bool = True) -> StateStore:
+    """Abre el almacén `name` (sin extensión) con el backend indicado."""
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Backend de estado desconocido: {backend} (disponibles: {', '.join(STATE_BACKENDS)})")
+    cls, ext = STATE_BACKENDS[backend]
+    return cls(f"{name}{ext}", keep_records=keep_records)
@@ -7,18 +7,39 @@ Exporta citas de Gesden (SQL Server) a Google Sheets.
 - Router de grabado:
   • Si FechaAlta == CitMod → cita NUEVA → insertamos fila completa
   • Si FechaAlta != CitMod → cita MODIFICADA → buscamos por Registro y actualizamos la fila
+    (solo si sus datos cambiaron; InsertedAt se conserva y UpdatedAt marca el cambio)
   • Se eliminan del Sheet las citas que ya no llegan desde SQL
+- La fila de cada Registro sale de la réplica local (gesden_sheets.SheetMirror):
+  solo se descarga la columna A para validarla, no la hoja entera.
+- Las llamadas a la API pasan por gesden_sheets.QuotaWorksheet: respeta las cuotas
+  por minuto y reintenta los 429/5xx en lugar de abortar la sincronización.
+- Reparto opcional en pestañas (SHEETS_SHARD_BY='month' o 'dentist'): una pestaña
+  por mes o por odontólogo más una pestaña índice (SHEETS_INDEX_WORKSHEET); las
+  pestañas se escriben en paralelo (SHEETS_SHARD_WORKERS hilos) con cuotas comunes.
+  Las pestañas acumulan historial: una cita que deja de estar entre las
+  TOP_RECORDS últimas modificadas se queda en su pestaña, y solo se borra de
+  una pestaña cuando pasa a otra (cambio de fecha u odontólogo).
+  Sin SHEETS_SHARD_BY todo va a TARGET_WORKSHEET, que es lo que lee la app.
 """
 
 import sys
 import os
 import datetime
-from typing import Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 import pyodbc
 import gspread
 from google.oauth2.service_account import Credentials
 
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery
+from gesden_rows import RowConverter
+from gesden_sheets import (
+    SHARD_PREFIXES, SHEETS_MIRROR_FILE, QuotaClient, QuotaWorksheet, SheetMirror, quota_worksheet, shard_title,
+    sheet_key, sync_worksheet,
+)
+
 # --- Configuración ---
 DB_SERVER = os.getenv('DB_SERVER', 'GABINETE2\\INFOMED')
 DB_DATABASE = os.getenv('DB_DATABASE', 'GELITE')
@@ -28,60 +49,20 @@ GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID', '1MBDBHQ08XGuf5LxVHCFhHDagIazFkpB
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE', 'service-account-key.json')
 TARGET_WORKSHEET = os.getenv('TARGET_WORKSHEET', 'Hoja1')
 
+# Reparto en pestañas: '' (una sola hoja), 'month' o 'dentist'
+SHEETS_SHARD_BY = os.getenv('SHEETS_SHARD_BY', '')
+SHEETS_INDEX_WORKSHEET = os.getenv('SHEETS_INDEX_WORKSHEET', 'Indice')
+SHEETS_SHARD_WORKERS = int(os.getenv('SHEETS_SHARD_WORKERS', '4'))
+INDEX_HEADERS: List[str] = ['Hoja', 'Citas', 'ActualizadoEn']
+
 HEADERS: List[str] = [
     'Registro', 'CitMod', 'FechaAlta', 'NumPac', 'Apellidos', 'Nombre', 'TelMovil',
     'Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas', 'Duracion',
-    'InsertedAt'
+    'InsertedAt', 'UpdatedAt'
 ]
 
-QUERY = """
-    SELECT TOP 250
-        IdCita AS Registro,
-        HorSitCita AS CitMod,
-        FecAlta AS FechaAlta,
-        NUMPAC AS NumPac,
-        CASE
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1)))
-            ELSE NULL
-        END AS Apellidos,
-        CASE
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto))))
-            ELSE Texto
-        END AS Nombre,
-        Movil AS TelMovil,
-        CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-        CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-        CASE
-            WHEN IdSitC = 0 THEN 'Planificada'
-            WHEN IdSitC = 1 THEN 'Anulada'
-            WHEN IdSitC = 5 THEN 'Finalizada'
-            WHEN IdSitC = 7 THEN 'Confirmada'
-            WHEN IdSitC = 8 THEN 'Cancelada'
-            ELSE 'Desconocido'
-        END AS EstadoCita,
-        CASE
-            WHEN IdIcono = 1 THEN 'Revision'
-            WHEN IdIcono = 2 THEN 'Urgencia'
-            WHEN IdIcono = 9 THEN 'Periodoncia'
-            WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-            WHEN IdIcono = 11 THEN 'Ortodoncia'
-            WHEN IdIcono = 13 THEN 'Primera'
-            WHEN IdIcono = 14 THEN 'Higiene dental'
-            ELSE 'Otros'
-        END AS Tratamiento,
-        CASE
-            WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-            WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-            WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-            WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-            WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-            ELSE 'Odontologo'
-        END AS Odontologo,
-        CONVERT(NVARCHAR(MAX), NOTAS) AS Notas,
-        CAST(CAST(Duracion AS DECIMAL(10, 2)) / 60 AS INT) AS Duracion
-    FROM dbo.DCitas
-    ORDER BY HorSitCita DESC;
-"""
+# Últimas citas modificadas que se reflejan en la hoja
+TOP_RECORDS = 250
 
 
 def log(msg: str) -> None:
@@ -103,33 +84,16 @@ def connect_db() -> Tuple[pyodbc.Connection, pyodbc.Cursor]:
 
 def fetch_rows(cursor: pyodbc.Cursor) -> List[Dict[str, Any]]:
     log("Ejecutando consulta SQL...")
-    cursor.execute(QUERY)
-    rows = cursor.fetchall()
-    columns = [col[0] for col in cursor.description]
+    query = AppointmentQuery(get_catalog(cursor), top=TOP_RECORDS, include_duration=True)
+    query.execute(cursor)
+    rows = query.fetchall(cursor)
     log(f"Consulta ejecutada. Registros: {len(rows)}")
-    out: List[Dict[str, Any]] = []
-    for r in rows:
-        d = {k: v for k, v in zip(columns, r)}
-        norm: Dict[str, str] = {}
-        for k, v in d.items():
-            if isinstance(v, (bytes, bytearray)):
-                norm[k] = v.decode('utf-8', errors='ignore')
-            elif isinstance(v, (datetime.date, datetime.datetime)):
-                if isinstance(v, datetime.datetime):
-                    norm[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    norm[k] = v.strftime('%Y-%m-%d')
-            elif v is None:
-                norm[k] = ''
-            else:
-                norm[k] = str(v)
-        out.append(norm)
-    return out
+    return RowConverter(query.description(cursor), as_text=True).to_dicts(rows)
 
 
 # --- Google Sheets (Service Account) ---
 
-def authorize_sheets() -> gspread.Worksheet:
+def open_spreadsheet() -> gspread.Spreadsheet:
     log("Autenticando con Google Sheets (Service Account)...")
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
@@ -137,19 +101,28 @@ def authorize_sheets() -> gspread.Worksheet:
     ]
     credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
     gc = gspread.authorize(credentials)
-    ss = gc.open_by_key(GOOGLE_SHEET_ID)
+    return gc.open_by_key(GOOGLE_SHEET_ID)
+
+
+def prepare_worksheet(ws: gspread.Worksheet, client: Optional[QuotaClient] = None) -> QuotaWorksheet:
+    # Cabeceras aseguradas
+    ws = quota_worksheet(ws, client)
+    header = ws.row_values(1)
+    if [h.strip() for h in header[:len(HEADERS)]] != HEADERS:
+        log(f"Escribiendo cabeceras en fila 1 de '{ws.title}'")
+        ws.update('A1:P1', [HEADERS])
+    return ws
+
+
+def authorize_sheets() -> QuotaWorksheet:
+    ss = open_spreadsheet()
     try:
         ws = ss.worksheet(TARGET_WORKSHEET)
         log(f"Usando hoja '{TARGET_WORKSHEET}'")
     except gspread.exceptions.WorksheetNotFound:
         log(f"Hoja '{TARGET_WORKSHEET}' no encontrada. Creando...")
         ws = ss.add_worksheet(title=TARGET_WORKSHEET, rows=1000, cols=20)
-    # Cabeceras aseguradas
-    values = ws.get_all_values()
-    if not values or (values and (len(values[0]) == 0 or values[0][0].strip() != 'Registro')):
-        log("Escribiendo cabeceras en fila 1")
-        ws.update('A1:O1', [HEADERS])
-    return ws
+    return prepare_worksheet(ws)
 
 
 def row_from_record(d: Dict[str, str]) -> List[str]:
@@ -168,69 +141,74 @@ def row_from_record(d: Dict[str, str]) -> List[str]:
         d.get('Odontologo', ''),
         d.get('Notas', ''),
         d.get('Duracion', ''),
-        datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),  # InsertedAt
+        '',  # UpdatedAt: solo cuando la cita cambia
     ]
 
 
-def build_index(ws: gspread.Worksheet) -> Dict[str, int]:
-    values = ws.get_all_values()
-    index: Dict[str, int] = {}
-    for i, row in enumerate(values, start=1):
-        if i == 1:
-            continue
-        if not row:
-            continue
-        key = (row[0] if len(row) > 0 else '').strip()
-        if key:
-            index[key] = i
-    return index
-
-
 def upsert_and_prune(ws: gspread.Worksheet, records: List[Dict[str, str]]) -> None:
-    existing_index = build_index(ws)
-    registros_actuales_sql = set()
-
-    updates: List[Tuple[str, List[List[str]]]] = []  # (range, values)
-    appends: List[List[str]] = []
-
+    sync_worksheet(ws, records, row_from_record)
+
+
+def sync_sharded(ss: gspread.Spreadsheet, records: List[Dict[str, str]],
+                 by: str = SHEETS_SHARD_BY, workers: int = SHEETS_SHARD_WORKERS) -> Dict[str, int]:
+    """Reparte las citas en una pestaña por mes u odontólogo y actualiza la pestaña índice.
+
+    `records` son solo las últimas citas modificadas, así que las pestañas no
+    se podan: conservan las citas que ya no llegan (historial) y de cada una se
+    borran únicamente las citas de `records` que ahora van en otra pestaña.
+    Las pestañas sin citas en `records` solo se abren si su réplica local
+    contiene alguna de esas citas. Cada pestaña se sincroniza en su propio hilo.
+    Devuelve las filas de cada pestaña del reparto.
+    """
+    groups: Dict[str, List[Dict[str, str]]] = {}
+    owner: Dict[str, str] = {}
     for d in records:
-        registro = d.get('Registro', '').strip()
-        if not registro:
-            continue
-        registros_actuales_sql.add(registro)
-
-        citmod = d.get('CitMod', '')
-        fecha_alta = d.get('FechaAlta', '')
-        is_new = citmod == fecha_alta
-
-        new_row = row_from_record(d)
-
-        if registro in existing_index:
-            row_number = existing_index[registro]
-            rng = f"A{row_number}:O{row_number}"
-            updates.append((rng, [new_row]))
-            log(f"UPDATE ({'NUEVA' if is_new else 'MOD'}) Registro {registro} -> fila {row_number}")
-        else:
-            appends.append(new_row)
-            log(f"APPEND ({'NUEVA' if is_new else 'MOD'}) Registro {registro}")
-
-    if updates:
-        log(f"Ejecutando {len(updates)} updates en lote...")
-        ws.batch_update([{ 'range': r, 'values': v } for r, v in updates])
-
-    for row in appends:
-        ws.append_row(row, value_input_option='RAW')
-    if appends:
-        log(f"Ejecutados {len(appends)} appends")
-
-    # Borrado de filas que ya no aparecen
-    existing_index_after = build_index(ws)
-    registros_sheet = set(existing_index_after.keys())
-    to_delete = sorted([existing_index_after[r] for r in registros_sheet - registros_actuales_sql], reverse=True)
-    if to_delete:
-        log(f"Eliminando {len(to_delete)} filas obsoletas...")
-        for row_num in to_delete:
-            ws.delete_rows(row_num)
+        title = shard_title(d, by)
+        groups.setdefault(title, []).append(d)
+        owner[d.get('Registro', '').strip()] = title
+    tabs = {w.title: w for w in ss.worksheets()}
+    shard_tabs = [title for title in tabs if title.startswith(SHARD_PREFIXES[by])]
+
+    # Citas que cambiaron de pestaña, según la réplica local (sin llamadas a la API)
+    counts: Dict[str, int] = {}
+    moved: Dict[str, List[str]] = {}
+    for title in shard_tabs:
+        mirror = SheetMirror.load(SHEETS_MIRROR_FILE, sheet_key(tabs[title]))
+        moved[title] = [r for r in mirror.rows if owner.get(r, title) != title]
+        counts[title] = len(mirror.rows)
+    pending = sorted(set(groups) | {title for title, keys in moved.items() if keys})
+    log(f"Reparto por '{by}': {len(pending)} de {len(set(shard_tabs) | set(groups))} pestañas con cambios, "
+        f"{workers} hilos")
+
+    # Un único cliente: las cuotas por minuto son de la cuenta, no de cada pestaña
+    client = QuotaClient()
+
+    def sync_tab(title: str) -> Tuple[str, int]:
+        ws = tabs.get(title)
+        if ws is None:
+            log(f"Pestaña '{title}' no encontrada. Creando...")
+            ws = ss.add_worksheet(title=title, rows=1000, cols=20)
+        rows = sync_worksheet(prepare_worksheet(ws, client), groups.get(title, []), row_from_record,
+                              prune=False, remove=owner)
+        return title, rows
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        counts.update(pool.map(sync_tab, pending))
+
+    # Índice: una fila por pestaña con su número de citas
+    index_ws = tabs.get(SHEETS_INDEX_WORKSHEET)
+    if index_ws is None:
+        index_ws = ss.add_worksheet(title=SHEETS_INDEX_WORKSHEET, rows=100, cols=len(INDEX_HEADERS))
+    index_ws = quota_worksheet(index_ws, client)
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    values = [INDEX_HEADERS] + [[title, str(n), now] for title, n in sorted(counts.items()) if n]
+    index_ws.batch_clear([f"A{len(values) + 1}:C"])
+    index_ws.batch_update([{'range': f"A1:C{len(values)}", 'values': values}])
+    index_ws.flush()
+    log(f"Índice '{SHEETS_INDEX_WORKSHEET}' actualizado; peticiones a la API: "
+        f"{client.stats['read']} lecturas, {client.stats['write']} escrituras, {client.stats['retries']} reintentos")
+    return counts
 
 
 def main() -> int:
@@ -244,15 +222,18 @@ def main() -> int:
             log("No hay registros para procesar.")
         else:
             log(f"Procesando {len(records)} registros...")
-            ws = authorize_sheets()
-            upsert_and_prune(ws, records)
+            if SHEETS_SHARD_BY:
+                sync_sharded(open_spreadsheet(), records)
+            else:
+                ws = authorize_sheets()
+                upsert_and_prune(ws, records)
             log("Sincronización completada correctamente.")
         return 0
     except pyodbc.Error as ex:
         log(f"ERROR BD: {ex}")
         return 1
     except gspread.exceptions.APIError as ex:
-        log(f"ERROR Google Sheets API: {ex}")
+        log(f"ERROR Google Sheets API (tras reintentos): {ex}")
         return 2
     except Exception as ex:
         log(f"ERROR no controlado: {ex}")
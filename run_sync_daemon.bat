@@ -0,0 +1,28 @@
+@echo off
+REM Sincronización SQL Server -> App Clínica en modo demonio
+REM Sustituye a la tarea programada cada 5 minutos: un único proceso mantiene
+REM la conexión SQL abierta y sincroniza cada SYNC_INTERVAL_SECONDS segundos.
+REM Configurar en el Programador de Tareas con desencadenador "Al iniciar el sistema".
+
+cd /d "C:\Users\Clinica\Streaming de Google Drive\App Gestion"
+
+set SYNC_INTERVAL_SECONDS=30
+set SYNC_SINKS=app,backend
+
+if exist "venv\Scripts\activate.bat" (
+    echo Activando entorno virtual...
+    call venv\Scripts\activate.bat
+)
+
+echo ========================================
+echo Demonio de sincronización - intervalo %SYNC_INTERVAL_SECONDS%s
+echo Sinks: %SYNC_SINKS%
+echo ========================================
+
+python sync_engine.py --daemon --interval %SYNC_INTERVAL_SECONDS% --sinks %SYNC_SINKS%
+
+if %ERRORLEVEL% NEQ 0 (
+    echo %date% %time% - Demonio terminado con error (código %ERRORLEVEL%) >> sync_errors.log
+)
+
+exit /b %ERRORLEVEL%
@@ -5,6 +5,11 @@ import os
 from datetime import datetime
 import logging
 
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery, rolling_window_filter
+from gesden_record import Appointment, appointments_from_rows, json_default
+from gesden_rows import RowConverter
+
 # Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
@@ -45,74 +50,17 @@ def execute_query(conn):
     """Ejecutar la consulta SQL y obtener los datos"""
     cursor = conn.cursor()
     
-    query = """
-    SELECT TOP 100
-    [IdCita] AS Registro,
-    [HorSitCita] AS CitMod,
-    FecAlta AS FechaAlta,
-    [NUMPAC] AS NumPac,
-    CASE 
-        WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1)))
-        ELSE NULL
-    END AS Apellidos,
-    CASE 
-        WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto))))
-        ELSE Texto
-    END AS Nombre,
-    Movil AS TelMovil,
-    CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-    CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-    CASE 
-        WHEN IdSitC = 0 THEN 'Planificada'
-        WHEN IdSitC = 1 THEN 'Anulada'
-        WHEN IdSitC = 5 THEN 'Finalizada'
-        WHEN IdSitC = 7 THEN 'Confirmada'
-        WHEN IdSitC = 8 THEN 'Cancelada'
-        ELSE 'Desconocido'
-    END AS EstadoCita,
-    CASE 
-        WHEN IdIcono = 1 THEN 'Revision'
-        WHEN IdIcono = 2 THEN 'Urgencia'
-        WHEN IdIcono = 9 THEN 'Periodoncia'
-        WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-        WHEN IdIcono = 11 THEN 'Ortodoncia'
-        WHEN IdIcono = 13 THEN 'Primera'
-        WHEN IdIcono = 14 THEN 'Higiene dental'
-        ELSE 'Otros'
-    END AS Tratamiento,
-    CASE 
-        WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-        WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-        WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-        WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-        WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-        ELSE 'Odontologo'
-    END AS Odontologo,
-    NOTAS AS Notas
-    FROM dbo.DCitas
-    WHERE Fecha >= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) - 30, 0)
-    ORDER BY HorSitCita DESC;
-    """
+    window_filter, params = rolling_window_filter(30)
+    query = AppointmentQuery(get_catalog(cursor), top=100, where=window_filter, params=params)
     
     log_message("Ejecutando consulta SQL...")
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    columns = [column[0] for column in cursor.description]
+    query.execute(cursor)
+    rows = query.fetchall(cursor)
     log_message(f"Consulta ejecutada. Se encontraron {len(rows)} registros.")
     
-    # Convertir a lista de diccionarios
-    data = []
-    for row in rows:
-        row_dict = {}
-        for i, column in enumerate(columns):
-            value = row[i]
-            # Convertir datetime a string si es necesario
-            if hasattr(value, 'strftime'):
-                value = value.strftime('%Y-%m-%d %H:%M:%S')
-            row_dict[column] = value
-        data.append(row_dict)
-    
-    return data
+    # Convertir a registros Appointment (datetime a string, NULL se conserva)
+    converter = RowConverter(query.description(cursor), null=None)
+    return appointments_from_rows(converter.columns, converter.to_tuples(rows))
 
 def process_appointments(current_data, previous_data=None):
     """Procesar citas para identificar nuevas y actualizadas"""
@@ -162,7 +110,7 @@ def save_data(data, filename):
                 'timestamp': datetime.now().isoformat(),
                 'appointments': data,
                 'total_count': len(data)
-            }, f, ensure_ascii=False, indent=2)
+            }, f, ensure_ascii=False, indent=2, default=json_default)
         log_message(f"Datos guardados en {filename}")
     except Exception as e:
         log_message(f"Error guardando datos: {e}")
@@ -176,7 +124,7 @@ def load_previous_data(filename):
                 data = json.load(f)
                 appointments = data.get('appointments', [])
                 # Convertir a diccionario indexado por Registro
-                return {apt['Registro']: apt for apt in appointments}
+                return {apt['Registro']: Appointment.from_dict(apt) for apt in appointments}
         return {}
     except Exception as e:
         log_message(f"Error cargando datos previos: {e}")
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-"""
+r"""
 Script robusto para sincronización de citas desde SQL Server
 Ejecutar cada 5 minutos mediante el Programador de Tareas de Windows
 
@@ -24,9 +24,21 @@ import sys
 from datetime import datetime, timedelta
 import logging
 import traceback
-import requests
 from pathlib import Path
 
+from gesden_backend import BackendClient
+
+from gesden_catalog import get_catalog
+from gesden_cdc import CHANGE_SOURCES, CdcPoller
+from gesden_journal import ChangeJournal, appointment_events
+from gesden_query import AppointmentQuery, rolling_window_filter
+from gesden_record import (
+    Appointment, appointments_from_rows, content_digest, field_diff, json_default
+)
+from gesden_rows import RowConverter
+from gesden_snapshot import write_json_atomic
+from gesden_state import open_state_store
+
 # Configuración
 DB_SERVER = 'GABINETE2\\INFOMED'
 DB_DATABASE = 'GELITE'
@@ -36,6 +48,27 @@ BACKEND_URL = 'http://localhost:3001'
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # segundos
 
+# Sincronización incremental por marca de agua (HorSitCita / IdCita)
+WATERMARK_FILE = 'sync_watermark.json'
+INCREMENTAL_SYNC = True
+FULL_SYNC_INTERVAL_HOURS = 24  # Lectura completa periódica para detectar borrados
+MAX_RECORDS = 300
+DAYS_BACK = 90
+DAYS_FORWARD = 365
+
+# Origen de los cambios en modo incremental: 'watermark' (HorSitCita),
+# 'ct' (Change Tracking) o 'rowversion' (ver gesden_cdc.py)
+CHANGE_SOURCE = os.getenv('SYNC_CHANGE_SOURCE', 'watermark')
+
+# Estado de la sincronización (citas por Registro), ver gesden_state.py
+STATE_NAME = 'sync_state'
+
+# Diario de cambios para consumidores incrementales, ver gesden_journal.py
+JOURNAL_ENABLED = os.getenv('SYNC_JOURNAL', '1') != '0'
+
+# Campos cuyo cambio cuenta como actualización de una cita
+CHANGE_FIELDS = ('Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas', 'TelMovil')
+
 # Configurar logging
 def setup_logging():
     """Configurar sistema de logging"""
@@ -71,20 +104,18 @@ def log_message(message, level='info'):
     
     print(formatted_message)
 
+_backend_client = None
+
+def backend_client():
+    """Cliente del backend con conexión persistente (se reutiliza entre envíos)"""
+    global _backend_client
+    if _backend_client is None:
+        _backend_client = BackendClient(BACKEND_URL, log=log_message)
+    return _backend_client
+
 def test_backend_connection():
     """Probar conexión con el backend API"""
-    try:
-        response = requests.get(f"{BACKEND_URL}/api/health", timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            log_message(f"✅ Backend API disponible - Estado: {data.get('status', 'Unknown')}")
-            return True
-        else:
-            log_message(f"⚠️ Backend API respondió con código: {response.status_code}", 'warning')
-            return False
-    except requests.exceptions.RequestException as e:
-        log_message(f"❌ Backend API no disponible: {e}", 'warning')
-        return False
+    return backend_client().health()
 
 def connect_to_sql():
     """Conectar a SQL Server con reintentos"""
@@ -114,91 +145,200 @@ def connect_to_sql():
                 log_message("❌ Se agotaron todos los intentos de conexión", 'error')
                 raise
 
-def execute_query(conn):
-    """Ejecutar la consulta SQL y obtener los datos"""
+def execute_query(conn, since=None):
+    """Ejecutar la consulta SQL y obtener los datos
+
+    Si se indica `since` (CitMod de la marca de agua), solo se leen las citas
+    modificadas desde ese instante: todas, sin TOP, porque la marca de agua
+    avanza hasta la última fila leída y lo que un TOP dejara fuera no se
+    volvería a leer hasta la siguiente lectura completa. El límite de
+    MAX_RECORDS se aplica después, en merge_incremental.
+    """
     cursor = conn.cursor()
     
-    # Consulta SQL optimizada
-    query = """
-    SELECT TOP 300
-    [IdCita] AS Registro,
-    [HorSitCita] AS CitMod,
-    FecAlta AS FechaAlta,
-    [NUMPAC] AS NumPac,
-    CASE 
-        WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1)))
-        ELSE NULL
-    END AS Apellidos,
-    CASE 
-        WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto))))
-        ELSE Texto
-    END AS Nombre,
-    Movil AS TelMovil,
-    CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-    CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-    CASE 
-        WHEN IdSitC = 0 THEN 'Planificada'
-        WHEN IdSitC = 1 THEN 'Anulada'
-        WHEN IdSitC = 5 THEN 'Finalizada'
-        WHEN IdSitC = 7 THEN 'Confirmada'
-        WHEN IdSitC = 8 THEN 'Cancelada'
-        ELSE 'Desconocido'
-    END AS EstadoCita,
-    CASE 
-        WHEN IdIcono = 1 THEN 'Revision'
-        WHEN IdIcono = 2 THEN 'Urgencia'
-        WHEN IdIcono = 9 THEN 'Periodoncia'
-        WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-        WHEN IdIcono = 11 THEN 'Ortodoncia'
-        WHEN IdIcono = 13 THEN 'Primera'
-        WHEN IdIcono = 14 THEN 'Higiene dental'
-        ELSE 'Otros'
-    END AS Tratamiento,
-    CASE 
-        WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-        WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-        WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-        WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-        WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-        ELSE 'Odontologo'
-    END AS Odontologo,
-    NOTAS AS Notas
-    FROM dbo.DCitas
-    WHERE Fecha >= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) - 90, 0)
-    AND Fecha <= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) + 365, 0)
-    ORDER BY HorSitCita DESC;
-    """
+    if since:
+        # Sin filtro de ventana: una cita modificada cuya nueva Fecha queda fuera
+        # debe llegar igualmente, para que merge_incremental la saque de la
+        # instantánea según su Fecha actual (lápida 'out_of_window').
+        # CitMod se guarda truncado a segundos: con >= se vuelve a leer el
+        # segundo frontera, y la fusión por Registro hace que sea inocuo.
+        # Se pasa como datetime para no depender del DATEFORMAT del login.
+        filters = ['HorSitCita >= ?']
+        params = [datetime.strptime(since, '%Y-%m-%d %H:%M:%S')]
+    else:
+        window_filter, params = rolling_window_filter(DAYS_BACK, DAYS_FORWARD)
+        filters = [window_filter]
+    
+    # Columnas en crudo; la traducción de estados, tratamientos y odontólogos
+    # se hace en Python con el catálogo (ver gesden_catalog.py). Duracion va
+    # incluida, como en sync_engine.py: los dos comparten sync_state y con
+    # columnas distintas cada alternancia reescribiría todas las citas
+    query = AppointmentQuery(
+        get_catalog(cursor),
+        top=None if since else MAX_RECORDS,
+        where=' AND '.join(filters),
+        params=params,
+        include_duration=True,
+    )
     
-    log_message("📊 Ejecutando consulta SQL...")
+    if since:
+        log_message(f"📊 Ejecutando consulta SQL incremental (CitMod >= {since})...")
+    else:
+        log_message("📊 Ejecutando consulta SQL...")
     start_time = time.time()
     
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    columns = [column[0] for column in cursor.description]
+    query.execute(cursor)
+    rows = query.fetchall(cursor)
     
     execution_time = time.time() - start_time
     log_message(f"✅ Consulta ejecutada en {execution_time:.2f}s. Se encontraron {len(rows)} registros.")
     
-    # Convertir a lista de diccionarios
-    data = []
-    for row in rows:
-        row_dict = {}
-        for i, column in enumerate(columns):
-            value = row[i]
-            # Convertir datetime a string si es necesario
-            if hasattr(value, 'strftime'):
-                value = value.strftime('%Y-%m-%d %H:%M:%S')
-            elif value is None:
-                value = ''
-            row_dict[column] = value
-        data.append(row_dict)
+    return rows_to_records(query.description(cursor), rows)
+
+def rows_to_records(description, rows):
+    """Convertir filas a registros Appointment
+    
+    `description` son pares (columna, tipo): la conversión de cada columna
+    (datetime a texto, NULL a '') se decide una vez y no celda a celda.
+    Los registros se leen como diccionarios; el JSON se genera al guardar.
+    """
+    converter = RowConverter(description)
+    return appointments_from_rows(converter.columns, converter.to_tuples(rows))
+
+def load_watermark(filename):
+    """Cargar la marca de agua de la última sincronización"""
+    try:
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        log_message(f"⚠️ Error cargando marca de agua: {e}", 'warning')
+    return {}
+
+def save_watermark(filename, data, last_full_sync):
+    """Guardar la mayor pareja (CitMod, Registro) vista"""
+    if not data:
+        return
+    top = max(data, key=lambda apt: (str(apt['CitMod']), str(apt['Registro'])))
+    watermark = {
+        'CitMod': str(top['CitMod']),
+        'Registro': str(top['Registro']),
+        'last_full_sync': last_full_sync,
+        'updated_at': datetime.now().isoformat()
+    }
+    try:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(watermark, f, ensure_ascii=False, indent=2)
+        log_message(f"🔖 Marca de agua: CitMod={watermark['CitMod']} Registro={watermark['Registro']}")
+    except Exception as e:
+        log_message(f"⚠️ Error guardando marca de agua: {e}", 'warning')
+
+def needs_full_sync(watermark, previous_data, force_full=False):
+    """Decidir si hay que leer la ventana completa en lugar del delta"""
+    if force_full or not INCREMENTAL_SYNC:
+        return True
+    if not previous_data or not watermark.get('CitMod') or not watermark.get('last_full_sync'):
+        return True
+    try:
+        last_full = datetime.fromisoformat(watermark['last_full_sync'])
+    except ValueError:
+        return True
+    return datetime.now() - last_full >= timedelta(hours=FULL_SYNC_INTERVAL_HOURS)
+
+def merge_incremental(previous_data, delta, deleted=()):
+    """Fusionar el delta sobre la instantánea previa respetando la ventana de la consulta
+    
+    La ventana se aplica aquí, sobre la Fecha actual de cada cita fusionada: el
+    delta llega sin filtro de ventana, así que una cita movida fuera de la
+    ventana sustituye a su versión previa y se descarta.
+    """
+    merged = dict(previous_data)
+    for appointment in delta:
+        merged[str(appointment['Registro'])] = appointment
+    for registro in deleted:
+        merged.pop(str(registro), None)
+    
+    today = datetime.now().date()
+    window_start = (today - timedelta(days=DAYS_BACK)).strftime('%Y-%m-%d')
+    window_end = (today + timedelta(days=DAYS_FORWARD)).strftime('%Y-%m-%d')
+    in_window = [
+        apt for apt in merged.values()
+        if window_start <= str(apt.get('Fecha', '')) <= window_end
+    ]
+    in_window.sort(key=lambda apt: str(apt['CitMod']), reverse=True)
+    return in_window[:MAX_RECORDS]
+
+def change_digest(appointment):
+    """Resumen de los CHANGE_FIELDS de una cita"""
+    return content_digest(appointment, CHANGE_FIELDS)
+
+def existing_keys(conn, keys):
+    """Registros de `keys` que siguen existiendo en dbo.DCitas"""
+    found = set()
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(keys), 1000):  # Límite de parámetros de SQL Server: 2100
+            chunk = keys[i:i + 1000]
+            cursor.execute(
+                f"SELECT IdCita FROM dbo.DCitas WHERE IdCita IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            found.update(str(row[0]) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+    return found
+
+def detect_tombstones(conn, previous_data, current_data, deleted=()):
+    """Generar lápidas para las citas de la instantánea previa que ya no están
+    
+    Cada lápida indica el motivo:
+      • 'deleted': la cita ya no existe en dbo.DCitas (o CDC informó del borrado)
+      • 'out_of_window': sigue existiendo pero salió de la ventana de fechas o del TOP
+    Solo se consulta la existencia de las claves desaparecidas, no la ventana completa.
+    """
+    current_keys = {str(apt['Registro']) for apt in current_data}
+    gone = [registro for registro in previous_data if registro not in current_keys]
+    if not gone:
+        return []
+    
+    deleted = {str(registro) for registro in deleted}
+    to_check = [registro for registro in gone if registro not in deleted]
+    still_existing = set(to_check)
+    if to_check:
+        try:
+            still_existing = existing_keys(conn, [int(registro) for registro in to_check])
+        except Exception as e:
+            # Sin confirmación no se anuncia un borrado
+            log_message(f"⚠️ No se pudo comprobar la existencia de {len(to_check)} citas: {e}", 'warning')
     
-    return data
+    detected_at = datetime.now().isoformat()
+    tombstones = []
+    for registro in gone:
+        previous = previous_data[registro]
+        reason = 'out_of_window' if registro in still_existing else 'deleted'
+        tombstones.append({
+            'Registro': previous['Registro'],
+            'reason': reason,
+            'CitMod': previous.get('CitMod', ''),
+            'Fecha': previous.get('Fecha', ''),
+            'detected_at': detected_at
+        })
+        if reason == 'deleted':
+            log_message(f"🗑️ Cita eliminada: {registro} - {previous.get('Nombre', '')} {previous.get('Apellidos', '')}")
+    return tombstones
 
-def process_appointments(current_data, previous_data=None):
-    """Procesar citas para identificar nuevas y actualizadas"""
+def process_appointments(current_data, previous_data=None, previous_digests=None):
+    """Procesar citas para identificar nuevas y actualizadas
+    
+    Una cita conocida se considera actualizada si cambia el resumen de sus
+    CHANGE_FIELDS: una búsqueda y una comparación por cita. Si no se indica
+    `previous_digests` (Registro -> resumen) se calcula desde `previous_data`,
+    que aquí hace falta de todos modos para la fusión incremental.
+    """
     if previous_data is None:
         previous_data = {}
+    if previous_digests is None:
+        previous_digests = {k: change_digest(apt) for k, apt in previous_data.items()}
     
     new_appointments = []
     updated_appointments = []
@@ -210,43 +350,41 @@ def process_appointments(current_data, previous_data=None):
         
         # Si FechaAlta == CitMod, es una cita nueva
         if fecha_alta == cit_mod:
-            if registro not in previous_data:
+            if registro not in previous_digests:
                 new_appointments.append(appointment)
                 log_message(f"🆕 Nueva cita: {registro} - {appointment['Nombre']} {appointment['Apellidos']} - {appointment['Fecha']} {appointment['Hora']}")
         else:
             # Si FechaAlta != CitMod, es una actualización
-            if registro in previous_data:
+            if registro in previous_digests:
                 # Verificar si hay cambios reales
-                if has_changes(previous_data[registro], appointment):
+                if previous_digests[registro] != change_digest(appointment):
                     updated_appointments.append(appointment)
                     log_message(f"🔄 Cita actualizada: {registro} - {appointment['Nombre']} {appointment['Apellidos']} - {appointment['Fecha']} {appointment['Hora']}")
+                    log_changes(previous_data.get(registro), appointment)
             else:
                 # Tratar como nueva si no la tenemos en caché
                 new_appointments.append(appointment)
     
     return new_appointments, updated_appointments
 
-def has_changes(old_appointment, new_appointment):
-    """Verificar si hay cambios en campos importantes"""
-    fields_to_compare = ['Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 'Odontologo', 'Notas', 'TelMovil']
-    
-    for field in fields_to_compare:
-        old_value = str(old_appointment.get(field, '')).strip()
-        new_value = str(new_appointment.get(field, '')).strip()
-        if old_value != new_value:
-            log_message(f"   📝 Campo '{field}' cambió: '{old_value}' -> '{new_value}'")
-            return True
-    return False
+def log_changes(old_appointment, new_appointment):
+    """Registrar en el log los campos cambiados (solo para citas cuyo resumen cambió)"""
+    if old_appointment is None:
+        return
+    for field, old_value, new_value in field_diff(old_appointment, new_appointment, CHANGE_FIELDS):
+        log_message(f"   📝 Campo '{field}' cambió: '{old_value}' -> '{new_value}'")
 
-def save_data(data, filename):
-    """Guardar datos en archivo JSON con backup"""
+def save_data(data, filename, tombstones=None):
+    """Guardar datos en archivo JSON de forma atómica
+    
+    Se escribe en una pasada a un temporal, con fsync y os.replace: si algo
+    falla, el archivo anterior queda intacto y los lectores nunca ven un
+    archivo ausente o incompleto. El SHA-256 queda en <archivo>.sha256.
+    
+    Si se indican `tombstones` se incluyen para que la app aplique las bajas
+    sin comparar la instantánea completa.
+    """
     try:
-        # Crear backup del archivo anterior si existe
-        if os.path.exists(filename):
-            backup_filename = f"{filename}.backup"
-            os.rename(filename, backup_filename)
-            log_message(f"📁 Backup creado: {backup_filename}")
-        
         # Preparar datos para guardar
         output_data = {
             'timestamp': datetime.now().isoformat(),
@@ -259,30 +397,52 @@ def save_data(data, filename):
                 'python_version': sys.version
             }
         }
+        if tombstones is not None:
+            output_data['tombstones'] = tombstones
         
-        # Guardar archivo principal
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=2)
-        
-        log_message(f"💾 Datos guardados en {filename}")
-        
-        # Verificar integridad del archivo
-        with open(filename, 'r', encoding='utf-8') as f:
-            test_data = json.load(f)
-            if len(test_data.get('appointments', [])) != len(data):
-                raise ValueError("Error de integridad en el archivo guardado")
-        
-        log_message("✅ Integridad del archivo verificada")
+        checksum = write_json_atomic(filename, output_data, default=json_default)
+        log_message(f"💾 Datos guardados en {filename} (sha256 {checksum[:12]})")
         
     except Exception as e:
         log_message(f"❌ Error guardando datos: {e}", 'error')
-        # Restaurar backup si existe
-        backup_filename = f"{filename}.backup"
-        if os.path.exists(backup_filename):
-            os.rename(backup_filename, filename)
-            log_message("🔄 Archivo restaurado desde backup")
         raise
 
+def save_state(store, previous_data, current_data, rewrite=False):
+    """Guardar en el almacén solo las citas nuevas o modificadas y borrar las que salen"""
+    current_keys = set()
+    changed = []
+    for appointment in current_data:
+        registro = str(appointment['Registro'])
+        current_keys.add(registro)
+        if rewrite or previous_data.get(registro) != appointment:
+            changed.append(appointment)
+    removed = [registro for registro in previous_data if registro not in current_keys]
+    with store.transaction():
+        store.upsert(changed, change_digest)
+        store.delete(removed)
+        store.set_meta('last_sync', datetime.now().isoformat())
+    log_message(f"🗄️ Estado guardado: {len(changed)} citas escritas, {len(removed)} eliminadas")
+
+def apply_changes(conn, store, previous_data, current_data, deleted=(), migrate_state=False):
+    """Lápidas, citas nuevas/actualizadas, instantánea JSON, diario y estado de un ciclo
+    
+    Lo usan main() y el sink 'app' de sync_engine.py, de modo que el diario y
+    el almacén reciben lo mismo con cualquiera de los dos ejecutores.
+    El diario se escribe antes que el estado: si se corta entre ambos, la
+    siguiente ejecución repite los eventos (entrega al menos una vez) en
+    lugar de perderlos. Devuelve (nuevas, actualizadas, lápidas).
+    """
+    tombstones = detect_tombstones(conn, previous_data, current_data, deleted)
+    new_appointments, updated_appointments = process_appointments(
+        current_data, previous_data, None if migrate_state else store.digests())
+    save_data(current_data, OUTPUT_FILE, tombstones)
+    if JOURNAL_ENABLED:
+        journal = ChangeJournal()
+        count = journal.append(appointment_events(new_appointments, updated_appointments, tombstones))
+        log_message(f"📓 Diario: {count} eventos (última secuencia {journal.last_seq})")
+    save_state(store, previous_data, current_data, rewrite=migrate_state)
+    return new_appointments, updated_appointments, tombstones
+
 def load_previous_data(filename):
     """Cargar datos previos del archivo JSON"""
     try:
@@ -291,7 +451,7 @@ def load_previous_data(filename):
                 data = json.load(f)
                 appointments = data.get('appointments', [])
                 # Convertir a diccionario indexado por Registro
-                previous_data = {str(apt['Registro']): apt for apt in appointments}
+                previous_data = {str(apt['Registro']): Appointment.from_dict(apt) for apt in appointments}
                 log_message(f"📂 Datos previos cargados: {len(previous_data)} registros")
                 return previous_data
         else:
@@ -301,41 +461,29 @@ def load_previous_data(filename):
         log_message(f"⚠️ Error cargando datos previos: {e}", 'warning')
         return {}
 
-def send_to_backend(data):
-    """Enviar datos al backend API si está disponible"""
+def send_to_backend(data, tombstones=None):
+    """Enviar datos al backend API si está disponible (gzip, NDJSON por trozos si son muchos)"""
     try:
-        if not test_backend_connection():
-            return False
-        
-        # Enviar datos al backend
-        response = requests.post(
-            f"{BACKEND_URL}/api/sync-data",
-            json={'appointments': data},
-            timeout=30
-        )
-        
-        if response.status_code == 200:
+        if backend_client().push_appointments(data, tombstones):
             log_message("✅ Datos enviados al backend exitosamente")
             return True
-        else:
-            log_message(f"⚠️ Backend respondió con código: {response.status_code}", 'warning')
-            return False
+        return False
             
     except Exception as e:
         log_message(f"⚠️ Error enviando datos al backend: {e}", 'warning')
         return False
 
 def cleanup_old_files():
-    """Limpiar archivos antiguos de backup y logs"""
+    """Limpiar temporales huérfanos y rotar el log"""
     try:
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(days=7)  # Mantener archivos de 7 días
-        
-        # Limpiar backups antiguos
-        for file in Path('.').glob('*.backup'):
+        # Temporales de escrituras atómicas interrumpidas (<archivo>.<pid>.tmp,
+        # ver gesden_snapshot.py). Solo los de más de una hora, para no tocar
+        # uno que otro proceso (p. ej. sync_engine.py --daemon) esté escribiendo.
+        cutoff_time = datetime.now() - timedelta(hours=1)
+        for file in Path('.').glob('*.tmp'):
             if file.stat().st_mtime < cutoff_time.timestamp():
                 file.unlink()
-                log_message(f"🗑️ Backup antiguo eliminado: {file}")
+                log_message(f"🗑️ Temporal huérfano eliminado: {file}")
         
         # Rotar log si es muy grande (>10MB)
         if os.path.exists(LOG_FILE):
@@ -346,7 +494,7 @@ def cleanup_old_files():
     except Exception as e:
         log_message(f"⚠️ Error en limpieza de archivos: {e}", 'warning')
 
-def main():
+def main(force_full=False):
     """Función principal"""
     start_time = datetime.now()
     
@@ -361,25 +509,57 @@ def main():
         # Limpiar archivos antiguos
         cleanup_old_files()
         
-        # Cargar datos previos
-        previous_data = load_previous_data(OUTPUT_FILE)
+        # Cargar datos previos (almacén de estado; la primera vez, el JSON) y marca de agua
+        store = open_state_store(STATE_NAME)
+        migrate_state = len(store) == 0
+        if migrate_state:
+            previous_data = load_previous_data(OUTPUT_FILE)
+        else:
+            previous_data = store.load_all()
+            log_message(f"📂 Datos previos cargados del almacén: {len(previous_data)} registros")
+        watermark = load_watermark(WATERMARK_FILE)
+        full_sync = needs_full_sync(watermark, previous_data, force_full)
+        cdc = CdcPoller(CHANGE_SOURCES[CHANGE_SOURCE]()) if CHANGE_SOURCE != 'watermark' else None
+        cdc_version = None
+        deleted = ()
+        delta = None
         
         # Conectar y obtener datos actuales
         conn = connect_to_sql()
         try:
-            current_data = execute_query(conn)
+            cdc_result = None
+            if cdc and not full_sync:
+                cdc_result = cdc.poll(conn)
+                full_sync = cdc_result is None
+            if full_sync:
+                if cdc:
+                    cdc_version = cdc.begin_full_sync(conn)
+                current_data = execute_query(conn)
+            elif cdc_result:
+                description, rows, deleted, cdc_version = cdc_result
+                current_data = merge_incremental(previous_data, rows_to_records(description, rows), deleted)
+            else:
+                delta = execute_query(conn, since=watermark['CitMod'])
+                current_data = merge_incremental(previous_data, delta)
+            
+            # Lápidas, cambios, JSON, diario y estado (compartido con sync_engine.py)
+            new_appointments, updated_appointments, tombstones = apply_changes(
+                conn, store, previous_data, current_data, deleted, migrate_state)
         finally:
             conn.close()
             log_message("🔌 Conexión SQL cerrada")
         
-        # Procesar cambios
-        new_appointments, updated_appointments = process_appointments(current_data, previous_data)
-        
-        # Guardar datos actualizados
-        save_data(current_data, OUTPUT_FILE)
+        # La marca de agua avanza solo cuando el estado ya está guardado
+        last_full_sync = start_time.isoformat() if full_sync else watermark.get('last_full_sync')
+        # En modo incremental, desde las filas leídas (el delta completo), no
+        # desde la instantánea recortada a la ventana y a MAX_RECORDS
+        save_watermark(WATERMARK_FILE, delta if delta is not None else current_data, last_full_sync)
+        store.close()
+        if cdc and cdc_version is not None:
+            cdc.save_version(cdc_version)
         
         # Intentar enviar al backend
-        backend_success = send_to_backend(current_data)
+        backend_success = send_to_backend(current_data, tombstones)
         
         # Calcular tiempo de ejecución
         end_time = datetime.now()
@@ -389,9 +569,12 @@ def main():
         log_message("=" * 60)
         log_message("📊 RESUMEN DE SINCRONIZACIÓN")
         log_message(f"⏱️ Tiempo de ejecución: {execution_time:.2f} segundos")
+        log_message(f"🔁 Modo: {'Completo' if full_sync else 'Incremental'} (origen: {CHANGE_SOURCE})")
         log_message(f"📋 Total de citas: {len(current_data)}")
         log_message(f"🆕 Citas nuevas: {len(new_appointments)}")
         log_message(f"🔄 Citas actualizadas: {len(updated_appointments)}")
+        removed = sum(1 for t in tombstones if t['reason'] == 'deleted')
+        log_message(f"🗑️ Citas eliminadas: {removed}, fuera de ventana: {len(tombstones) - removed}")
         log_message(f"🌐 Backend API: {'✅ Conectado' if backend_success else '❌ No disponible'}")
         
         if new_appointments:
@@ -421,10 +604,9 @@ def main():
         # Intentar notificar el error al backend
         try:
             if test_backend_connection():
-                requests.post(
-                    f"{BACKEND_URL}/api/sync-error",
-                    json={'error': str(e), 'timestamp': datetime.now().isoformat()},
-                    timeout=10
+                backend_client().post(
+                    '/api/sync-error',
+                    json.dumps({'error': str(e), 'timestamp': datetime.now().isoformat()}).encode('utf-8')
                 )
         except:
             pass  # Ignorar errores de notificación
@@ -432,5 +614,5 @@ def main():
         return 1  # Código de salida con error
 
 if __name__ == "__main__":
-    exit_code = main()
+    exit_code = main(force_full='--full' in sys.argv[1:])
     sys.exit(exit_code)
\ No newline at end of file
@@ -16,6 +16,13 @@ import os
 import sys
 from typing import List, Dict, Any, Optional
 
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery, rolling_window_filter
+from gesden_record import Appointment, appointments_from_rows, content_digest, json_default
+from gesden_rows import RowConverter
+from gesden_snapshot import write_json_atomic
+from gesden_state import open_state_store
+
 # Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
@@ -42,11 +49,14 @@ APP_CONFIG = {
     'use_api': False  # Usar archivos locales en lugar de API
 }
 
-# Archivo para guardar el estado de la última sincronización
+# Estado de la última sincronización (Registro -> resumen), ver gesden_state.py.
+# STATE_FILE es el formato anterior; se importa la primera vez.
+STATE_NAME = 'sync_state_app'
 STATE_FILE = 'last_sync_state.json'
 
 class SQLSyncService:
     def __init__(self):
+        self.state = open_state_store(STATE_NAME, keep_records=False)
         self.last_sync_data = self.load_last_sync_state()
         
     def log_message(self, message: str, level: str = 'info'):
@@ -58,26 +68,49 @@ class SQLSyncService:
         else:
             logger.info(message)
     
+    def import_legacy_state(self):
+        """Importa last_sync_state.json (citas completas o resúmenes) al almacén vacío"""
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+        digests = legacy.get('digests') or {
+            k: content_digest(v) for k, v in legacy.get('appointments', {}).items()
+        }
+        with self.state.transaction():
+            self.state.upsert([{'Registro': k} for k in digests], lambda r: digests[r['Registro']])
+            if legacy.get('last_sync'):
+                self.state.set_meta('last_sync', legacy['last_sync'])
+        self.log_message(f"Estado importado de {STATE_FILE}: {len(digests)} citas")
+    
     def load_last_sync_state(self) -> Dict[str, Any]:
-        """Carga el estado de la última sincronización"""
+        """Carga el estado de la última sincronización (Registro -> resumen de la cita)"""
         try:
-            if os.path.exists(STATE_FILE):
-                with open(STATE_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+            if len(self.state) == 0 and os.path.exists(STATE_FILE):
+                self.import_legacy_state()
+            return {
+                'last_sync': self.state.get_meta('last_sync'),
+                'digests': self.state.digests()
+            }
         except Exception as e:
             self.log_message(f"Error cargando estado anterior: {e}", 'warning')
         return {}
     
-    def save_sync_state(self, appointments: List[Dict[str, Any]]):
-        """Guarda el estado actual de las citas"""
+    def save_sync_state(self, appointments: List[Appointment]):
+        """Guarda solo los resúmenes que cambian y elimina las citas que ya no están"""
         try:
-            state = {
-                'last_sync': datetime.now().isoformat(),
-                'appointments': {apt['Registro']: apt for apt in appointments}
+            previous = self.last_sync_data.get('digests', {})
+            current = {str(apt['Registro']): apt for apt in appointments}
+            changed = [apt for registro, apt in current.items() if previous.get(registro) != content_digest(apt)]
+            removed = [registro for registro in previous if registro not in current]
+            with self.state.transaction():
+                self.state.upsert(changed, content_digest)
+                self.state.delete(removed)
+                self.state.set_meta('last_sync', datetime.now().isoformat())
+            self.last_sync_data = {
+                'last_sync': self.state.get_meta('last_sync'),
+                'digests': {registro: content_digest(apt) for registro, apt in current.items()}
             }
-            with open(STATE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(state, f, ensure_ascii=False, indent=2)
-            self.log_message(f"Estado guardado: {len(appointments)} citas")
+            self.log_message(f"Estado guardado: {len(changed)} citas escritas, {len(removed)} eliminadas, "
+                             f"{len(current)} en total")
         except Exception as e:
             self.log_message(f"Error guardando estado: {e}", 'error')
     
@@ -99,80 +132,25 @@ class SQLSyncService:
             self.log_message(f"Error conectando a SQL Server: {e}", 'error')
             raise
     
-    def fetch_appointments_from_sql(self) -> List[Dict[str, Any]]:
+    def fetch_appointments_from_sql(self) -> List[Appointment]:
         """Obtiene las citas desde SQL Server"""
-        query = """
-        SELECT TOP 100
-        [IdCita] AS Registro,
-        [HorSitCita] AS CitMod,
-        FecAlta AS FechaAlta,
-        [NUMPAC] AS NumPac,
-        CASE 
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(LEFT(Texto, CHARINDEX(',', Texto) - 1)))
-            ELSE NULL
-        END AS Apellidos,
-        CASE 
-            WHEN CHARINDEX(',', Texto) > 0 THEN LTRIM(RTRIM(SUBSTRING(Texto, CHARINDEX(',', Texto) + 1, LEN(Texto))))
-            ELSE Texto
-        END AS Nombre,
-        Movil AS TelMovil,
-        CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha,
-        CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) AS Hora,
-        CASE 
-            WHEN IdSitC = 0 THEN 'Planificada'
-            WHEN IdSitC = 1 THEN 'Anulada'
-            WHEN IdSitC = 5 THEN 'Finalizada'
-            WHEN IdSitC = 7 THEN 'Confirmada'
-            WHEN IdSitC = 8 THEN 'Cancelada'
-            ELSE 'Desconocido'
-        END AS EstadoCita,
-        CASE 
-            WHEN IdIcono = 1 THEN 'Revision'
-            WHEN IdIcono = 2 THEN 'Urgencia'
-            WHEN IdIcono = 9 THEN 'Periodoncia'
-            WHEN IdIcono = 10 THEN 'Cirugia Implantes'
-            WHEN IdIcono = 11 THEN 'Ortodoncia'
-            WHEN IdIcono = 13 THEN 'Primera'
-            WHEN IdIcono = 14 THEN 'Higiene dental'
-            ELSE 'Otros'
-        END AS Tratamiento,
-        CASE 
-            WHEN IdUsu = 3 THEN 'Dr. Mario Rubio'
-            WHEN IdUsu = 4 THEN 'Dra. Irene Garcia'
-            WHEN IdUsu = 8 THEN 'Dra. Virginia Tresgallo'
-            WHEN IdUsu = 10 THEN 'Dra. Miriam Carrasco'
-            WHEN IdUsu = 12 THEN 'Dr. Juan Antonio Manzanedo'
-            ELSE 'Odontologo'
-        END AS Odontologo,
-        NOTAS AS Notas
-        FROM dbo.DCitas
-        WHERE Fecha >= DATEDIFF(DAY, '1900-01-01', GETDATE() - 90)  -- Últimos 90 días
-        ORDER BY HorSitCita DESC;
-        """
+        window_filter, params = rolling_window_filter(90)  # Últimos 90 días
         
         conn = None
         try:
             conn = self.connect_to_sql_server()
             cursor = conn.cursor()
+            query = AppointmentQuery(get_catalog(cursor), top=100, where=window_filter, params=params)
             
             self.log_message("Ejecutando consulta SQL...")
-            cursor.execute(query)
-            
-            # Obtener nombres de columnas
-            columns = [column[0] for column in cursor.description]
+            query.execute(cursor)
             
             # Obtener datos
-            rows = cursor.fetchall()
+            rows = query.fetchall(cursor)
             
-            # Convertir a lista de diccionarios
-            appointments = []
-            for row in rows:
-                appointment = dict(zip(columns, row))
-                # Convertir datetime a string si es necesario
-                for key, value in appointment.items():
-                    if isinstance(value, datetime):
-                        appointment[key] = value.isoformat()
-                appointments.append(appointment)
+            # Convertir a registros Appointment (datetime a ISO, NULL se conserva)
+            converter = RowConverter(query.description(cursor), null=None, datetime_format=None)
+            appointments = appointments_from_rows(converter.columns, converter.to_tuples(rows))
             
             self.log_message(f"Consulta ejecutada. Se encontraron {len(appointments)} registros.")
             return appointments
@@ -184,14 +162,14 @@ class SQLSyncService:
             if conn:
                 conn.close()
     
-    def analyze_changes(self, current_appointments: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    def analyze_changes(self, current_appointments: List[Appointment]) -> Dict[str, List[Appointment]]:
         """Analiza los cambios entre la sincronización anterior y actual"""
         new_appointments = []
         updated_appointments = []
         all_appointments = current_appointments
         
-        # Obtener citas de la sincronización anterior
-        previous_appointments = self.last_sync_data.get('appointments', {})
+        # Resúmenes de la sincronización anterior
+        previous_digests = self.last_sync_data.get('digests', {})
         
         for appointment in current_appointments:
             registro = str(appointment['Registro'])
@@ -200,14 +178,14 @@ class SQLSyncService:
             
             # Verificar si es una cita nueva (FechaAlta == CitMod)
             if fecha_alta == cit_mod:
-                if registro not in previous_appointments:
+                if registro not in previous_digests:
                     new_appointments.append(appointment)
                     self.log_message(f"Nueva cita detectada: {registro} - {appointment.get('Nombre', '')} {appointment.get('Apellidos', '')}")
             else:
                 # Es una actualización (FechaAlta != CitMod)
-                if registro in previous_appointments:
+                if registro in previous_digests:
                     # Verificar si hay cambios reales
-                    if self.has_appointment_changed(previous_appointments[registro], appointment):
+                    if previous_digests[registro] != content_digest(appointment):
                         updated_appointments.append(appointment)
                         self.log_message(f"Cita actualizada: {registro} - {appointment.get('Nombre', '')} {appointment.get('Apellidos', '')}")
                 else:
@@ -221,38 +199,21 @@ class SQLSyncService:
             'all': all_appointments
         }
     
-    def has_appointment_changed(self, previous: Dict[str, Any], current: Dict[str, Any]) -> bool:
-        """Verifica si una cita ha cambiado"""
-        # Campos importantes para comparar
-        fields_to_compare = [
-            'Fecha', 'Hora', 'EstadoCita', 'Tratamiento', 
-            'Odontologo', 'Notas', 'TelMovil', 'Nombre', 'Apellidos'
-        ]
-        
-        for field in fields_to_compare:
-            if str(previous.get(field, '')) != str(current.get(field, '')):
-                self.log_message(f"Campo cambiado '{field}': '{previous.get(field, '')}' -> '{current.get(field, '')}'")
-                return True
-        
-        return False
-    
     def save_for_app(self, data: Dict[str, Any]) -> bool:
         """Guarda los datos en formato que la app puede leer"""
         try:
             # Convertir datos al formato que espera la app React Native
             formatted_data = self.format_data_for_app(data)
             
-            # Guardar archivo principal para la app
-            with open(APP_CONFIG['data_file'], 'w', encoding='utf-8') as f:
-                json.dump(formatted_data, f, ensure_ascii=False, indent=2)
+            # Guardar archivo principal para la app (reemplazo atómico)
+            write_json_atomic(APP_CONFIG['data_file'], formatted_data)
             
             # Guardar archivo de respaldo
-            with open(APP_CONFIG['backup_file'], 'w', encoding='utf-8') as f:
-                json.dump({
-                    'timestamp': datetime.now().isoformat(),
-                    'raw_data': data,
-                    'formatted_data': formatted_data
-                }, f, ensure_ascii=False, indent=2)
+            write_json_atomic(APP_CONFIG['backup_file'], {
+                'timestamp': datetime.now().isoformat(),
+                'raw_data': data,
+                'formatted_data': formatted_data
+            }, default=json_default)
             
             self.log_message(f"Datos guardados para la app: {APP_CONFIG['data_file']}")
             self.log_message(f"Nuevas: {len(data['new'])}, Actualizadas: {len(data['updated'])}, Total: {len(data['all'])}")
@@ -351,7 +312,7 @@ class SQLSyncService:
             }
             
             with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(backup_data, f, ensure_ascii=False, indent=2)
+                json.dump(backup_data, f, ensure_ascii=False, indent=2, default=json_default)
             
             self.log_message(f"Datos guardados en archivo de respaldo: {filename}")
         except Exception as e:
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motor de sincronización: una sola lectura de dbo.DCitas por ciclo y reparto
+del resultado a varios destinos (sinks).
+
+Antes cada script (sql_sync_robust, sql_sync_script, gesden_to_sheets, ...)
+lanzaba su propia consulta; aquí la consulta se ejecuta una vez y cada sink
+recibe la misma lista de registros. La excepción es 'sheets', que repite la
+consulta de gesden_to_sheets sobre la misma conexión (ver SheetsSink).
+
+Sinks disponibles (variable SYNC_SINKS o --sinks, separados por comas):
+  • app      → appointments_data.json, diario y estado (apply_changes de sql_sync_robust)
+  • app_v2   → formato React Native (save_for_app de sql_sync_script)
+  • sheets   → Google Sheets (upsert_and_prune de gesden_to_sheets), con la
+               consulta propia de gesden_to_sheets (fetch_rows: las TOP_RECORDS
+               últimas modificadas, sin ventana de fechas) para que la hoja sea
+               la misma con el sink que con el script
+  • csv      → CSV local (SYNC_CSV_FILE)
+  • backend  → POST al backend (send_to_backend de sql_sync_robust)
+
+'app' y 'app_v2' escriben ambos appointments_data.json: usar solo uno.
+
+Modo demonio (--daemon): un único proceso que mantiene la conexión SQL
+abierta y sincroniza cada --interval segundos (admite menos de un minuto),
+en lugar de arrancar Python desde el Programador de Tareas cada 5 minutos.
+
+Uso:
+  python sync_engine.py [--sinks app,sheets,backend]
+  python sync_engine.py --daemon --interval 30 [--sinks ...]
+"""
+
+import abc
+import argparse
+import csv
+import datetime
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from gesden_catalog import get_catalog
+from gesden_query import AppointmentQuery, rolling_window_filter
+from gesden_record import Appointment, appointments_from_rows
+from gesden_rows import RowConverter
+
+# Ventana de extracción común a todos los sinks (la más amplia de los scripts)
+EXTRACT_TOP = int(os.getenv('SYNC_EXTRACT_TOP', '300'))
+EXTRACT_DAYS_BACK = int(os.getenv('SYNC_DAYS_BACK', '90'))
+EXTRACT_DAYS_FORWARD = int(os.getenv('SYNC_DAYS_FORWARD', '365'))
+
+DEFAULT_SINKS = os.getenv('SYNC_SINKS', 'app,backend')
+CSV_FILE = os.getenv('SYNC_CSV_FILE', 'appointments_sync.csv')
+
+DAEMON_INTERVAL = float(os.getenv('SYNC_INTERVAL_SECONDS', '300'))
+# Si la conexión lleva más de esto sin usarse, se comprueba con SELECT 1
+LIVENESS_IDLE_SECONDS = float(os.getenv('SYNC_LIVENESS_IDLE_SECONDS', '120'))
+
+
+def log(msg: str) -> None:
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+
+
+# --- Extracción ---
+
+def build_extract_query(cursor: Any) -> AppointmentQuery:
+    window_filter, params = rolling_window_filter(EXTRACT_DAYS_BACK, EXTRACT_DAYS_FORWARD)
+    return AppointmentQuery(
+        get_catalog(cursor),
+        top=EXTRACT_TOP,
+        where=window_filter,
+        params=params,
+        include_duration=True,
+    )
+
+
+def extract(conn: Any) -> List[Appointment]:
+    """Única lectura de la base de datos del ciclo."""
+    cursor = conn.cursor()
+    try:
+        query = build_extract_query(cursor)
+        start = time.time()
+        query.execute(cursor)
+        rows = query.fetchall(cursor)
+        log(f"Extracción: {len(rows)} registros en {time.time() - start:.2f}s")
+        converter = RowConverter(query.description(cursor))
+        return appointments_from_rows(converter.columns, converter.to_tuples(rows))
+    finally:
+        cursor.close()
+
+
+# --- Sinks ---
+
+class SyncCycle:
+    """Lo que comparten los sinks en un ciclo: la conexión SQL y las lápidas que calcula 'app'."""
+
+    def __init__(self, conn: Any) -> None:
+        self.conn = conn
+        self.tombstones: Optional[List[Dict[str, Any]]] = None
+
+
+class Sink(abc.ABC):
+    """Destino de los registros extraídos en cada ciclo."""
+
+    name = 'sink'
+
+    @abc.abstractmethod
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class AppJsonSink(Sink):
+    """appointments_data.json, diario de cambios y estado (apply_changes de sql_sync_robust).
+
+    Usa el mismo almacén de estado que sql_sync_robust.main (sync_state.db),
+    abierto una vez: las citas del ciclo anterior se mantienen en memoria y
+    solo se releen si otro proceso ha escrito el almacén entretanto.
+    """
+
+    name = 'app'
+
+    def __init__(self) -> None:
+        import sql_sync_robust
+        self.robust = sql_sync_robust
+        self.store = sql_sync_robust.open_state_store(sql_sync_robust.STATE_NAME)
+        self.previous: Optional[Dict[str, Appointment]] = None
+        self.last_sync: Optional[str] = None
+
+    def _load_previous(self) -> bool:
+        """Carga self.previous si hace falta; devuelve True si el estado viene del JSON (migración)."""
+        migrate = len(self.store) == 0
+        if migrate:
+            self.previous = self.robust.load_previous_data(self.robust.OUTPUT_FILE)
+        elif self.previous is None or self.store.get_meta('last_sync') != self.last_sync:
+            self.previous = self.store.load_all()
+            log(f"[app] Datos previos cargados del almacén: {len(self.previous)} registros")
+        return migrate
+
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        migrate = self._load_previous()
+        previous = self.previous or {}
+        # Lápidas (con la conexión del motor), JSON, diario y estado, igual que
+        # sql_sync_robust.main; 'backend' reutiliza las lápidas en el mismo ciclo
+        new, updated, cycle.tombstones = self.robust.apply_changes(
+            cycle.conn, self.store, previous, records, migrate_state=migrate)
+        self.previous = {str(r['Registro']): r for r in records}
+        self.last_sync = self.store.get_meta('last_sync')
+        log(f"[app] Nuevas: {len(new)}, Actualizadas: {len(updated)}, Lápidas: {len(cycle.tombstones)}")
+
+    def close(self) -> None:
+        self.store.close()
+
+
+class AppFormattedSink(Sink):
+    """Formato de la app React Native (SQLSyncService.save_for_app)."""
+
+    name = 'app_v2'
+
+    def __init__(self) -> None:
+        from sql_sync_script import SQLSyncService
+        self.service = SQLSyncService()
+
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        changes = self.service.analyze_changes(records)
+        if not self.service.save_for_app(changes):
+            raise RuntimeError('save_for_app falló')
+        self.service.save_sync_state(records)
+
+
+class SheetsSink(Sink):
+    """Google Sheets mediante upsert_and_prune (gesden_to_sheets).
+
+    No usa los registros de la extracción común (ventana de fechas, TOP
+    EXTRACT_TOP) sino gesden_to_sheets.fetch_rows sobre la misma conexión.
+    """
+
+    name = 'sheets'
+
+    def __init__(self) -> None:
+        import gesden_to_sheets
+        self.sheets = gesden_to_sheets
+        self.ws = None
+        self.ss = None
+
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        cursor = cycle.conn.cursor()
+        try:
+            rows = self.sheets.fetch_rows(cursor)
+        finally:
+            cursor.close()
+        if not rows:
+            return
+        if self.sheets.SHEETS_SHARD_BY:
+            # Una pestaña por mes u odontólogo (SHEETS_SHARD_BY)
+            if self.ss is None:
+                self.ss = self.sheets.open_spreadsheet()
+            self.sheets.sync_sharded(self.ss, rows)
+            return
+        if self.ws is None:
+            self.ws = self.sheets.authorize_sheets()
+        self.sheets.upsert_and_prune(self.ws, rows)
+
+
+class CsvSink(Sink):
+    """CSV local, reescrito de forma atómica en cada ciclo."""
+
+    name = 'csv'
+
+    def __init__(self, path: str = CSV_FILE) -> None:
+        self.path = path
+
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        if not records:
+            return
+        columns = list(records[0].keys())
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows([d.get(c, '') for c in columns] for d in records)
+        os.replace(tmp, self.path)
+        log(f"[csv] {len(records)} filas en {self.path}")
+
+
+class BackendSink(Sink):
+    """POST al backend (send_to_backend de sql_sync_robust), con las lápidas de 'app' si está activo."""
+
+    name = 'backend'
+
+    def __init__(self) -> None:
+        import sql_sync_robust
+        self.robust = sql_sync_robust
+
+    def write(self, records: List[Appointment], cycle: SyncCycle) -> None:
+        if not self.robust.send_to_backend(records, cycle.tombstones):
+            raise RuntimeError('backend no disponible')
+
+
+SINKS = {cls.name: cls for cls in (AppJsonSink, AppFormattedSink, SheetsSink, CsvSink, BackendSink)}
+
+
+def build_sinks(names: str) -> List[Sink]:
+    sinks: List[Sink] = []
+    for name in [n.strip() for n in names.split(',') if n.strip()]:
+        if name not in SINKS:
+            raise ValueError(f"Sink desconocido: {name} (disponibles: {', '.join(SINKS)})")
+        sinks.append(SINKS[name]())
+    # 'app' primero: calcula las lápidas que usa 'backend'
+    sinks.sort(key=lambda sink: sink.name != 'app')
+    return sinks
+
+
+# --- Motor ---
+
+class SyncEngine:
+    """Ejecuta la extracción una vez por ciclo y la reparte a los sinks."""
+
+    def __init__(self, sinks: List[Sink]) -> None:
+        self.sinks = sinks
+
+    def run_once(self, conn: Any) -> Dict[str, Optional[str]]:
+        """Devuelve {sink: None | mensaje de error}. Un sink que falla no afecta a los demás."""
+        records = extract(conn)
+        cycle = SyncCycle(conn)
+        results: Dict[str, Optional[str]] = {}
+        for sink in self.sinks:
+            start = time.time()
+            try:
+                sink.write(records, cycle)
+                results[sink.name] = None
+                log(f"[{sink.name}] OK ({time.time() - start:.2f}s)")
+            except Exception as e:
+                results[sink.name] = str(e)
+                log(f"[{sink.name}] ❌ Error: {e}")
+        return results
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                log(f"[{sink.name}] ⚠️ Error al cerrar: {e}")
+
+
+# --- Conexión persistente y demonio ---
+
+class SqlConnection:
+    """Conexión SQL reutilizable entre ciclos con comprobación de vida y reconexión."""
+
+    def __init__(self, connect: Callable[[], Any], liveness_idle: float = LIVENESS_IDLE_SECONDS) -> None:
+        self.connect = connect
+        self.liveness_idle = liveness_idle
+        self.conn: Any = None
+        self.last_used = 0.0
+
+    def _alive(self) -> bool:
+        try:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            finally:
+                cursor.close()
+            return True
+        except Exception as e:
+            log(f"⚠️ Conexión SQL caída: {e}")
+            return False
+
+    def get(self) -> Any:
+        if self.conn is not None and time.monotonic() - self.last_used > self.liveness_idle:
+            if not self._alive():
+                self.reset()
+        if self.conn is None:
+            self.conn = self.connect()
+        self.last_used = time.monotonic()
+        return self.conn
+
+    def reset(self) -> None:
+        """Descarta la conexión actual; la siguiente llamada a get() reconecta."""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+    close = reset
+
+
+def run_daemon(engine: SyncEngine, sql: SqlConnection, interval: float,
+               max_ticks: Optional[int] = None) -> None:
+    """Ejecuta un ciclo cada `interval` segundos (ritmo fijo, sin acumular retrasos)."""
+    log(f"🚀 Demonio de sincronización iniciado (intervalo {interval:g}s, sinks: "
+        f"{', '.join(s.name for s in engine.sinks)})")
+    ticks = 0
+    next_run = time.monotonic()
+    try:
+        while max_ticks is None or ticks < max_ticks:
+            start = time.monotonic()
+            try:
+                engine.run_once(sql.get())
+            except Exception as e:
+                # Error de extracción: se asume conexión inválida y se reconecta en el siguiente ciclo
+                log(f"❌ Error en el ciclo: {e}")
+                sql.reset()
+            ticks += 1
+            log(f"Ciclo {ticks} completado en {time.monotonic() - start:.2f}s")
+
+            next_run += interval
+            delay = next_run - time.monotonic()
+            if delay < 0:
+                log(f"⚠️ El ciclo superó el intervalo en {-delay:.2f}s")
+                next_run = time.monotonic()
+                delay = 0
+            if max_ticks is None or ticks < max_ticks:
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        log("Demonio detenido por el usuario")
+    finally:
+        sql.close()
+        engine.close()
+        log("🔌 Conexión SQL cerrada")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Sincronización Gesden con una sola extracción por ciclo')
+    parser.add_argument('--sinks', default=DEFAULT_SINKS, help=f"Destinos separados por comas ({', '.join(SINKS)})")
+    parser.add_argument('--daemon', action='store_true', help='Mantener el proceso y sincronizar periódicamente')
+    parser.add_argument('--interval', type=float, default=DAEMON_INTERVAL,
+                        help=f'Segundos entre ciclos en modo demonio (por defecto {DAEMON_INTERVAL:g})')
+    args = parser.parse_args()
+    if args.interval <= 0:
+        parser.error('--interval debe ser mayor que 0')
+
+    from sql_sync_robust import connect_to_sql
+
+    try:
+        engine = SyncEngine(build_sinks(args.sinks))
+    except ValueError as e:
+        log(f"❌ {e}")
+        return 2
+
+    if args.daemon:
+        run_daemon(engine, SqlConnection(connect_to_sql), args.interval)
+        return 0
+
+    conn = None
+    try:
+        conn = connect_to_sql()
+        results = engine.run_once(conn)
+        return 0 if all(err is None for err in results.values()) else 1
+    except Exception as e:
+        log(f"❌ Error en la sincronización: {e}")
+        return 1
+    finally:
+        if conn is not None:
+            conn.close()
+        engine.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""CDC de extremo a extremo con el sustituto SQLite (SqliteChangeSource + CdcPoller)."""
+
+import datetime
+import sqlite3
+
+import pytest
+
+import gesden_cdc
+from gesden_catalog import get_catalog
+from gesden_cdc import CdcPoller, SqliteChangeSource
+from gesden_query import AppointmentQuery, date_to_fecha
+
+TODAY = datetime.date.today()
+
+
+def fecha(days):
+    return date_to_fecha(TODAY + datetime.timedelta(days=days))
+
+
+def cita(id_cita, texto, days=1, hora=9 * 3600, modified='2025-01-01 10:00:00', duracion=1800):
+    return (id_cita, modified, '2024-12-01 09:00:00', 1000 + id_cita, texto, '600000000',
+            fecha(days), hora, 1, 2, 3, None, duracion)
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE DCitas (
+            IdCita INTEGER PRIMARY KEY, HorSitCita TEXT, FecAlta TEXT, NUMPAC INTEGER, Texto TEXT,
+            Movil TEXT, Fecha INTEGER, Hora INTEGER, IdSitC INTEGER, IdIcono INTEGER, IdUsu INTEGER,
+            NOTAS TEXT, Duracion INTEGER
+        )''')
+    SqliteChangeSource().install(conn)
+    conn.executemany('INSERT INTO DCitas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [cita(1, 'Lopez, Ana'), cita(2, 'Ruiz, Eva'), cita(3, 'Gil, Luis')])
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def poller(conn, tmp_path):
+    poller = CdcPoller(SqliteChangeSource(), str(tmp_path / 'cdc_state.json'))
+    # Lectura completa inicial: la versión se toma antes de leer
+    poller.save_version(poller.begin_full_sync(conn))
+    return poller
+
+
+def change(conn):
+    conn.execute('INSERT INTO DCitas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 cita(4, 'Sanz, Rosa', modified='2025-01-02 08:00:00'))
+    conn.execute("UPDATE DCitas SET Texto = 'Ruiz, Eva M.', HorSitCita = '2025-01-02 09:00:00' WHERE IdCita = 2")
+    conn.execute('DELETE FROM DCitas WHERE IdCita = 1')
+    conn.commit()
+
+
+def test_poll_without_saved_version_requires_full_sync(conn, tmp_path):
+    assert CdcPoller(SqliteChangeSource(), str(tmp_path / 'missing.json')).poll(conn) is None
+
+
+def test_poll_returns_inserts_updates_and_deletes_since_version(conn, poller):
+    change(conn)
+    description, rows, deleted, version = poller.poll(conn)
+
+    columns = [name for name, _ in description]
+    assert columns == AppointmentQuery(get_catalog(), include_duration=True, raw=True).columns
+    by_key = {row[0]: dict(zip(columns, row)) for row in rows}
+    assert sorted(by_key) == [2, 4]
+    assert deleted == [1]
+    assert version == SqliteChangeSource().current_version(conn.cursor())
+    assert (by_key[2]['Apellidos'], by_key[2]['Nombre']) == ('Ruiz', 'Eva M.')
+    assert by_key[4]['Fecha'] == (TODAY + datetime.timedelta(days=1)).isoformat()
+    assert (by_key[4]['Hora'], by_key[4]['Duracion']) == ('09:00', 30)
+
+    # Con la versión guardada, el siguiente ciclo no ve cambios
+    poller.save_version(version)
+    assert poller.poll(conn) == ([], [], [], version)
+
+
+def test_changes_are_netted_per_key(conn, poller):
+    conn.execute('INSERT INTO DCitas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', cita(5, 'Diez, Pau'))
+    conn.execute('DELETE FROM DCitas WHERE IdCita = 5')
+    conn.execute('UPDATE DCitas SET IdCita = 30 WHERE IdCita = 3')
+    conn.commit()
+    _, rows, deleted, _ = poller.poll(conn)
+    assert [row[0] for row in rows] == [30]
+    assert sorted(deleted) == [3, 5]
+
+
+def test_fetch_reads_keys_in_chunks(conn, poller, monkeypatch):
+    conn.executemany('INSERT INTO DCitas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [cita(i, f'Paciente, {i}') for i in range(10, 17)])
+    conn.commit()
+    monkeypatch.setattr(gesden_cdc, 'FETCH_CHUNK', 3)
+    statements = []
+    conn.set_trace_callback(statements.append)
+
+    _, rows, _, _ = poller.poll(conn)
+
+    assert sorted(row[0] for row in rows) == list(range(10, 17))
+    selects = [s for s in statements if s.startswith(SqliteChangeSource.RAW_SELECT)]
+    assert len(selects) == 3  # 3 + 3 + 1 claves
+
+
+def test_version_older_than_retention_falls_back_to_full_sync(conn, poller):
+    source = SqliteChangeSource()
+    change(conn)
+    source.cleanup(conn, source.current_version(conn.cursor()))
+    assert poller.poll(conn) is None
+
+    # Tras la lectura completa se vuelve a trabajar por cambios
+    poller.save_version(poller.begin_full_sync(conn))
+    conn.execute("UPDATE DCitas SET NOTAS = 'Llamar' WHERE IdCita = 3")
+    conn.commit()
+    _, rows, deleted, _ = poller.poll(conn)
+    assert [row[0] for row in rows] == [3] and deleted == []
+
+
+def test_sql_sync_robust_merges_cdc_changes_into_previous_snapshot(conn, poller, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # sql_sync_robust abre sql_sync.log al importarse
+    robust = pytest.importorskip('sql_sync_robust')
+    cursor = conn.cursor()
+    source = SqliteChangeSource()
+    description, rows = source.fetch(cursor, [1, 2, 3])
+    previous = {str(apt['Registro']): apt for apt in robust.rows_to_records(description, rows)}
+
+    # La cita 3 se mueve fuera de la ventana; la 1 se borra; la 2 cambia; la 4 es nueva
+    change(conn)
+    conn.execute('UPDATE DCitas SET Fecha = ?, HorSitCita = ? WHERE IdCita = 3',
+                 [fecha(robust.DAYS_FORWARD + 30), '2025-01-03 08:00:00'])
+    conn.commit()
+    description, rows, deleted, _ = poller.poll(conn)
+    merged = robust.merge_incremental(previous, robust.rows_to_records(description, rows), deleted)
+
+    assert [apt['Registro'] for apt in merged] == [2, 4]  # por CitMod descendente
+    assert merged[0]['Nombre'] == 'Eva M.'
+    tombstones = robust.detect_tombstones(None, previous, merged, deleted)
+    assert {t['Registro']: t['reason'] for t in tombstones} == {1: 'deleted', 3: 'out_of_window'}
@@ -0,0 +1,113 @@
+"""Filtros sargables de gesden_query frente a las expresiones SQL anteriores.
+
+Las expresiones antiguas se evalúan en Python con la misma semántica que
+SQL Server:
+  • export: CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23)
+    comparado como texto con 'YYYY-MM-DD'
+  • ventana móvil: Fecha >= DATEADD(DAY, DATEDIFF(DAY, 0, GETDATE()) - N, 0);
+    el entero se convierte a datetime contando días desde 1900-01-01
+  • hora mostrada: CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108)
+"""
+
+import datetime
+import operator
+
+import pytest
+
+from gesden_catalog import get_catalog
+from gesden_query import (
+    AppointmentQuery, date_range_filter, date_to_fecha, fecha_to_date, hora_to_str, rolling_window_filter,
+    time_to_hora,
+)
+
+SQL_EPOCH = datetime.date(1900, 1, 1)
+OPS = {'>=': operator.ge, '<=': operator.le}
+
+
+def selects(sql, params, values):
+    """Evalúa un predicado 'Col >= ? AND Col <= ?' sobre {columna: valor}."""
+    result = True
+    for predicate, param in zip(sql.split(' AND '), params):
+        column, op, _ = predicate.split()
+        result = result and OPS[op](values[column], param)
+    return result
+
+
+def old_fecha_text(fecha):
+    return (SQL_EPOCH + datetime.timedelta(days=fecha - 2)).isoformat()
+
+
+def old_hora_text(hora):
+    return (datetime.datetime(1900, 1, 1) + datetime.timedelta(seconds=hora)).strftime('%H:%M')
+
+
+BOUNDARY_RANGES = [
+    ('2024-12-31', '2025-01-01'),  # cambio de año
+    ('2025-01-01', '2025-12-31'),
+    ('2024-02-28', '2024-03-01'),  # año bisiesto
+    ('2024-02-29', '2024-02-29'),
+    ('2023-02-28', '2023-03-01'),  # año no bisiesto
+    ('1900-02-28', '1900-03-01'),  # 1900 no fue bisiesto (SQL Server tampoco lo trata como tal)
+]
+
+
+@pytest.mark.parametrize('date_from,date_to', BOUNDARY_RANGES)
+def test_export_filter_matches_old_convert_between(date_from, date_to):
+    sql, params = date_range_filter(date_from, date_to)
+    assert sql == 'Fecha >= ? AND Fecha <= ?'
+    for fecha in range(params[0] - 10, params[1] + 11):
+        old = date_from <= old_fecha_text(fecha) <= date_to
+        assert selects(sql, params, {'Fecha': fecha}) == old, fecha
+
+
+@pytest.mark.parametrize('day', ['2024-12-31', '2025-01-01', '2024-02-28', '2024-02-29', '2024-03-01'])
+def test_fecha_roundtrip_matches_old_dateadd(day):
+    fecha = date_to_fecha(day)
+    assert old_fecha_text(fecha) == day
+    assert fecha_to_date(fecha).isoformat() == day
+
+
+def test_appointment_query_sql_and_params_for_from_to():
+    sql, params = date_range_filter('2024-02-29', '2025-01-01')
+    query = AppointmentQuery(get_catalog(), where=sql, params=params, include_duration=True, raw=True)
+    assert 'WHERE Fecha >= ? AND Fecha <= ?' in query.sql
+    assert 'CONVERT(VARCHAR(10)' not in query.sql.split('WHERE')[1]
+    assert query.params == [date_to_fecha('2024-02-29'), date_to_fecha('2025-01-01')] == [45351, 45658]
+
+
+@pytest.mark.parametrize('today', [
+    datetime.date(2025, 1, 1), datetime.date(2024, 12, 31), datetime.date(2024, 2, 29), datetime.date(2025, 6, 1),
+])
+def test_rolling_window_is_old_window_shifted_two_days(today):
+    back, forward = 90, 365
+    sql, params = rolling_window_filter(back, forward, today=today)
+    query = AppointmentQuery(get_catalog(), top=300, where=sql, params=params)
+    assert 'WHERE Fecha >= ? AND Fecha <= ?' in query.sql
+    assert 'GETDATE' not in query.sql
+    assert query.params == params
+
+    low = today - datetime.timedelta(days=back)
+    high = today + datetime.timedelta(days=forward)
+    new, old = [], []
+    for fecha in range(params[0] - 10, params[1] + 11):
+        if selects(sql, params, {'Fecha': fecha}):
+            new.append(fecha)
+        # Fecha (int) frente a un datetime: SQL Server cuenta días desde 1900-01-01
+        if low <= SQL_EPOCH + datetime.timedelta(days=fecha) <= high:
+            old.append(fecha)
+    # La expresión anterior seleccionaba la misma ventana dos días antes
+    assert old == [f - 2 for f in new]
+    # La nueva coincide con la fecha que ve el usuario
+    assert (fecha_to_date(new[0]), fecha_to_date(new[-1])) == (low, high)
+
+
+@pytest.mark.parametrize('time_from,time_to', [('00:00', '23:59'), ('09:30', '13:00'), ('23:59', '23:59')])
+def test_hora_filter_matches_old_dateadd_text(time_from, time_to):
+    sql, params = date_range_filter(time_from=time_from, time_to=time_to)
+    assert sql == 'Hora >= ? AND Hora <= ?'
+    # Las citas de la agenda van por minutos: Hora es múltiplo de 60
+    for hora in range(0, 86400, 60):
+        old = time_from <= old_hora_text(hora) <= time_to
+        assert selects(sql, params, {'Hora': hora}) == old, hora
+        assert hora_to_str(hora) == old_hora_text(hora)
+    assert params == [time_to_hora(time_from), time_to_hora(time_to)]